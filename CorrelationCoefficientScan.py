@@ -1,7 +1,10 @@
 # Standard modules
 import os
 import itertools
-from collections import OrderedDict
+import pickle
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+from collections import OrderedDict, deque
 import numpy as np
 import matplotlib as mpl
 mpl.use('TkAgg') #used to be mpl.use('macosx')
@@ -13,13 +16,22 @@ from astropy.time import Time
 import progressbar
 from scipy.io.idl import readsav
 from sunpy.util.metadata import MetaDict
-from automatic_fit_light_curve import automatic_fit_light_curve
+from automatic_fit_light_curve import automatic_fit_light_curve, automatic_fit_light_curves
 import math
 import sys
 
 # Custom modules
+from sliding_window_correlation import sliding_window_starts, sliding_window_correlation, \
+    lagged_sliding_window_correlation, template_bank_correlation, correlation_block_windows, \
+    discriminating_line_order, early_abandon_correlation
+from dynamic_time_warping import dtw_sliding_window_correlation
+from detection_events import DetectionEvents
+from smooth_light_curves import smooth_light_curves
 from jpm_time_conversions import metatimes_to_seconds_since_start, datetimeindex_to_human
 from jpm_logger import JpmLogger
+from concurrency_budget import ConcurrencyBudget, configure_concurrency, get_concurrency_budget
+from dimming_prefilter import dimming_prefilter, labeled_event_times, prefilter_recall
+from eve_archive import read_eve_lines
 
 __author__ = 'Tyler J Albee & Shawn A Polson'
 __contact__ = 'tyal7988@colorado.edu'
@@ -28,15 +40,146 @@ __contact__ = 'tyal7988@colorado.edu'
 def correlationCoefficientScan(output_path='/Users/tyleralbee/Desktop/StealthCME', 
                                eve_data_path='/Users/tyleralbee/Desktop/savesets/eve_selected_lines.csv',
                                cme_signature='/Users/tyleralbee/Desktop/savesets/eve_lines_event_percents_fitted.csv',
+                               window_stride=60,
+                               correlation_threshold=4.2,
+                               fit_light_curves=True,
+                               gamma_search='grid',
+                               smooth_once=False,
+                               refit_candidates=False,
+                               candidate_threshold=None,
+                               smoothed_eve_data_path=None,
+                               max_lag_minutes=None,
+                               dtw_band_minutes=None,
+                               merge_overlapping_windows=False,
+                               max_events=None,
+                               early_abandon=False,
+                               prefilter=False,
+                               prefilter_settings=None,
+                               labeled_catalog_path=None,
+                               n_processes=1,
+                               max_threads=None,
+                               checkpoint_interval=100,
+                               resume=False,
+                               incremental=False,
                                verbose=True):
+    """Slide a window the length of a CME signature across the EVE data and record windows that correlate with it.
 
-    eve_lines = pd.read_csv(eve_data_path, index_col=0)
-    eve_lines.index = pd.to_datetime(eve_lines.index)
-    wholeDfLength = eve_lines.__len__()
+    Inputs:
+        None.
+
+    Optional Inputs:
+        output_path [str]:             Set to a path for saving the output catalog, log, and fitting plots.
+        eve_data_path [str]:           The preprocessed SDO EVE extracted emission lines data (eve_selected_lines.csv),
+                                       or the EVE archive converted from it (see eve_archive.py), which loads in a
+                                       fraction of the time and memory.
+        cme_signature [str]:           The fitted CME signature produced by generate_cme_signature
+                                       (eve_lines_event_percents_fitted.csv), or a directory of such csv files to scan
+                                       against all of them in one pass (template bank mode). In that mode the output
+                                       catalog records the best matching template and every template's total
+                                       correlation coefficient. The signatures must all have the same length.
+        window_stride [int]:           The number of rows to advance the window between scores. Any stride >= 1 is
+                                       supported. Default is 60 (1 hour of 1-minute EVE data).
+        correlation_threshold [float]: The minimum total correlation coefficient (summed over all lines) for a window
+                                       to be written to the output catalog. Default is 4.2.
+        fit_light_curves [bool]:       Set to fit every line of every window with automatic_fit_light_curve before
+                                       scoring it, as the signature was. Set to False to score the raw irradiance of
+                                       all windows at once with the vectorized correlation engine. Default is True.
+        gamma_search [str]:            How automatic_fit_light_curve searches for the SVR gamma of each fit: 'grid'
+                                       for every gamma on every split, or 'halving' for successive halving, warm
+                                       started from the best gamma of the previous fit of the same line.
+                                       Default is 'grid'.
+        smooth_once [bool]:            Set together with fit_light_curves to fit every line over the whole data set
+                                       once with smooth_light_curves, in overlapping blocks with blended edges, and
+                                       score all windows of the smoothed data with the vectorized correlation engine
+                                       instead of refitting each overlapping window. Default is False.
+        refit_candidates [bool]:       Set together with smooth_once to treat windows of the smoothed data that cross
+                                       candidate_threshold as candidates only, and refit and rescore each candidate
+                                       window exactly as fit_light_curves alone would. Default is False.
+        candidate_threshold [float]:   The total correlation coefficient of the smoothed data that makes a window a
+                                       candidate for refitting. A value a little below correlation_threshold keeps
+                                       windows that smoothing scores slightly low. Default is None, meaning
+                                       correlation_threshold.
+        smoothed_eve_data_path [str]:  Set to a csv path to reuse the smoothed data of an earlier scan of the same EVE
+                                       data, or save it there for later scans. Default is None.
+        max_lag_minutes [float]:       Set to let each line shift by up to this many minutes in either direction
+                                       relative to the signature, keeping the best normalized cross-correlation per
+                                       line (FFT lag-tolerant mode). The best lag and coefficient of every line are
+                                       added to the output catalog. Default is None, meaning fixed alignment.
+        dtw_band_minutes [float]:      Set to match each line to the signature with dynamic time warping, letting any
+                                       point of a window be matched up to this many minutes away from its place in
+                                       the signature (a Sakoe-Chiba band), so stretched or compressed dimmings still
+                                       score highly. Lines are then scored on the correlation coefficient scale as
+                                       1 - DTW distance / (2 * signature rows) of the z-normalized curves, which
+                                       equals the Pearson coefficient for a band of 0. LB_Kim and LB_Keogh lower
+                                       bounds discard most windows before any DTW is run. Default is None, meaning
+                                       Pearson correlation.
+        merge_overlapping_windows [bool]: Set to write one row per event instead of one per window. Windows that cross
+                                       correlation_threshold and overlap are merged by non-maximum suppression into an
+                                       event whose row holds the best window's scores, its start ('Peak Time'), the
+                                       extent of all merged windows ('Start Time' to 'End Time'), and the number of
+                                       windows merged. Default is False.
+        max_events [int]:              Set to keep only this many of the highest scoring events (in a bounded heap, so
+                                       memory does not grow with the number of windows scanned). Implies
+                                       merge_overlapping_windows. Default is None, meaning all events.
+        early_abandon [bool]:          Set to score the lines of each window in order of how often they rule windows
+                                       out (see discriminating_line_order) and abandon a window as soon as its total,
+                                       plus 1 for every line not yet scored, falls below correlation_threshold. With
+                                       fit_light_curves, the remaining lines of an abandoned window are never fitted.
+                                       The catalog is unchanged; the average number of lines scored per window is
+                                       logged. Not supported with lags, DTW, or a template bank. Default is False.
+        prefilter [bool]:              Set together with fit_light_curves to fit and score only the windows of the raw
+                                       data in which several lines dim by a robust z-score relative to the first rows
+                                       of the window (see dimming_prefilter.py), which is cheap compared to fitting.
+                                       With refit_candidates, only the candidates that pass are refit. The pass rate
+                                       is logged. Raises a ValueError in the modes that fit no windows: without
+                                       fit_light_curves, or with smooth_once but not refit_candidates.
+                                       Default is False.
+        prefilter_settings [dict]:     Keyword arguments of dimming_prefilter, e.g., {'z_threshold': 2.5,
+                                       'min_lines': 2}. Default is None, meaning its defaults.
+        labeled_catalog_path [str]:    Set to a SOHO catalog with a "Stealth?" column (e.g., Labeled SOHO
+                                       Catalog/stealth_soho_catalog_best_window.csv) to log the fraction of the
+                                       labeled stealth CMEs within the scan that a passing window covers. Default is
+                                       None.
+        n_processes [int]:             The number of processes to split the scan across. The EVE time range is cut
+                                       into overlapping shards that are scored in one process pool for the whole scan
+                                       and merged back in time order, giving the same catalog as a serial run.
+                                       Reduced to max_threads if it is larger. Default is 1 (serial).
+        max_threads [int]:             The most threads the scan may use at once. They are split between the
+                                       n_processes shards, the fitting workers of each shard, and their BLAS threads,
+                                       so nested parallelism never oversubscribes the cores (see concurrency_budget.py).
+                                       Default is None, meaning the STEALTH_CME_MAX_THREADS environment variable or else
+                                       all available cores.
+        checkpoint_interval [int]:     The number of windows to score between checkpoints. As shards complete, in
+                                       time order, the last completed window and all detections so far are saved to
+                                       cc_checkpoint.pkl in output_path once this many more windows are scored. No
+                                       shard is longer than this, rounded up to a whole number of correlation engine
+                                       blocks, and shards are shorter when needed to keep every process busy.
+                                       Default is 100.
+        resume [bool]:                 Set to continue from the checkpoint in output_path instead of starting over.
+                                       The final catalog is the same as that of an uninterrupted run. Default is False.
+        incremental [bool]:            Set to scan only the rows appended to eve_data_path since the last complete
+                                       scan in output_path. A complete scan leaves its high-water mark (row count and
+                                       last time) and the rows its next windows need in cc_checkpoint.pkl, so only the
+                                       new rows are read and only windows that touch them are scored. New detections
+                                       are appended to the previous cc_output csv once the checkpoint records them.
+                                       Windows whose lag range was cut short by the old end of the data are not
+                                       rescored. Default is False.
+        verbose [bool]:                Set to log the processing messages to disk and console. Default is True.
+
+    Outputs:
+        No direct return, but writes a cc_output csv to disk with the windows that crossed correlation_threshold,
+        and the cc_checkpoint.pkl scan state.
 
-    cme_event = pd.read_csv(cme_signature, index_col=0)
-    cme_event.index = pd.to_datetime(cme_event.index)
-    cmeEventLength = cme_event.__len__()
+    Optional Outputs:
+        None
+
+    Example:
+        correlationCoefficientScan(window_stride=1, fit_light_curves=False, n_processes=8, verbose=True)
+        correlationCoefficientScan(window_stride=1, fit_light_curves=False, incremental=True)  # after appending a day
+        correlationCoefficientScan(window_stride=1, smooth_once=True, refit_candidates=True, candidate_threshold=3.8)
+        correlationCoefficientScan(window_stride=1, fit_light_curves=False, dtw_band_minutes=30)
+        correlationCoefficientScan(prefilter=True, labeled_catalog_path='stealth_soho_catalog_best_window.csv')
+    """
 
     if verbose:
         logger = JpmLogger(filename='do_correlation_coefficient_scan', path=output_path, console=True)
@@ -44,133 +187,986 @@ def correlationCoefficientScan(output_path='/Users/tyleralbee/Desktop/StealthCME
     else:
         logger = None
 
+    # Share the cores between the shard processes, their fitting workers, and the BLAS threads of each
+    concurrency_budget = configure_concurrency(total_threads=max_threads, outer_processes=n_processes)
+    n_processes = concurrency_budget.outer_processes
+    if verbose:
+        logger.info('Running with {0}.'.format(concurrency_budget))
+
+    # ----------Pick up from the last checkpoint---------------------------------------------------------------------
+
+    checkpoint_filename = output_path + 'cc_checkpoint.pkl'
+    checkpoint = None
+    if (resume or incremental) and os.path.exists(checkpoint_filename):
+        checkpoint = read_scan_checkpoint(checkpoint_filename)
+    elif (resume or incremental) and verbose:
+        logger.warning('No checkpoint found at {0}. Starting from the first window.'.format(checkpoint_filename))
+    incremental = incremental and checkpoint is not None
+    if incremental and not checkpoint.get('complete'):
+        raise ValueError('Checkpoint {0} is from an unfinished scan. Finish it with resume=True first.'.format(
+            checkpoint_filename))
+
+    # ----------Load data-------------------------------------------------------------------------------------------
+
+    if incremental:
+        # Only read the rows appended since the last scan and put the carried-over tail in front of them
+        new_eve_lines = read_eve_lines(eve_data_path, first_row=checkpoint['n_rows'])
+        if len(new_eve_lines) > 0 and new_eve_lines.index[0] <= checkpoint['last_time']:
+            raise ValueError('{0} changed before row {1} rather than being appended to; rerun the full scan.'.format(
+                eve_data_path, checkpoint['n_rows']))
+        eve_lines = pd.concat([checkpoint['tail'], new_eve_lines])
+        eve_lines = eve_lines.iloc[max(checkpoint['tail_start_row'] - checkpoint['n_rows'], 0):]
+        first_row = checkpoint['tail_start_row']  # The row of the full archive that eve_lines starts at
+        n_rows = checkpoint['n_rows'] + len(new_eve_lines)
+        if verbose:
+            logger.info('Loaded {0} new rows of EVE data appended after {1}.'.format(len(new_eve_lines),
+                                                                                      checkpoint['last_time']))
+    else:
+        eve_lines = read_eve_lines(eve_data_path)
+        first_row = 0
+        n_rows = len(eve_lines)
+    wholeDfLength = eve_lines.__len__()
+
+    # Line up the signature columns with the EVE columns so they can be scored as arrays
+    template_names, cme_template = load_cme_signatures(cme_signature, eve_lines.columns)
+    cmeEventLength = cme_template.shape[-2]
+    if template_names is not None and max_lag_minutes is not None:
+        raise ValueError('The lag-tolerant mode (max_lag_minutes) does not support a template bank directory.')
+    if dtw_band_minutes is not None and (template_names is not None or max_lag_minutes is not None):
+        raise ValueError('The dynamic time warping mode (dtw_band_minutes) does not support a template bank directory '
+                         'or max_lag_minutes.')
+
+    # Convert the lag range and warping band to rows of EVE data
+    max_lag_rows = None
+    dtw_band_rows = None
+    if incremental and len(eve_lines) < 2:
+        # Too few rows to measure the cadence (and no windows to score), so take the rows of the last scan
+        max_lag_rows = checkpoint['settings']['max_lag_rows']
+        dtw_band_rows = checkpoint['settings'].get('dtw_band_rows')  # Checkpoints from before DTW have no band
+    elif max_lag_minutes is not None or dtw_band_minutes is not None:
+        cadence_seconds = np.median(np.diff(eve_lines.index.values)) / np.timedelta64(1, 's')
+        if max_lag_minutes is not None:
+            max_lag_rows = int(round(max_lag_minutes * 60.0 / cadence_seconds))
+        if dtw_band_minutes is not None:
+            dtw_band_rows = int(round(dtw_band_minutes * 60.0 / cadence_seconds))
+
     if verbose:
         logger.info('Loaded EVE and CME data')
 
+    # Fit each line once over the whole data set rather than once per overlapping window
+    smooth_once = smooth_once and fit_light_curves
+    refit_candidates = refit_candidates and smooth_once
+    if candidate_threshold is None:
+        candidate_threshold = correlation_threshold
+    if prefilter and not (fit_light_curves and (refit_candidates or not smooth_once)):  # Only fits are worth skipping
+        raise ValueError('The prefilter only skips window fits, so it needs fit_light_curves, and refit_candidates '
+                         'with smooth_once.')
+    if smooth_once:
+        if incremental:
+            smoothed_eve_data_path = None  # Only the carried-over tail and the new rows are loaded
+        eve_lines_smoothed = smooth_light_curves(eve_lines, smoothed_eve_data_path=smoothed_eve_data_path,
+                                                 gamma_search=gamma_search, verbose=verbose, logger=logger)
+
+    # Score the lines that most often rule a window out first, so hopeless windows are abandoned after a few lines
+    line_order = None
+    if early_abandon:
+        if template_names is not None or max_lag_rows is not None or dtw_band_rows is not None:
+            raise ValueError('Early abandoning does not support max_lag_minutes, dtw_band_minutes, or a template bank.')
+        line_order = discriminating_line_order((eve_lines_smoothed if smooth_once else eve_lines).values,
+                                               cme_template, window_stride=window_stride)
+        if verbose:
+            logger.info('Early abandoning with line order: {0}.'.format(', '.join(eve_lines.columns[line_order])))
+
     # Define the columns of the output catalog
-    output_table = pd.DataFrame(columns=['Event #', 'Start Time', 'End Time', 'Correlation Coefficient'])
+    merge_overlapping_windows = merge_overlapping_windows or max_events is not None
+    output_columns = correlation_scan_output_columns(eve_lines.columns, lagged=max_lag_rows is not None,
+                                                     template_names=template_names)
     csv_filename = output_path + 'cc_output_{0}.csv'.format(Time.now().iso)
-    output_table.to_csv(csv_filename, header=True, index=False, mode='w')
 
     if verbose:
         logger.info('Created output table definition.')
 
-    # Start a progress bar
-    widgets = [progressbar.Percentage(), progressbar.Bar(), progressbar.Timer(), ' ', progressbar.AdaptiveETA()]
+    scan_settings = dict(window_stride=window_stride, correlation_threshold=correlation_threshold,
+                         fit_light_curves=fit_light_curves, gamma_search=gamma_search, max_lag_rows=max_lag_rows,
+                         dtw_band_rows=dtw_band_rows,
+                         template_names=template_names, line_order=line_order, output_path=output_path,
+                         verbose=verbose, return_lines_evaluated=True)
+    checkpoint_settings = dict(eve_data_path=eve_data_path, cme_signature=cme_signature, window_stride=window_stride,
+                               correlation_threshold=correlation_threshold, fit_light_curves=fit_light_curves,
+                               gamma_search=gamma_search,
+                               max_lag_rows=max_lag_rows, dtw_band_rows=dtw_band_rows, smooth_once=smooth_once,
+                               refit_candidates=refit_candidates,
+                               candidate_threshold=candidate_threshold,
+                               merge_overlapping_windows=merge_overlapping_windows, max_events=max_events)
+    if prefilter:
+        checkpoint_settings['prefilter_settings'] = prefilter_settings or {}
+    checkpoint_settings['cme_template_digest'] = cme_template_digest(cme_template, template_names)
+    if checkpoint is not None:
+        saved_settings = dict({'dtw_band_rows': None}, **checkpoint['settings'])  # Checkpoints from before DTW
+        if 'cme_template_digest' not in saved_settings:
+            if verbose:
+                logger.warning('Checkpoint {0} does not record the contents of the CME signature it was made with, so '
+                               'they cannot be checked.'.format(checkpoint_filename))
+            saved_settings['cme_template_digest'] = checkpoint_settings['cme_template_digest']
+        if saved_settings['cme_template_digest'] != checkpoint_settings['cme_template_digest']:
+            raise ValueError('Checkpoint {0} was made with a different CME signature than the one now in {1}. Scan '
+                             'from the start to score every window against the same signature.'.format(
+                                 checkpoint_filename, cme_signature))
+        if saved_settings != checkpoint_settings:
+            raise ValueError('Checkpoint {0} was made with different scan settings: {1}'.format(
+                checkpoint_filename, checkpoint['settings']))
+
+    # Shards must hold whole engine blocks so that scoring them separately matches one uninterrupted pass
+    if fit_light_curves and not smooth_once:
+        windows_per_block = 1
+    else:
+        windows_per_block = correlation_block_windows(window_stride, lagged=max_lag_rows is not None)
+
+    # Window starts are relative to eve_lines. An incremental scan starts at the first window that was not yet scored.
+    next_window = 0
+    detections = concatenate_detections([], output_columns[1:])
+    detection_events = DetectionEvents(max_events) if merge_overlapping_windows else None
+    if incremental:
+        detection_events = checkpoint['detection_events']
+        first_window_row = checkpoint['next_window_row'] - first_row
+        window_starts = np.arange(first_window_row, max(wholeDfLength - cmeEventLength + 1, first_window_row),
+                                  window_stride)
+        csv_filename = checkpoint['csv_filename']
+        if verbose:
+            logger.info('Incremental scan of {0} new windows.'.format(len(window_starts)))
+    else:
+        window_starts = sliding_window_starts(wholeDfLength, cmeEventLength, window_stride)
+        if checkpoint is not None:
+            next_window = checkpoint['next_window']
+            detections = checkpoint['detections']
+            detection_events = checkpoint['detection_events']
+            if verbose:
+                logger.info('Resuming from checkpoint {0}: {1} of {2} windows already scored, {3} detections.'.format(
+                    checkpoint_filename, next_window, len(window_starts),
+                    detection_events.n_windows if merge_overlapping_windows else len(detections)))
+
+    # Test every window cheaply on the raw data, so only those in which several lines dim are fitted
+    if prefilter:
+        prefilter_starts, passed, _ = dimming_prefilter(eve_lines.values, cmeEventLength, window_starts=window_starts,
+                                                        **(prefilter_settings or {}))
+        window_passed = np.zeros(wholeDfLength, dtype=bool)
+        window_passed[prefilter_starts[passed]] = True
+        if verbose:
+            logger.info('Dimming pre-filter passed {0} of {1} windows ({2:.1%}).'.format(
+                passed.sum(), len(passed), passed.mean() if len(passed) > 0 else 0))
+            if labeled_catalog_path is not None:
+                recall, n_events = prefilter_recall(eve_lines.index[prefilter_starts],
+                                                    eve_lines.index[prefilter_starts + cmeEventLength - 1], passed,
+                                                    labeled_event_times(labeled_catalog_path))
+                if n_events > 0:
+                    logger.info('Dimming pre-filter recall: {0:.1%} of the {1} labeled stealth CMEs in the scanned '
+                                'windows.'.format(recall, n_events))
+                else:
+                    logger.info('No labeled stealth CMEs fall in the scanned windows to measure the pre-filter recall.')
+
+    # ----------Score every window of the data set in shards, checkpointing as they complete---------------------------
+
+    shard_windows = scan_shard_windows(len(window_starts) - next_window, windows_per_block, checkpoint_interval,
+                                       n_processes)
+    shard_edges = [(shard_start, min(shard_start + shard_windows, len(window_starts)))
+                   for shard_start in range(next_window, len(window_starts), shard_windows)]
+    shard_settings = dict(scan_settings, refit_candidates=refit_candidates, candidate_threshold=candidate_threshold)
+
+    def scan_shards():
+        # Each shard carries only the rows its windows (and their lags) need, so shards are cheap to send to a worker
+        for shard_start, shard_end in shard_edges:
+            shard_window_starts = window_starts[shard_start:shard_end]
+            first_shard_row, last_shard_row = shard_rows(shard_window_starts, wholeDfLength, cmeEventLength,
+                                                         max_lag_rows)
+            passed_window_starts = None
+            if prefilter:
+                passed_window_starts = shard_window_starts[window_passed[shard_window_starts]] - first_shard_row
+            if not smooth_once and prefilter:
+                local_window_starts = passed_window_starts
+            else:
+                local_window_starts = shard_window_starts - first_shard_row
+            yield (eve_lines.iloc[first_shard_row:last_shard_row], cme_template, local_window_starts,
+                   dict(shard_settings,
+                        eve_lines_smoothed=eve_lines_smoothed.iloc[first_shard_row:last_shard_row]
+                        if smooth_once else None,
+                        refit_window_starts=passed_window_starts if smooth_once else None))
+
+    if n_processes > 1:
+        widgets = [progressbar.Percentage(), progressbar.Bar(), progressbar.Timer(), ' ', progressbar.AdaptiveETA()]
+        progress_bar_shards = progressbar.ProgressBar(
+            widgets=[progressbar.FormatLabel('Correlation Coefficient Shards ')] + widgets,
+            max_value=len(shard_edges)).start()
+
+    n_lines_evaluated = 0
+    checkpointed_window = next_window
+    shard_results = map_scan_shards(scan_shards(), n_processes, output_path=output_path, verbose=verbose, logger=logger)
+    for k, ((shard_start, shard_end), (shard_detections, shard_lines_evaluated)) in enumerate(zip(shard_edges,
+                                                                                                  shard_results)):
+        n_lines_evaluated += shard_lines_evaluated.sum()
+        if merge_overlapping_windows:
+            detection_events.add(shard_detections)  # Only the kept events and the still-open group stay in memory
+        else:
+            detections = concatenate_detections([detections, shard_detections], output_columns[1:])
+        if n_processes > 1:
+            progress_bar_shards.update(k)
+
+        # An incremental scan is short, and its previous (complete) checkpoint stays valid until it finishes
+        if not incremental and (shard_end - checkpointed_window >= checkpoint_interval or
+                                shard_end == len(window_starts)):
+            last_window_start = eve_lines.index[window_starts[shard_end - 1]]
+            write_scan_checkpoint(checkpoint_filename, {'settings': checkpoint_settings,
+                                                        'shard_windows': shard_windows,
+                                                        'next_window': shard_end,
+                                                        'last_completed_window_start': last_window_start,
+                                                        'detections': detections,
+                                                        'detection_events': detection_events})
+            checkpointed_window = shard_end
+            if verbose:
+                logger.info('Checkpoint saved after window {0} of {1}.'.format(shard_end, len(window_starts)))
+    if n_processes > 1:
+        progress_bar_shards.finish()
+
+    if verbose:
+        logger.info('Scored {0} windows with a stride of {1} rows; {2} crossed the threshold of {3}.'.format(
+            len(window_starts) - next_window, window_stride,
+            detection_events.n_windows if merge_overlapping_windows else len(detections), correlation_threshold))
+        if early_abandon and len(window_starts) > next_window:
+            logger.info('Early abandoning scored an average of {0:.2f} of {1} lines per window.'.format(
+                n_lines_evaluated / float(len(window_starts) - next_window), len(eve_lines.columns)))
+
+    # ---------Output Results-------------------------------------------------------------------------------------------
+
+    if incremental:
+        detections = concatenate_detections([checkpoint['detections'], detections], output_columns[1:])
+
+    # Save the high-water mark and the rows that the first windows of the next incremental scan will need. The
+    # checkpoint is written before the catalog, so a crash in between is made good by the next run (see below).
+    if len(window_starts) > 0:
+        next_window_row = first_row + window_starts[-1] + window_stride
+    elif incremental:
+        next_window_row = checkpoint['next_window_row']
+    else:
+        next_window_row = 0
+    tail_start_row = max(next_window_row - (max_lag_rows or 0), 0)
+    write_scan_checkpoint(checkpoint_filename, {'settings': checkpoint_settings,
+                                                'shard_windows': shard_windows,
+                                                'next_window': len(window_starts),
+                                                'detections': detections,
+                                                'detection_events': detection_events,
+                                                'complete': True,
+                                                'csv_filename': csv_filename,
+                                                'n_rows': n_rows,
+                                                'last_time': eve_lines.index[-1],
+                                                'next_window_row': next_window_row,
+                                                'tail_start_row': tail_start_row,
+                                                'tail': eve_lines.iloc[max(tail_start_row - first_row, 0):]})
+
+    if merge_overlapping_windows:
+        # New windows can extend the last event, so the (short) event catalog is always rewritten in full
+        output_table = detection_events.events()
+        output_table.insert(0, 'Event #', np.arange(1, len(output_table) + 1))
+        write_catalog_csv(csv_filename, output_table)
+        if verbose:
+            logger.info('Merged the windows into {0} events.'.format(len(output_table)))
+    else:
+        output_table = detections.reset_index(drop=True)
+        output_table.insert(0, 'Event #', np.arange(1, len(output_table) + 1))
+        output_table = output_table[output_columns]
+        if incremental:
+            # Only the rows the previous catalog lacks are appended, continuing its event numbers
+            update_catalog_csv(csv_filename, output_table)
+        else:
+            write_catalog_csv(csv_filename, output_table)
+
+    if verbose:
+        logger.info('Correlation scan catalog written to {0}.'.format(csv_filename))
+
+
+def write_catalog_csv(csv_filename, output_table):
+    """Write a scan catalog in full, replacing any previous one in one atomic step.
+
+    Inputs:
+        csv_filename [str]:          The path and filename of the catalog csv.
+        output_table [pd DataFrame]: The catalog.
+
+    Optional Inputs:
+        None
+
+    Outputs:
+        No direct return, but writes csv_filename to disk.
+
+    Optional Outputs:
+        None
+
+    Example:
+        write_catalog_csv(csv_filename, output_table)
+    """
+    temporary_filename = csv_filename + '.tmp'
+    with open(temporary_filename, 'w') as csv_file:
+        output_table.to_csv(csv_file, header=True, index=False)
+        csv_file.flush()
+        os.fsync(csv_file.fileno())
+    os.replace(temporary_filename, csv_filename)  # A crash mid-write leaves the previous catalog intact
+
+
+def update_catalog_csv(csv_filename, output_table):
+    """Bring a scan catalog that was appended to up to date with the full catalog, appending only the missing rows.
+
+    The catalog on disk is trusted up to as many rows as output_table holds. Rows past that (e.g., appended by a scan
+    that crashed before its checkpoint recorded them, and then rescanned) are cut off, as is a row cut short by a
+    crash, and the rows of output_table that the catalog lacks are appended.
+
+    Inputs:
+        csv_filename [str]:          The path and filename of the catalog csv.
+        output_table [pd DataFrame]: The full catalog, as recorded by the scan checkpoint.
+
+    Optional Inputs:
+        None
+
+    Outputs:
+        No direct return, but updates csv_filename on disk.
+
+    Optional Outputs:
+        None
+
+    Example:
+        update_catalog_csv(checkpoint['csv_filename'], output_table)
+    """
+    if not os.path.exists(csv_filename):
+        write_catalog_csv(csv_filename, output_table)
+        return
+
+    n_rows = 0
+    with open(csv_filename, 'r+b') as csv_file:
+        csv_file.readline()  # The header
+        end_of_rows = csv_file.tell()
+        while n_rows < len(output_table):
+            row = csv_file.readline()
+            if not row.endswith(b'\n'):
+                break
+            n_rows += 1
+            end_of_rows = csv_file.tell()
+        csv_file.truncate(end_of_rows)
+    with open(csv_filename, 'a') as csv_file:
+        output_table.iloc[n_rows:].to_csv(csv_file, header=False, index=False)
+        csv_file.flush()
+        os.fsync(csv_file.fileno())
+
+
+def write_scan_checkpoint(checkpoint_filename, checkpoint):
+    """Durably save the state of a correlation scan, replacing any previous checkpoint in one atomic step.
+
+    Inputs:
+        checkpoint_filename [str]: The path and filename of the checkpoint.
+        checkpoint [dict]:         The scan state: the scan settings, the shard size in windows, the index of the next
+                                   window to score, the start time of the last completed window, and the detections
+                                   (or their DetectionEvents when merging overlapping windows). A finished scan also records its output csv, high-water mark, and carried-over
+                                   tail rows for incremental scans.
+
+    Optional Inputs:
+        None
+
+    Outputs:
+        No direct return, but writes checkpoint_filename to disk.
+
+    Optional Outputs:
+        None
+
+    Example:
+        write_scan_checkpoint(output_path + 'cc_checkpoint.pkl', checkpoint)
+    """
+    temporary_filename = checkpoint_filename + '.tmp'
+    with open(temporary_filename, 'wb') as checkpoint_file:
+        pickle.dump(checkpoint, checkpoint_file, protocol=pickle.HIGHEST_PROTOCOL)
+        checkpoint_file.flush()
+        os.fsync(checkpoint_file.fileno())
+    os.replace(temporary_filename, checkpoint_filename)  # A crash mid-write leaves the previous checkpoint intact
+
+
+def read_scan_checkpoint(checkpoint_filename):
+    """Load the state of a correlation scan saved by write_scan_checkpoint.
+
+    Inputs:
+        checkpoint_filename [str]: The path and filename of the checkpoint.
+
+    Optional Inputs:
+        None
+
+    Outputs:
+        checkpoint [dict]: The scan state.
+
+    Optional Outputs:
+        None
+
+    Example:
+        checkpoint = read_scan_checkpoint(output_path + 'cc_checkpoint.pkl')
+    """
+    with open(checkpoint_filename, 'rb') as checkpoint_file:
+        return pickle.load(checkpoint_file)
+
+
+def load_cme_signatures(cme_signature, line_names):
+    """Load one CME signature, or a directory of them, as arrays with columns in the order of the EVE lines.
+
+    Inputs:
+        cme_signature [str]:   A csv file made by generate_cme_signature, or a directory of them.
+        line_names [pd.Index]: The EVE emission line column names.
+
+    Optional Inputs:
+        None
+
+    Outputs:
+        template_names [list]:   The file name (without extension) of each signature in a directory, sorted.
+                                 None for a single signature file.
+        cme_template [np.array]: A 2-D array (signature rows x lines) for a single file, or a 3-D array
+                                 (templates x signature rows x lines) for a directory.
+
+    Optional Outputs:
+        None
+
+    Example:
+        template_names, cme_template = load_cme_signatures('/Users/tyleralbee/Desktop/savesets/', eve_lines.columns)
+    """
+    if not os.path.isdir(cme_signature):
+        cme_event = pd.read_csv(cme_signature, index_col=0)
+        return None, cme_event[line_names].values
 
-    startRow = 0
-    endRow = cmeEventLength
-    numSlices = int(wholeDfLength/cmeEventLength)
-    output_row = 1
+    signature_filenames = sorted(filename for filename in os.listdir(cme_signature) if filename.endswith('.csv'))
+    if not signature_filenames:
+        raise ValueError('No csv CME signatures found in {0}.'.format(cme_signature))
 
-    progress_bar_sliding_window = progressbar.ProgressBar(widgets=[progressbar.FormatLabel('Correlation Coefficient Analysis ')] + widgets,
-                                                   max_value=numSlices).start()
+    template_names, templates = [], []
+    for filename in signature_filenames:
+        cme_event = pd.read_csv(os.path.join(cme_signature, filename), index_col=0)
+        template_names.append(os.path.splitext(filename)[0])
+        templates.append(cme_event[line_names].values)
+
+    template_lengths = set(len(template) for template in templates)
+    if len(template_lengths) > 1:
+        raise ValueError('CME signatures in {0} have different lengths: {1}'.format(cme_signature,
+                                                                                   sorted(template_lengths)))
+    return template_names, np.stack(templates)
+
+
+def cme_template_digest(cme_template, template_names=None):
+    """Get a digest of the contents of a CME signature or template bank, to tell whether it changed between scans.
+
+    Inputs:
+        cme_template [np.array]: The CME signature or template bank from load_cme_signatures.
+
+    Optional Inputs:
+        template_names [list]: The names of the templates of a template bank. Default is None.
+
+    Outputs:
+        digest [str]: The SHA-256 hex digest of the template names, shape, and values.
+
+    Optional Outputs:
+        None
+
+    Example:
+        digest = cme_template_digest(cme_template, template_names)
+    """
+    cme_template = np.ascontiguousarray(cme_template, dtype=np.float64)
+    template_hash = hashlib.sha256(repr((template_names, cme_template.shape)).encode())
+    template_hash.update(cme_template.tobytes())
+    return template_hash.hexdigest()
+
+
+def correlation_scan_output_columns(line_names, lagged=False, template_names=None):
+    """Get the columns of the correlation scan output catalog.
+
+    Inputs:
+        line_names [pd.Index]: The EVE emission line column names.
+
+    Optional Inputs:
+        lagged [bool]:          Set to include the per-line best correlation coefficient and lag of the lag-tolerant
+                                mode. Default is False.
+        template_names [list]:  Set to the template bank names to include the best template and the total correlation
+                                coefficient of every template. Default is None.
+
+    Outputs:
+        output_columns [list]: The output catalog column names.
+
+    Optional Outputs:
+        None
+
+    Example:
+        output_columns = correlation_scan_output_columns(eve_lines.columns, lagged=True)
+    """
+    output_columns = ['Event #', 'Start Time', 'End Time', 'Correlation Coefficient']
+    if lagged:
+        output_columns += list(line_names + ' Correlation Coefficient')
+        output_columns += list(line_names + ' Lag [min]')
+    if template_names is not None:
+        output_columns += ['Best Template']
+        output_columns += [template_name + ' Correlation Coefficient' for template_name in template_names]
+    return output_columns
+
+
+def score_windows(eve_lines, cme_template, window_starts, window_stride=60, correlation_threshold=4.2,
+                  fit_light_curves=True, gamma_search='grid', max_lag_rows=None, dtw_band_rows=None, template_names=None, line_order=None,
+                  output_path='', verbose=False, logger=None, show_progress=True, return_lines_evaluated=False):
+    """Score sliding windows of EVE data against a CME signature and keep those that cross the threshold.
+
+    Inputs:
+        eve_lines [pd DataFrame]:  EVE extracted emission lines with a DatetimeIndex, or any contiguous slice of them
+                                   that holds every row the windows (and their lags) need.
+        cme_template [np.array]:   The CME signature as a 2-D array (signature rows x lines) in eve_lines column order,
+                                   or a template bank as a 3-D array (templates x signature rows x lines).
+        window_starts [np.array]:  The first row (relative to eve_lines) of each window to score. Must be increasing
+                                   and spaced by window_stride.
+
+    Optional Inputs:
+        window_stride [int]:           The spacing of window_starts in rows. Default is 60.
+        correlation_threshold [float]: The minimum total correlation coefficient to keep a window. Default is 4.2.
+        fit_light_curves [bool]:       Set to fit each window with automatic_fit_light_curve before scoring it.
+                                       Default is True.
+        gamma_search [str]:            The gamma_search of automatic_fit_light_curve. With 'halving', each fit is
+                                       warm started from the best gamma of the last accepted fit of the same line.
+                                       Default is 'grid'.
+        max_lag_rows [int]:            Set to score each line at its best lag within +/- this many rows.
+                                       Default is None, meaning fixed alignment.
+        dtw_band_rows [int]:           Set to score each line with dynamic time warping within a Sakoe-Chiba band of
+                                       this many rows. Default is None, meaning Pearson correlation.
+        template_names [list]:         The names of the templates when cme_template is a template bank. A window is
+                                       kept when its best template crosses the threshold. Default is None.
+        line_order [np.array]:         Set to score the lines of each window in this order (e.g., from
+                                       discriminating_line_order) and abandon the window as soon as its total can no
+                                       longer reach correlation_threshold. A fitted window is abandoned before its
+                                       remaining lines are fitted. Not supported with lags, DTW, or a template bank.
+                                       Default is None, meaning every line of every window is scored.
+        output_path [str]:             Where fitting plots are saved. Default is ''.
+        verbose [bool]:                Set to log the processing messages to disk and console. Default is False.
+        logger [JpmLogger]:            A configured logger from jpm_logger.py. Default is None.
+        show_progress [bool]:          Set to display a progress bar. Default is True.
+        return_lines_evaluated [bool]: Set to also return the number of lines scored for each window.
+                                       Default is False.
+
+    Outputs:
+        detections [pd DataFrame]: One row per window that crossed the threshold, in time order, with the columns of
+                                   correlation_scan_output_columns() except 'Event #'.
+
+    Optional Outputs:
+        lines_evaluated [np.array]: The number of lines scored for each window, if return_lines_evaluated is set.
+
+    Example:
+        detections = score_windows(eve_lines, cme_event[eve_lines.columns].values,
+                                   sliding_window_starts(len(eve_lines), len(cme_event)), fit_light_curves=False)
+    """
+    wholeDfLength = eve_lines.__len__()
+    cmeEventLength = cme_template.shape[-2]
+    template_bank = template_names is not None
+    output_columns = correlation_scan_output_columns(eve_lines.columns, lagged=max_lag_rows is not None,
+                                                     template_names=template_names)[1:]
+    detection_rows = []
+    if line_order is not None and (template_bank or max_lag_rows is not None or dtw_band_rows is not None):
+        raise ValueError('Early abandoning (line_order) does not support lags, DTW, or a template bank.')
+    lines_evaluated = np.full(len(window_starts), len(eve_lines.columns))
+    line_gamma_priors = {}  # The best gamma of the last accepted fit of each line, to warm start the next
+
+    # Without fitting, every window is independent of the others so score them all in one vectorized pass
+    if not fit_light_curves and len(window_starts) > 0:
+        if template_bank:
+            window_starts, bank_correlation_coefficients = template_bank_correlation(
+                eve_lines.values, cme_template, window_stride=window_stride, window_starts=window_starts)
+            template_correlation_coefficients = bank_correlation_coefficients.sum(axis=2)  # windows x templates
+        elif dtw_band_rows is not None:
+            window_starts, correlation_coefficients, pruned_windows = dtw_sliding_window_correlation(
+                eve_lines.values, cme_template, dtw_band_rows, correlation_threshold, window_stride=window_stride,
+                window_starts=window_starts)
+            total_correlation_coefficients = correlation_coefficients.sum(axis=1)
+            if verbose:
+                logger.info('DTW scored {0} windows: {1}.'.format(len(window_starts), ', '.join(
+                    '{0} {1}'.format(count, stage) for stage, count in pruned_windows.items())))
+        elif line_order is not None:
+            window_starts, correlation_coefficients, lines_evaluated = early_abandon_correlation(
+                eve_lines.values, cme_template, correlation_threshold, line_order=line_order,
+                window_stride=window_stride, window_starts=window_starts)
+            total_correlation_coefficients = correlation_coefficients.sum(axis=1)
+        elif max_lag_rows is None:
+            window_starts, correlation_coefficients = sliding_window_correlation(
+                eve_lines.values, cme_template, window_stride=window_stride, window_starts=window_starts)
+            total_correlation_coefficients = correlation_coefficients.sum(axis=1)
+        else:
+            window_starts, correlation_coefficients, lags = lagged_sliding_window_correlation(
+                eve_lines.values, cme_template, max_lag_rows, window_stride=window_stride, window_starts=window_starts)
+            total_correlation_coefficients = correlation_coefficients.sum(axis=1)
+
+    # Start a progress bar
+    widgets = [progressbar.Percentage(), progressbar.Bar(), progressbar.Timer(), ' ', progressbar.AdaptiveETA()]
+    if show_progress:
+        progress_bar_sliding_window = progressbar.ProgressBar(widgets=[progressbar.FormatLabel('Correlation Coefficient Analysis ')] + widgets,
+                                                       max_value=len(window_starts)).start()
 
     # ----------Loop through data set using a sliding time window-------------------------------------------------------
 
-    for i in range(1, numSlices):
+    for i, startRow in enumerate(window_starts):
+        endRow = startRow + cmeEventLength
 
         # ----------Clip dataset to time slice window-------------------------------------------------------------------
 
         event_time_slice = eve_lines.iloc[startRow:endRow]
 
-        # ---------Convert irradiance values to percentages-------------------------------------------------------------
+        if fit_light_curves:
 
-        preflare_irradiance = event_time_slice.iloc[0]
-        event_time_slice_percentages = (event_time_slice - preflare_irradiance) / preflare_irradiance * 100.0
+            # In lag-tolerant mode, fit enough rows on either side of the window to cover every lag
+            if max_lag_rows is not None:
+                paddedStartRow = max(startRow - max_lag_rows, 0)
+                event_time_slice = eve_lines.iloc[paddedStartRow:min(endRow + max_lag_rows, wholeDfLength)]
 
-        if verbose:
-            logger.info("Event {0} irradiance converted from absolute to percent units.".format(i))
+            # ---------Convert irradiance values to percentages---------------------------------------------------------
 
-        # ---------Fit light curves to reduce noise---------------------------------------------------------------------
+            preflare_irradiance = event_time_slice.iloc[0]
+            event_time_slice_percentages = (event_time_slice - preflare_irradiance) / preflare_irradiance * 100.0
 
-        uncertainty = np.ones(len(event_time_slice_percentages)) * 0.002545  # got this line from James's code
+            if verbose:
+                logger.info("Event {0} irradiance converted from absolute to percent units.".format(i))
 
-        progress_bar_fitting = progressbar.ProgressBar(
-            widgets=[progressbar.FormatLabel('Light curve fitting: ')] + widgets,
-            max_value=len(event_time_slice_percentages.columns)).start()
+            # ---------Fit light curves to reduce noise-----------------------------------------------------------------
 
-        for j, column in enumerate(event_time_slice_percentages):
-            if event_time_slice_percentages[column].isnull().all().all():
-                if verbose:
-                    logger.info(
-                        'Event {0} {1} fitting skipped because all irradiances are NaN.'.format(j, column))
-            else:
-                eve_line_event_percentages = pd.DataFrame(event_time_slice_percentages[column])
-                eve_line_event_percentages.columns = ['irradiance']
-                eve_line_event_percentages['uncertainty'] = uncertainty
-
-                fitting_path = output_path + 'Fitting/'
-                if not os.path.exists(fitting_path):
-                    os.makedirs(fitting_path)
+            fitting_path = output_path + 'Fitting/'
+            if not os.path.exists(fitting_path):
+                os.makedirs(fitting_path)
 
+            abandoned = False
+            if line_order is None:
+                # Every line is needed, so they are all fitted together on one worker pool
                 plt.close('all')
-                light_curve_fit, best_fit_gamma, best_fit_score = automatic_fit_light_curve(
-                                                                    eve_line_event_percentages,
-                                                                    plots_save_path='{0} Event {1} {2} '.format(
-                                                                        fitting_path, j, column), verbose=verbose,
-                                                                    logger=logger)
-                event_time_slice_percentages[column] = light_curve_fit
-                event_time_slice_fitted = event_time_slice_percentages  # Keep our variable names explicit
-
-                if verbose:
-                    logger.info('Event {0} {1} light curves fitted.'.format(j, column))
-                progress_bar_fitting.update(j)
+                event_time_slice_percentages, best_fit_gammas, _ = automatic_fit_light_curves(
+                    event_time_slice_percentages, uncertainty=0.002545,  # got this uncertainty from James's code
+                    plots_save_path='{0} Event {1} '.format(fitting_path, i), gamma_search=gamma_search,
+                    gamma_priors=line_gamma_priors if gamma_search == 'halving' else None,
+                    verbose=verbose, logger=logger)
+                line_gamma_priors.update(best_fit_gammas[event_time_slice_percentages.notnull().any()].to_dict())
+            else:
+                uncertainty = np.ones(len(event_time_slice_percentages)) * 0.002545  # got this line from James's code
 
-        progress_bar_fitting.finish()
+                if show_progress:
+                    progress_bar_fitting = progressbar.ProgressBar(
+                        widgets=[progressbar.FormatLabel('Light curve fitting: ')] + widgets,
+                        max_value=len(event_time_slice_percentages.columns)).start()
 
-        if verbose:
-            logger.info("Event {0} Light curves fitted".format(i))
+                # With early abandoning, lines are fitted in line_order and each is scored as soon as it is fitted
+                partial_total = 0.0
+                for k, j in enumerate(line_order):
+                    column = event_time_slice_percentages.columns[j]
+                    if event_time_slice_percentages[column].isnull().all().all():
+                        if verbose:
+                            logger.info(
+                                'Event {0} {1} fitting skipped because all irradiances are NaN.'.format(i, column))
+                    else:
+                        eve_line_event_percentages = pd.DataFrame(event_time_slice_percentages[column])
+                        eve_line_event_percentages.columns = ['irradiance']
+                        eve_line_event_percentages['uncertainty'] = uncertainty
 
-        # ---------Compute Correlation Coefficients---------------------------------------------------------------------
+                        plt.close('all')
+                        light_curve_fit, best_fit_gamma, best_fit_score = automatic_fit_light_curve(
+                                                                            eve_line_event_percentages,
+                                                                            plots_save_path='{0} Event {1} {2} '.format(
+                                                                                fitting_path, i, column),
+                                                                            gamma_search=gamma_search,
+                                                                            gamma_prior=line_gamma_priors.get(column)
+                                                                            if gamma_search == 'halving' else None,
+                                                                            verbose=verbose, logger=logger)
+                        if isinstance(light_curve_fit, pd.DataFrame):
+                            event_time_slice_percentages[column] = light_curve_fit['irradiance']
+                            line_gamma_priors[column] = best_fit_gamma
+                        else:
+                            event_time_slice_percentages[column] = light_curve_fit  # np.nan for a rejected fit
 
-        totalCorrelationCoefficient = 0.0
-        ds1 = event_time_slice_fitted
-        ds2 = cme_event
+                        if verbose:
+                            logger.info('Event {0} {1} light curves fitted.'.format(i, column))
+                        if show_progress:
+                            progress_bar_fitting.update(k)
 
-        # Gather stats for correlation
-        for k, column in enumerate(ds1):
-            dsColumn1 = ds1[column]
-            dsColumn2 = ds2[column]
+                    _, line_correlation_coefficient = sliding_window_correlation(
+                        event_time_slice_percentages.iloc[:, [j]].values, cme_template[:, [j]], window_stride=1)
+                    partial_total += line_correlation_coefficient[0, 0]
+                    lines_evaluated[i] = k + 1
+                    if not partial_total + (len(line_order) - k - 1) >= correlation_threshold:  # True for NaN too
+                        abandoned = True
+                        if verbose:
+                            logger.info('Event {0} abandoned after {1} lines.'.format(i, k + 1))
+                        break
 
-            dsColumn1.reset_index(drop=True, inplace=True) # prevent NaNs from appearing in join
-            dsColumn2.reset_index(drop=True, inplace=True) # prevent NaNs from appearing in join
+                if show_progress:
+                    progress_bar_fitting.finish()
+            event_time_slice_fitted = event_time_slice_percentages  # Keep our variable names explicit
 
-            # TODO: assert that both columns have same count?
-            n = int(dsColumn1.count())
-            meanA = float(dsColumn1.mean())
-            meanB = float(dsColumn2.mean())
-            stdA = float(dsColumn1.std(ddof=0))
-            stdB = float(dsColumn2.std(ddof=0))
+            if verbose:
+                logger.info("Event {0} Light curves fitted".format(i))
 
-            # Generate correlation output
-            dsJoined = pd.DataFrame({'a': dsColumn1, 'b': dsColumn2})  # Avoids ambiguity when attr names are the same
-            numerator = 0.0  # Stores summation of (a_i - meanA)(b_i - meanB)
-            denominator = n * stdA * stdB
+            # ---------Compute Correlation Coefficients-----------------------------------------------------------------
 
-            for index, row in dsJoined.iterrows():
-                a = row['a']
-                b = row['b']
-                numerator = numerator + (a - meanA) * (b - meanB)
+            # A single window scored with the same engine the unfitted scan uses for all windows at once
+            if abandoned:
+                totalCorrelationCoefficient = np.nan  # It can no longer reach the threshold
+            elif template_bank:
+                _, bank_correlation_coefficients_window = template_bank_correlation(event_time_slice_fitted.values,
+                                                                                    cme_template, window_stride=1)
+                window_template_correlation_coefficients = bank_correlation_coefficients_window[0].sum(axis=1)
+            elif dtw_band_rows is not None:
+                _, correlation_coefficients_window, _ = dtw_sliding_window_correlation(
+                    event_time_slice_fitted.values, cme_template, dtw_band_rows, correlation_threshold, window_stride=1)
+                line_correlation_coefficients = correlation_coefficients_window[0]
+            elif max_lag_rows is None:
+                _, correlation_coefficients_window = sliding_window_correlation(event_time_slice_fitted.values,
+                                                                                cme_template, window_stride=1)
+                line_correlation_coefficients = correlation_coefficients_window[0]
+            else:
+                _, correlation_coefficients_window, lags_window = lagged_sliding_window_correlation(
+                    event_time_slice_fitted.values, cme_template, max_lag_rows, window_stride=1)
+                line_correlation_coefficients = correlation_coefficients_window[startRow - paddedStartRow]
+                line_lags = lags_window[startRow - paddedStartRow]
+                event_time_slice = eve_lines.iloc[startRow:endRow]  # Back to the unpadded window for the output
+            if not template_bank and not abandoned:
+                totalCorrelationCoefficient = line_correlation_coefficients.sum()
+        elif template_bank:
+            window_template_correlation_coefficients = template_correlation_coefficients[i]
+        else:
+            line_correlation_coefficients = correlation_coefficients[i]
+            if max_lag_rows is not None:
+                line_lags = lags[i]
+            totalCorrelationCoefficient = total_correlation_coefficients[i]
 
-            correlationCoefficient = numerator / denominator
-            totalCorrelationCoefficient = totalCorrelationCoefficient + correlationCoefficient
+        # The window's score against a template bank is that of its best matching template
+        if template_bank:
+            if np.isnan(window_template_correlation_coefficients).all():
+                totalCorrelationCoefficient = np.nan
+            else:
+                best_template_index = np.nanargmax(window_template_correlation_coefficients)
+                totalCorrelationCoefficient = window_template_correlation_coefficients[best_template_index]
 
-        # ---------Output Results---------------------------------------------------------------------------------------
+        # ---------Keep windows that cross the threshold----------------------------------------------------------------
 
         eventStartTime = event_time_slice.iloc[0].name
         eventEndTime = event_time_slice.iloc[-1].name
 
-        if not math.isnan(totalCorrelationCoefficient) and totalCorrelationCoefficient >= 4.2:
-            output_table.loc[output_row] = [output_row, eventStartTime, eventEndTime, totalCorrelationCoefficient]
-            csv_filename = output_path + 'cc_output_{0}.csv'.format(Time.now().iso)
-            output_table.to_csv(csv_filename, header=True, index=False, mode='w')
-            output_row = output_row + 1
+        if not math.isnan(totalCorrelationCoefficient) and totalCorrelationCoefficient >= correlation_threshold:
+            output_values = [eventStartTime, eventEndTime, totalCorrelationCoefficient]
+            if max_lag_rows is not None:
+                # Report lags as the time between the window start and the start of the best lagged match
+                lag_times = eve_lines.index[startRow + line_lags]
+                output_values += list(line_correlation_coefficients)
+                output_values += list((lag_times - eventStartTime).total_seconds() / 60.0)
+            if template_bank:
+                output_values += [template_names[best_template_index]]
+                output_values += list(window_template_correlation_coefficients)
+            detection_rows.append(output_values)
+
+        if show_progress:
+            progress_bar_sliding_window.update(i)  # advance progress bar
+
+    if show_progress:
+        progress_bar_sliding_window.finish()
+
+    if return_lines_evaluated:
+        return pd.DataFrame(detection_rows, columns=output_columns), lines_evaluated
+    return pd.DataFrame(detection_rows, columns=output_columns)
+
+
+def score_scan_shard(eve_lines, cme_template, window_starts, eve_lines_smoothed=None, refit_candidates=False,
+                     candidate_threshold=None, refit_window_starts=None, logger=None, **scan_settings):
+    """Score one shard of a correlation scan: its windows, or the windows of its smoothed data and then any candidates.
+
+    Inputs:
+        eve_lines [pd DataFrame]: EVE extracted emission lines with a DatetimeIndex, or the slice of them the shard's
+                                  windows (and their lags) need.
+        cme_template [np.array]:  The CME signature or template bank, as passed to score_windows.
+        window_starts [np.array]: The first row (relative to eve_lines) of each window to score.
+
+    Optional Inputs:
+        eve_lines_smoothed [pd DataFrame]: Set to the same rows of smooth_light_curves data to score the windows of
+                                           that with the vectorized engine instead of fitting each window.
+                                           Default is None.
+        refit_candidates [bool]:           Set together with eve_lines_smoothed to refit and rescore, from eve_lines,
+                                           the windows of the smoothed data that cross candidate_threshold.
+                                           Default is False.
+        candidate_threshold [float]:       The total correlation coefficient of the smoothed data that makes a window a
+                                           candidate. Default is None, meaning correlation_threshold.
+        refit_window_starts [np.array]:    Set to the only window starts that may be refit (e.g., those that passed
+                                           dimming_prefilter). Default is None, meaning every candidate.
+        logger [JpmLogger]:                A configured logger from jpm_logger.py. Default is None.
+        scan_settings [dict]:              Any other keyword arguments of score_windows.
+
+    Outputs:
+        detections [pd DataFrame]:  The same table score_windows returns.
+        lines_evaluated [np.array]: The number of lines scored for each window.
+
+    Optional Outputs:
+        None
+
+    Example:
+        detections, lines_evaluated = score_scan_shard(eve_lines, cme_template, window_starts,
+                                                       eve_lines_smoothed=eve_lines_smoothed, refit_candidates=True)
+    """
+    scan_settings = dict(scan_settings, return_lines_evaluated=True)
+    if eve_lines_smoothed is None:
+        return score_windows(eve_lines, cme_template, window_starts, logger=logger, **scan_settings)
+
+    if candidate_threshold is None:
+        candidate_threshold = scan_settings.get('correlation_threshold', 4.2)
+    detections, lines_evaluated = score_windows(eve_lines_smoothed, cme_template, window_starts, logger=logger,
+                                                **dict(scan_settings, fit_light_curves=False,
+                                                       correlation_threshold=candidate_threshold))
+    if refit_candidates and len(detections) > 0:
+        candidate_starts = eve_lines.index.get_indexer(detections['Start Time'])
+        if refit_window_starts is not None:
+            candidate_starts = candidate_starts[np.isin(candidate_starts, refit_window_starts)]
+        if scan_settings.get('verbose', False):
+            logger.info('Refitting {0} candidate windows.'.format(len(candidate_starts)))
+        detections, _ = score_windows(eve_lines, cme_template, candidate_starts, logger=logger, **scan_settings)
+    return detections, lines_evaluated
+
+
+def scan_shard_windows(n_windows, windows_per_block, checkpoint_interval, n_processes, shards_per_process=4):
+    """Get the number of windows in each shard of a scan: enough shards to keep every process busy, and none longer
+    than a checkpoint interval, in whole correlation engine blocks.
+
+    Inputs:
+        n_windows [int]:           The number of windows to score.
+        windows_per_block [int]:   The windows in one block of the correlation engine (1 when fitting each window).
+        checkpoint_interval [int]: The most windows a shard may hold before rounding up to whole blocks.
+        n_processes [int]:         The number of worker processes.
+
+    Optional Inputs:
+        shards_per_process [int]: The least number of shards per worker process. More shards balance the load better
+                                  when some windows take longer to fit than others. Default is 4.
+
+    Outputs:
+        shard_windows [int]: The number of windows in each shard, a multiple of windows_per_block.
+
+    Optional Outputs:
+        None
+
+    Example:
+        shard_windows = scan_shard_windows(len(window_starts), 1, checkpoint_interval=100, n_processes=8)
+    """
+    shard_windows = max(checkpoint_interval, 1)
+    if n_processes > 1:
+        shard_windows = min(shard_windows, int(math.ceil(n_windows / float(n_processes * shards_per_process))))
+    return max(int(math.ceil(shard_windows / float(windows_per_block))), 1) * windows_per_block
+
+
+def shard_rows(window_starts, n_rows, window_rows, max_lag_rows=None):
+    """Get the rows of EVE data a shard of windows needs: from its first window (less any lag range) to the end of its
+    last window (plus any lag range).
+
+    Inputs:
+        window_starts [np.array]: The first row of each window in the shard, increasing.
+        n_rows [int]:             The number of rows of EVE data.
+        window_rows [int]:        The number of rows in each window, i.e., the length of the CME signature.
+
+    Optional Inputs:
+        max_lag_rows [int]: The lag range of the lag-tolerant mode. Default is None.
+
+    Outputs:
+        first_row [int]: The first row the shard needs.
+        last_row [int]:  One past the last row the shard needs.
+
+    Optional Outputs:
+        None
+
+    Example:
+        first_row, last_row = shard_rows(shard_window_starts, len(eve_lines), len(cme_event))
+    """
+    lag_rows = max_lag_rows or 0
+    if len(window_starts) == 0:
+        return 0, 0
+    return max(window_starts[0] - lag_rows, 0), min(window_starts[-1] + window_rows + lag_rows, n_rows)
+
+
+# Each worker process gets its own logger, created once by the pool initializer
+_shard_logger = None
+
+
+def _init_shard_worker(output_path, verbose, worker_budget):
+    global _shard_logger
+    configure_concurrency(worker_budget, limit_blas=True)  # Each shard only uses its share of the cores
+    if verbose:
+        _shard_logger = JpmLogger(filename='do_correlation_coefficient_scan_pid{0}'.format(os.getpid()),
+                                  path=output_path, console=False)
+
+
+def _score_shard(shard):
+    eve_lines_shard, cme_template, local_window_starts, shard_settings = shard
+    return score_scan_shard(eve_lines_shard, cme_template, local_window_starts, logger=_shard_logger,
+                            show_progress=False, **shard_settings)
+
+
+def map_scan_shards(shards, n_processes, shards_per_process=4, output_path='', verbose=False, logger=None):
+    """Score shards with score_scan_shard, in one process pool when more than one process is asked for, and yield
+    their results in shard (i.e., time) order.
+
+    The pool is created once for all of the shards, and a few shards per process are submitted ahead of the one being
+    waited on, so every process stays busy while shards waiting to be scored do not pile up in memory.
+
+    Inputs:
+        shards [iterable]: (eve_lines, cme_template, window_starts, settings) tuples of the arguments of
+                           score_scan_shard, with settings holding its keyword arguments. May be a generator.
+        n_processes [int]: The number of worker processes. 1 scores the shards in this process.
+
+    Optional Inputs:
+        shards_per_process [int]: The number of shards per process to submit ahead. Default is 4.
+        output_path [str]:        Where the per-process logs are saved. Default is ''.
+        verbose [bool]:           Set to log the processing messages of each worker to disk. Default is False.
+        logger [JpmLogger]:       A configured logger from jpm_logger.py, used when scoring in this process.
+                                  Default is None.
+
+    Outputs:
+        A generator of the (detections, lines_evaluated) of each shard.
+
+    Optional Outputs:
+        None
+
+    Example:
+        for detections, lines_evaluated in map_scan_shards(shards, n_processes=8):
+            ...
+    """
+    if n_processes <= 1:
+        for eve_lines_shard, cme_template, local_window_starts, shard_settings in shards:
+            yield score_scan_shard(eve_lines_shard, cme_template, local_window_starts, logger=logger,
+                                   **shard_settings)
+        return
+
+    # Each worker's fits get its share of the cores, however the caller configured the budget
+    budget = get_concurrency_budget()
+    worker_budget = ConcurrencyBudget(total_threads=budget.total_threads, outer_processes=n_processes,
+                                      blas_threads=budget.blas_threads).worker_budget()
+    with ProcessPoolExecutor(max_workers=n_processes, initializer=_init_shard_worker,
+                             initargs=(output_path, verbose, worker_budget)) as pool:
+        submitted = deque()
+        for shard in shards:
+            submitted.append(pool.submit(_score_shard, shard))
+            if len(submitted) >= n_processes * shards_per_process:
+                yield submitted.popleft().result()
+        while submitted:
+            yield submitted.popleft().result()
+
+
+def concatenate_detections(detections_list, columns):
+    """Join tables of detections from consecutive pieces of a scan into one table, keeping their order.
+
+    Inputs:
+        detections_list [list]: pd DataFrames returned by score_windows, in time order.
+        columns [list]:         The detection columns, used when there are no detections at all.
+
+    Optional Inputs:
+        None
+
+    Outputs:
+        detections [pd DataFrame]: All detections in one table.
 
-        startRow = startRow + 60  # advance time window by 1 hour
-        endRow = endRow + 60      # advance time window by 1 hour
-        progress_bar_sliding_window.update(i)  # advance progress bar
+    Optional Outputs:
+        None
 
+    Example:
+        detections = concatenate_detections([detections_1, detections_2], list(detections_1.columns))
+    """
+    detections_list = [detections for detections in detections_list if len(detections) > 0]
+    if not detections_list:
+        return pd.DataFrame(columns=columns)
+    return pd.concat(detections_list, ignore_index=True)
 
 
 if __name__ == "__main__":
@@ -26,6 +26,7 @@ import sys
 # Custom modules
 from jpm_time_conversions import metatimes_to_seconds_since_start, datetimeindex_to_human
 from jpm_logger import JpmLogger
+from catalog_writer import CatalogWriter
 
 __author__ = 'Tyler J Albee & Shawn A Polson'
 __contact__ = 'tyal7988@colorado.edu'
@@ -40,8 +41,9 @@ def detectStealthCMEsInSOHO(output_path='/Users/shawnpolson/Pictures/stealth_cme
     sLength = len(soho['Time'])  # number of rows in the SOHO catalog
     soho['Stealth?'] = pd.Series(np.nan, index=soho.index)  # add the new column to the catalog
 
+    # Rows are appended to one catalog in batches, which is renamed into place once every row is labeled
     csv_filename = output_path + 'stealth_soho_catalog_best_window_cont_{0}.csv'.format(Time.now().iso)
-    soho.to_csv(csv_filename, header=True, index=False, mode='w')
+    catalog_writer = CatalogWriter(csv_filename, soho.columns)
 
     # Start a progress bar
     widgets = [progressbar.Percentage(), progressbar.Bar(), progressbar.Timer(), ' ', progressbar.AdaptiveETA()]
@@ -77,12 +79,10 @@ def detectStealthCMEsInSOHO(output_path='/Users/shawnpolson/Pictures/stealth_cme
             soho_row['Stealth?'] = 'no'
             soho.iloc[i] = soho_row
 
-        csv_filename = output_path + 'stealth_soho_catalog_best_window_cont_{0}.csv'.format(Time.now().iso)
-        soho.to_csv(csv_filename, header=True, index=False, mode='w')
+        catalog_writer.add(soho_row, progress=i + 1)
         progress_bar_sliding_window.update(i)  # advance progress bar
 
-    csv_filename = output_path + 'stealth_soho_catalog_best_window_cont_{0}.csv'.format(Time.now().iso)
-    soho.to_csv(csv_filename, header=True, index=False, mode='w')
+    catalog_writer.close()
     print("Done!")
 
 
@@ -1,7 +1,5 @@
 # Standard modules
 import os
-import itertools
-from collections import OrderedDict
 import numpy as np
 import matplotlib as mpl
 mpl.use('TkAgg') #used to be mpl.use('macosx')
@@ -21,7 +19,11 @@ from jpm_number_printing import latex_float
 # from get_goes_flare_events import get_goes_flare_events  # TODO: Uncomment once sunpy method implemented
 from determine_preflare_irradiance import determine_preflare_irradiance
 from light_curve_peak_match_subtract import light_curve_peak_match_subtract
-from automatic_fit_light_curve import automatic_fit_light_curve
+from automatic_fit_light_curve import automatic_fit_light_curves
+from light_curve_fit_cache import LightCurveFitCache
+from concurrency_budget import configure_concurrency
+from eve_archive import open_eve_lines, read_eve_window
+from jedi_catalog import JediCatalogWriter, JediRecord, jedi_catalog_schema
 from determine_dimming_depth import determine_dimming_depth
 from determine_dimming_slope import determine_dimming_slope
 from determine_dimming_duration import determine_dimming_duration
@@ -34,6 +36,9 @@ def generate_cme_signature(start_timestamp='2010-08-07 17:12:11',
                           end_timestamp='2010-08-07 21:18:11',
                           output_path='/Users/tyleralbee/Desktop/StealthCME'
 ,
+                          eve_data_path='/Users/tyleralbee/Desktop/StealthCME/eve_selected_lines.csv',
+                          fit_cache_path=None,
+                          max_threads=None,
                           verbose=True):
     """Wrapper code for generating the dimming depth, duration, and slope for one CME event.
 
@@ -46,10 +51,18 @@ def generate_cme_signature(start_timestamp='2010-08-07 17:12:11',
         flare_index_range [range]                               The range of GOES flare indices to process. Default is range(0, 5052).
         output_path [str]:                                      Set to a path for saving the JEDI catalog table and processing
                                                                 summary plots. Default is '/Users/shawnpolson/Documents/School/Spring 2018/Data Mining/StealthCMEs/PyCharm/JEDI Catalog/'.
+        eve_data_path [str]:                                    The preprocessed SDO EVE extracted emission lines data (eve_selected_lines.csv),
+                                                                or the EVE archive converted from it (see eve_archive.py).
+        fit_cache_path [str]:                                   Set to a directory to keep the light curve fits in, so a rerun
+                                                                with the same data reuses them instead of refitting. Default is None.
+        max_threads [int]:                                      The most threads the fits may use at once, shared between the fitting workers
+                                                                and their BLAS libraries (see concurrency_budget.py). Default is None, meaning
+                                                                the STEALTH_CME_MAX_THREADS environment variable or else all available cores.
         verbose [bool]:                                         Set to log the processing messages to disk and console. Default is False.
 
     Outputs:
-        No direct return, but writes a (csv? sql table? hdf5?) to disk with the dimming paramerization results.
+        No direct return, but writes a typed columnar JEDI catalog (see jedi_catalog.py) to disk with the dimming
+        paramerization results. Read it back, a parameter at a time if desired, with read_jedi_catalog.
         Subroutines also optionally save processing plots to disk in output_path.
 
     Optional Outputs:
@@ -66,64 +79,28 @@ def generate_cme_signature(start_timestamp='2010-08-07 17:12:11',
     else:
         logger = None
 
+    # Share the cores between the fitting workers and their BLAS threads so they are not oversubscribed
+    concurrency_budget = configure_concurrency(total_threads=max_threads)
+    if verbose:
+        logger.info('Running with {0}.'.format(concurrency_budget))
+
 #---------Load dataset of selected lines--------------------------------------------------------------------------------
 
     # Get EVE level 2 extracted emission lines data
     # Load up the actual irradiance data into a pandas DataFrame
     # Declare that column 0 is the index then convert it to datetime
-    eve_lines = pd.read_csv('/Users/tyleralbee/Desktop/StealthCME/eve_selected_lines.csv', index_col=0)
-    eve_lines.index = pd.to_datetime(eve_lines.index)
+    # An EVE archive is only opened here; the event's window is read from it on its own
+    eve_lines = open_eve_lines(eve_data_path)
 
     if verbose:
         logger.info('Loaded EVE data')
 
-    # Define the columns of the JEDI catalog
-    jedi_row = pd.DataFrame([OrderedDict([
-                             ('Event #', np.nan),
-                             ('Start Time', np.nan),
-                             ('End Time', np.nan),
-                             ('GOES Flare Class', np.nan),
-                             ('Pre-Flare Start Time', np.nan),
-                             ('Pre-Flare End Time', np.nan),
-                             ('Flare Interrupt', np.nan)])])
-    jedi_row = jedi_row.join(pd.DataFrame(columns=eve_lines.columns + ' Pre-Flare Irradiance [W/m2]'))
-    jedi_row = jedi_row.join(pd.DataFrame(columns=eve_lines.columns + ' Slope Start Time'))
-    jedi_row = jedi_row.join(pd.DataFrame(columns=eve_lines.columns + ' Slope End Time'))
-    jedi_row = jedi_row.join(pd.DataFrame(columns=eve_lines.columns + ' Slope Min [%/s]'))
-    jedi_row = jedi_row.join(pd.DataFrame(columns=eve_lines.columns + ' Slope Max [%/s]'))
-    jedi_row = jedi_row.join(pd.DataFrame(columns=eve_lines.columns + ' Slope Mean [%/s]'))
-    jedi_row = jedi_row.join(pd.DataFrame(columns=eve_lines.columns + ' Slope Uncertainty [%/s]'))
-    jedi_row = jedi_row.join(pd.DataFrame(columns=eve_lines.columns + ' Depth Time'))
-    jedi_row = jedi_row.join(pd.DataFrame(columns=eve_lines.columns + ' Depth [%]'))
-    jedi_row = jedi_row.join(pd.DataFrame(columns=eve_lines.columns + ' Depth Uncertainty [%]'))
-    jedi_row = jedi_row.join(pd.DataFrame(columns=eve_lines.columns + ' Duration Start Time'))
-    jedi_row = jedi_row.join(pd.DataFrame(columns=eve_lines.columns + ' Duration End Time'))
-    jedi_row = jedi_row.join(pd.DataFrame(columns=eve_lines.columns + ' Duration [s]'))
-    jedi_row = jedi_row.join(pd.DataFrame(columns=eve_lines.columns + ' Fitting Gamma'))
-    jedi_row = jedi_row.join(pd.DataFrame(columns=eve_lines.columns + ' Fitting Score'))
-
-    ion_tuples = list(itertools.permutations(eve_lines.columns.values, 2))
-    ion_permutations = pd.Index([' by '.join(ion_tuples[i]) for i in range(len(ion_tuples))])
-
-    jedi_row = jedi_row.join(pd.DataFrame(columns=ion_permutations + ' Slope Start Time'))
-    jedi_row = jedi_row.join(pd.DataFrame(columns=ion_permutations + ' Slope End Time'))
-    jedi_row = jedi_row.join(pd.DataFrame(columns=ion_permutations + ' Slope Min [%/s]'))
-    jedi_row = jedi_row.join(pd.DataFrame(columns=ion_permutations + ' Slope Max [%/s]'))
-    jedi_row = jedi_row.join(pd.DataFrame(columns=ion_permutations + ' Slope Mean [%/s]'))
-    jedi_row = jedi_row.join(pd.DataFrame(columns=ion_permutations + ' Slope Uncertainty [%/s]'))
-    jedi_row = jedi_row.join(pd.DataFrame(columns=ion_permutations + ' Depth Time'))
-    jedi_row = jedi_row.join(pd.DataFrame(columns=ion_permutations + ' Depth [%]'))
-    jedi_row = jedi_row.join(pd.DataFrame(columns=ion_permutations + ' Depth Uncertainty [%]'))
-    jedi_row = jedi_row.join(pd.DataFrame(columns=ion_permutations + ' Duration Start Time'))
-    jedi_row = jedi_row.join(pd.DataFrame(columns=ion_permutations + ' Duration End Time'))
-    jedi_row = jedi_row.join(pd.DataFrame(columns=ion_permutations + ' Duration [s]'))
-    jedi_row = jedi_row.join(pd.DataFrame(columns=ion_permutations + ' Correction Time Shift [s]'))
-    jedi_row = jedi_row.join(pd.DataFrame(columns=ion_permutations + ' Correction Scale Factor'))
-    jedi_row = jedi_row.join(pd.DataFrame(columns=ion_permutations + ' Fitting Gamma'))
-    jedi_row = jedi_row.join(pd.DataFrame(columns=ion_permutations + ' Fitting Score'))
-
-    csv_filename = output_path + 'jedi_{0}.csv'.format(Time.now().iso)
-    jedi_row.to_csv(csv_filename, header=True, index=False, mode='w')
+    # Define the typed columns of the JEDI catalog once; the event fills one preallocated row
+    jedi_schema = jedi_catalog_schema(eve_lines.columns)
+    jedi_row = JediRecord(jedi_schema)
+
+    catalog_path = output_path + 'jedi_{0}/'.format(Time.now().iso)
+    catalog_writer = JediCatalogWriter(catalog_path, jedi_schema)
 
     if verbose:
         logger.info('Created JEDI row definition.')
@@ -141,7 +118,7 @@ def generate_cme_signature(start_timestamp='2010-08-07 17:12:11',
     # Note: See this link if James's "eve_lines[start:end]" syntax is desired: https://stackoverflow.com/questions/16175874/python-pandas-dataframe-slicing-by-date-conditions  (Note we get KeyError if requested times in this range don't exist exactly)
     startTime = pd.to_datetime(start_timestamp)  # default value is '2010-08-07 17:12:11'
     endTime = pd.to_datetime(end_timestamp)      # default value is '2010-08-07 21:18:11'
-    eve_lines_event = eve_lines.loc[(eve_lines.index >= startTime) & (eve_lines.index <= endTime)]  # this syntax is more forgiving than "eve_lines[startTime:endTime]"
+    eve_lines_event = read_eve_window(eve_lines, startTime, endTime)  # a binary search, as forgiving of inexact times as a boolean mask
     #print(eve_lines_event.head)
 
     if verbose:
@@ -169,39 +146,22 @@ def generate_cme_signature(start_timestamp='2010-08-07 17:12:11',
 #---------Fit light curves to reduce noise------------------------------------------------------------------------------
 
     # Fit the light curves to reduce influence of noise on the parameterizations to come later
-    uncertainty = np.ones(len(eve_lines_event_percentages)) * 0.002545  # got this line from James's code
-
-    progress_bar_fitting = progressbar.ProgressBar(widgets=[progressbar.FormatLabel('Light curve fitting: ')] + widgets,
-                                                   max_value=len(eve_lines_event_percentages.columns)).start()
-    for i, column in enumerate(eve_lines_event_percentages):
-        if eve_lines_event_percentages[column].isnull().all().all():
-            if verbose:
-                logger.info(
-                    'Event {0} {1} fitting skipped because all irradiances are NaN.'.format(1, column))
-        else:
-            eve_line_event_percentages = pd.DataFrame(eve_lines_event_percentages[column])
-            eve_line_event_percentages.columns = ['irradiance']
-            eve_line_event_percentages['uncertainty'] = uncertainty
-
-            fitting_path = output_path + 'Fitting/'
-            if not os.path.exists(fitting_path):
-                os.makedirs(fitting_path)
-
-            plt.close('all')
-            light_curve_fit, best_fit_gamma, best_fit_score = automatic_fit_light_curve(eve_line_event_percentages,
-                                                                                        plots_save_path='{0} Event {1} {2} '.format(
-                                                                                            fitting_path, 1,
-                                                                                            column),
-                                                                                        verbose=verbose, logger=logger)
-            eve_lines_event_percentages[column] = light_curve_fit
-            jedi_row[column + ' Fitting Gamma'] = best_fit_gamma
-            jedi_row[column + ' Fitting Score'] = best_fit_score
-
-            if verbose:
-                logger.info('Event {0} {1} light curves fitted.'.format(1, column))
-            progress_bar_fitting.update(i)
-
-    progress_bar_fitting.finish()
+    # All lines share the event's time axis, so they are fitted together on one worker pool
+    # Fits kept from previous runs are reused
+    fit_cache = LightCurveFitCache(fit_cache_path) if fit_cache_path else None
+    fitting_path = output_path + 'Fitting/'
+    if not os.path.exists(fitting_path):
+        os.makedirs(fitting_path)
+
+    plt.close('all')
+    (eve_lines_event_percentages, best_fit_gammas, best_fit_scores, fit_uncertainties,
+     fit_replicates) = automatic_fit_light_curves(
+        eve_lines_event_percentages, uncertainty=0.002545,  # got this uncertainty from James's code
+        plots_save_path='{0} Event {1} '.format(fitting_path, 1), fit_cache=fit_cache, fit_uncertainty_bootstraps=20,
+        return_fit_replicates=True, verbose=verbose, logger=logger)
+    for column in best_fit_scores.index[best_fit_scores.notnull()]:  # All NaN lines were skipped
+        jedi_row[column + ' Fitting Gamma'] = best_fit_gammas[column]
+        jedi_row[column + ' Fitting Score'] = best_fit_scores[column]
 
     if verbose:
         logger.info('Light curves fitted')
@@ -242,6 +202,8 @@ def generate_cme_signature(start_timestamp='2010-08-07 17:12:11',
 
             jedi_row[column + ' Depth [%]'] = depth_percent
             jedi_row[column + ' Depth Time'] = depth_time
+            if not pd.isnull(depth_time):
+                jedi_row[column + ' Depth Uncertainty [%]'] = fit_uncertainties[column][depth_time]
 
             # Determine dimming slope (if any)
             slope_path = output_path + 'Slope/'
@@ -270,6 +232,15 @@ def generate_cme_signature(start_timestamp='2010-08-07 17:12:11',
                 jedi_row[column + ' Slope Start Time'] = slope_start_time
                 jedi_row[column + ' Slope End Time'] = slope_end_time
 
+                # The mean slope is the drop from the maximum to the end of the slope over their time difference,
+                # so its uncertainty is the spread of that drop over the bootstrap refits of the fit
+                slope_max_time = eve_line_event[slope_start_time:slope_end_time]['irradiance'].idxmax()
+                slope_seconds = (slope_end_time - slope_max_time).total_seconds()
+                if slope_seconds > 0 and column in fit_replicates:
+                    slope_replicates = (fit_replicates[column].loc[slope_end_time] -
+                                        fit_replicates[column].loc[slope_max_time]) / slope_seconds
+                    jedi_row[column + ' Slope Uncertainty [%/s]'] = np.std(slope_replicates, ddof=1)
+
                 # Determine dimming duration (if any)
                 duration_path = output_path + 'Duration/'
                 if not os.path.exists(duration_path):
@@ -355,9 +326,12 @@ def generate_cme_signature(start_timestamp='2010-08-07 17:12:11',
 #---------Output results------------------------------------------------------------------------------------------------
 
     # Write to the JEDI catalog on disk
-    jedi_row.to_csv(csv_filename, header=False, index=False, mode='a')
+    catalog_writer.add(jedi_row)
+    catalog_writer.close()
     if verbose:
-        logger.info('Event {0} JEDI row written to {1}.'.format(1, csv_filename))
+        logger.info('Event {0} JEDI row written to {1}.'.format(1, catalog_path))
+        if fit_cache is not None:
+            logger.info(fit_cache.summary())
 
 
 if __name__ == '__main__':
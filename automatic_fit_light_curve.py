@@ -1,4 +1,8 @@
 # Standard modules
+import time
+import contextlib
+import multiprocessing
+import concurrent.futures
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
@@ -6,19 +10,37 @@ from sklearn.pipeline import make_pipeline
 from sklearn.model_selection import validation_curve, ShuffleSplit
 from sklearn.metrics import explained_variance_score, make_scorer
 from sklearn.svm import SVR
+from sklearn.kernel_approximation import Nystroem
+from sklearn.linear_model import Ridge
+from scipy.interpolate import make_smoothing_spline
+from scipy.signal import savgol_coeffs, savgol_filter
+from joblib import Parallel, delayed
+from joblib.externals.loky import get_reusable_executor
+from threadpoolctl import threadpool_limits
 
 # Custom modules
 from jpm_time_conversions import metatimes_to_seconds_since_start, datetimeindex_to_human
 from jpm_logger import JpmLogger
+from concurrency_budget import ConcurrencyBudget, get_concurrency_budget
 
 __author__ = 'James Paul Mason'
 __contact__ = 'jmason86@gmail.com'
 
+# What joblib raises when a task outlives its timeout, depending on the backend and Python version
+_TIMEOUT_ERRORS = (TimeoutError, multiprocessing.TimeoutError, concurrent.futures.TimeoutError)
 
-def automatic_fit_light_curve(light_curve_df, minimum_score=0.3, plots_save_path=None,
+
+def automatic_fit_light_curve(light_curve_df, minimum_score=0.3, plots_save_path=None, method='svr',
+                              precompute_kernel=True, gamma_search='grid', gamma_prior=None, random_state=None,
+                              fit_cache=None, max_training_points=None, fit_uncertainty_bootstraps=0, time_budget=None,
                               verbose=False, logger=None):
     """Automatically fit the best support vector machine regression (SVR) model for the input light curve.
 
+    Other smoothers can be used instead of the SVR with the method keyword. Each chooses its own smoothing
+    hyperparameter by cross-validation and is scored with an explained variance score on held out points, so
+    minimum_score and the outputs mean the same for every method. benchmark_light_curve_fitting.py compares their
+    runtimes and scores on EVE windows.
+
     Inputs:
         light_curve_df [pd DataFrame]: A pandas DataFrame with a DatetimeIndex, and columns for irradiance and uncertainty.
 
@@ -28,17 +50,71 @@ def automatic_fit_light_curve(light_curve_df, minimum_score=0.3, plots_save_path
                                Default value is 0.3.
         plots_save_path [str]: Set to a path in order to save the validation curve and best fit overplot on the data to disk.
                                Default is None, meaning no plots will be saved to disk.
+        method [str]:          The fitting backend:
+                               'svr':      RBF support vector regression with gamma chosen on a validation curve.
+                               'spline':   A cubic smoothing spline with its penalty chosen on the same train/test
+                                           splits as the SVR.
+                               'savgol':   A quadratic Savitzky-Golay filter with its window length (up to half
+                                           the points) chosen and scored by leave-one-out cross-validation, which
+                                           the linearity of the filter gives without refitting. Assumes a regular
+                                           cadence.
+                               'nystroem': Kernel ridge regression on a 100 component Nystroem approximation of the
+                                           RBF kernel, with gamma chosen on the same splits as the SVR.
+                               Default is 'svr'.
+        precompute_kernel [bool]: Set to compute the squared distances between all times once and build each gamma's
+                                  RBF kernel from them, training every SVR on slices of that kernel
+                                  (kernel='precomputed') instead of letting each of the 400 validation fits recompute
+                                  it from X. Gives the same best gamma and fit as the rbf kernel. Default is True.
+        gamma_search [str]:    'grid' to score every gamma on all 20 train/test splits, or 'halving' for successive
+                               halving: every gamma is scored on 2 splits, the better half is kept and scored on 5,
+                               then 10, then all 20, so most of the budget goes to the gammas that are still in the
+                               running. The best gamma is chosen among those scored on all 20 splits.
+                               Default is 'grid'.
+        gamma_prior [float]:   Set to the best gamma of previous fits of the same emission line to only try gammas
+                               within two decades of it. Default is None, meaning the full gamma range.
+        random_state [int]:    Set to seed the ShuffleSplit of the validation curve for reproducible fits.
+                               Default is None.
+        fit_cache [LightCurveFitCache]: Set to a cache from light_curve_fit_cache.py to return the stored fit of the
+                                        same points and settings without refitting, and to store new fits in it.
+                                        random_state defaults to the cache's seed. Default is None.
+        max_training_points [int]: Set to bound the cost of 'svr' fits of long windows, e.g., hours of 10 second data.
+                                   Windows with more points are cut into this many consecutive strata of equal size,
+                                   each replaced by one inducing point: the weighted mean of its points, weighted by
+                                   their total weight normalized to a mean of 1. Gamma is chosen on the validation
+                                   curve of SVRs trained on the inducing points, and the best one is trained on all of
+                                   them, then predicted at every time. With verbose, the residuals of that fit on every
+                                   point are logged. Default is None, meaning every point is used.
+        fit_uncertainty_bootstraps [int]: Set to estimate the uncertainty of the fit at each point from this many wild
+                                          bootstrap refits: the fit plus its residuals with random signs is refitted
+                                          with the best hyperparameter, and the standard deviation of the refits is the
+                                          fit uncertainty. Only accepted fits are bootstrapped. 20 refits give it to
+                                          about 16%. The refits of the full 'svr' fit share its kernel and stop at a
+                                          10 times looser tolerance than it, but 20 of them still take about 5 times
+                                          as long as it, so with fit_cache the uncertainty is cached with the fit.
+                                          Default is 0, meaning the fit uncertainty is the input uncertainty.
+        time_budget [float]:   Set to the wall-clock seconds the fit may take. The validation curve, final fit, and
+                               bootstrap of an 'svr' fit run in worker processes (one of its own when the concurrency
+                               budget allows a single job), which are stopped once they outlive the time left, and no
+                               new stage is started once the budget is spent. The fast smoothers check the budget
+                               between hyperparameters. The light curve is then fitted with the cheap and deterministic
+                               'savgol' method instead, and fit_method is returned. Starting the worker takes a few
+                               seconds of the first budgeted fit. Default is None, meaning no limit.
         verbose [bool]:        Set to log the processing messages to disk and console. Default is False.
         logger [JpmLogger]:    A configured logger from jpm_logger.py. If set to None, will generate a
                                new one. Default is None.
 
     Outputs:
         light_curve_fit_df [pd DataFrame]: A pandas DataFrame with a DatetimeIndex, and columns for fitted irradiance and uncertainty.
-        best_fit_gamma [float]:            The best found gamma hyper parameter for the SVR.
+                                           The uncertainty is that of the fit with fit_uncertainty_bootstraps, and the
+                                           input uncertainty otherwise.
+        best_fit_gamma [float]:            The best found gamma hyper parameter for the SVR (or Nystroem), or the
+                                           best penalty of the spline (for time scaled to 0 - 1), or the best window
+                                           length of the Savitzky-Golay filter.
         best_fit_score [float]:            The best explained variance score.
 
     Optional Outputs:
-        None
+        fit_method [str]: Returned fourth with time_budget. The method of the fit: method, or 'savgol' if the budget
+                          ran out.
 
     Example:
         light_curve_fit, best_fit_gamma, best_fit_score = automatic_fit_light_curve(light_curve_df, verbose=True)
@@ -48,6 +124,34 @@ def automatic_fit_light_curve(light_curve_df, minimum_score=0.3, plots_save_path
     if verbose:
         if not logger:
             logger = JpmLogger(filename='automatic_fit_light_curve_log', path='/Users/jmason86/Desktop/')
+
+    fit_settings = {'minimum_score': minimum_score, 'plots_save_path': plots_save_path,
+                    'precompute_kernel': precompute_kernel, 'gamma_search': gamma_search, 'gamma_prior': gamma_prior,
+                    'random_state': random_state, 'fit_cache': fit_cache, 'max_training_points': max_training_points,
+                    'fit_uncertainty_bootstraps': fit_uncertainty_bootstraps, 'verbose': verbose, 'logger': logger}
+    if time_budget is None:
+        return _automatic_fit_light_curve(light_curve_df, method, None, get_concurrency_budget().parallel(),
+                                          **fit_settings)
+
+    # The fit falls back to the Savitzky-Golay filter, which takes a fraction of a second and always gives the same fit
+    if method != 'savgol':
+        try:
+            with _budget_pool(get_concurrency_budget()) as parallel:
+                return _automatic_fit_light_curve(light_curve_df, method, time.monotonic() + time_budget, parallel,
+                                                  **fit_settings) + (method,)
+        except _TIMEOUT_ERRORS:
+            if verbose:
+                logger.warning('{0} fit ran past its {1} s budget. Falling back to savgol.'.format(method, time_budget))
+    return _automatic_fit_light_curve(light_curve_df, 'savgol', None, get_concurrency_budget().parallel(),
+                                      **fit_settings) + ('savgol',)
+
+
+def _automatic_fit_light_curve(light_curve_df, method, deadline, parallel, minimum_score, plots_save_path,
+                               precompute_kernel, gamma_search, gamma_prior, random_state, fit_cache,
+                               max_training_points, fit_uncertainty_bootstraps, verbose, logger):
+    # The fit of automatic_fit_light_curve, raising TimeoutError once time.monotonic() passes the deadline (if not
+    # None). The validation curves, final SVR fit, and bootstrap refits run on the parallel pool.
+    if verbose:
         logger.info("Running on event with light curve start time of {0}.".format(light_curve_df.index[0]))
 
     # Pull data out of the DataFrame for compatibility formatting
@@ -77,66 +181,631 @@ def automatic_fit_light_curve(light_curve_df, minimum_score=0.3, plots_save_path
     # Overwrite the default scorer (R^2) with explained variance score
     evs = make_scorer(explained_variance_score)
 
+    # Helper function to estimate the fit uncertainty of an accepted fit, returned with its bootstrap refits
+    def bootstrap_fit(y_fit, best_fit_gamma, best_fit_score, fit_seconds=None):
+        if not fit_uncertainty_bootstraps or not best_fit_score >= minimum_score:
+            return None, None
+        t0 = time.monotonic()
+        fit_uncertainty, fit_replicates = _bootstrap_fit_uncertainty(
+            method, X, y, y_fit, 1 / uncertainty.values, best_fit_gamma, fit_uncertainty_bootstraps, random_state,
+            strata, _timed(parallel, deadline), return_replicates=True)
+        if verbose:
+            _log_fit_uncertainty_timing(fit_uncertainty_bootstraps, time.monotonic() - t0, fit_seconds, logger)
+        return fit_uncertainty, fit_replicates
+
+    # Helper function to package an accepted fit
+    def accept_fit(y_fit, best_fit_gamma, best_fit_score, fit_uncertainty=None):
+        return _accept_light_curve_fit(light_curve_df, finite_irradiance_indices, X, y, y_fit, uncertainty,
+                                       best_fit_gamma, best_fit_score, minimum_score, plots_save_path, verbose, logger,
+                                       fit_uncertainty)
+
+    # A cached fit has to be reproducible, so it always has a cross-validation seed
+    if fit_cache is not None and random_state is None:
+        random_state = fit_cache.random_state
+
+    # Long windows: gamma is chosen and the fit is trained on one inducing point per stratum, so they are the same model
+    X_train, y_train, train_weight, strata = X, y, None, None
+    if method == 'svr' and max_training_points is not None and len(y) > max_training_points:
+        strata = _time_strata(len(y), max_training_points)
+        X_train, y_train, train_weight, _ = _inducing_points(X, y, 1 / uncertainty.values, strata)
+        if verbose:
+            logger.info("Choosing gamma and training on {0} inducing points.".format(max_training_points))
+
     # Split the data between training/testing 50/50 but across the whole time range rather than the default consecutive Kfolds
-    import time
-    t0 = time.time()
-    shuffle_split = ShuffleSplit(n_splits=20, train_size=0.5, test_size=0.5, random_state=None)
+    shuffle_split = ShuffleSplit(n_splits=20, train_size=0.5, test_size=0.5, random_state=random_state)
+    splits = list(shuffle_split.split(X_train))
+
+    # A fit of the same points with the same settings is taken from the cache without refitting
+    if fit_cache is not None:
+        cache_key = fit_cache.key(X, y, uncertainty.values, splits, method=method, precompute_kernel=precompute_kernel,
+                                  gamma_search=gamma_search, gamma_prior=gamma_prior, random_state=random_state,
+                                  max_training_points=max_training_points if strata is not None else None,
+                                  fit_uncertainty_bootstraps=fit_uncertainty_bootstraps)
+        cached_fit = fit_cache.get(cache_key)
+        if cached_fit is not None:
+            y_fit, best_fit_gamma, best_fit_score, train_score, val_score, fit_uncertainty, fit_replicates = cached_fit
+            if verbose:
+                logger.info('Fit taken from the cache. Best score: {0}, best hyperparameter: {1}'.format(
+                    best_fit_score, best_fit_gamma))
+            if plots_save_path and val_score is not None:
+                _plot_validation_curve(light_curve_df.index, gamma, train_score, val_score, plots_save_path, verbose,
+                                       logger)
+            if fit_uncertainty is None:  # Cached while rejected, or by a version without the bootstrap
+                fit_uncertainty, fit_replicates = bootstrap_fit(y_fit, best_fit_gamma, best_fit_score)
+                if fit_uncertainty is not None:
+                    fit_cache.put(cache_key, y_fit, best_fit_gamma, best_fit_score, train_score, val_score,
+                                  fit_uncertainty, fit_replicates)
+            return accept_fit(y_fit, best_fit_gamma, best_fit_score, fit_uncertainty)
+
+    # The fast smoothers
+    if method != 'svr':
+        t0 = time.monotonic()
+        y_fit, best_fit_gamma, best_fit_score = _fit_fast_smoother(method, X, y, 1 / uncertainty.values, gamma,
+                                                                   splits, random_state, deadline)
+        fit_seconds = time.monotonic() - t0
+        _check_time_budget(deadline)
+        if verbose:
+            logger.info('{0} best score: {1}, best hyperparameter: {2}'.format(method, best_fit_score, best_fit_gamma))
+        fit_uncertainty, fit_replicates = bootstrap_fit(y_fit, best_fit_gamma, best_fit_score, fit_seconds)
+        if fit_cache is not None:
+            fit_cache.put(cache_key, y_fit, best_fit_gamma, best_fit_score, fit_uncertainty=fit_uncertainty,
+                          fit_replicates=fit_replicates)
+        return accept_fit(y_fit, best_fit_gamma, best_fit_score, fit_uncertainty)
+
+    # Warm start: previous fits of the same line narrow down where the best gamma can be
+    candidate_gamma_indices = np.arange(len(gamma))
+    if gamma_prior is not None:
+        candidate_gamma_indices = np.flatnonzero(np.abs(np.log10(gamma) - np.log10(gamma_prior)) <= 2)
+        if verbose:
+            logger.info('Trying {0} gammas around the prior of {1}.'.format(len(candidate_gamma_indices), gamma_prior))
+
+    # Only gamma changes between fits, so the distances are computed once and each gamma's kernel is exp(-gamma * d^2)
+    squared_distances = (X_train - X_train.T) ** 2 if precompute_kernel else None
+    train_score = np.full((len(gamma), len(splits)), np.nan)  # NaN for the gammas and splits that were not scored
+    val_score = np.full((len(gamma), len(splits)), np.nan)
 
     # Generate the validation curve -- test all them gammas!
     # Parallelized to speed it up (n_jobs = # of parallel threads)
-    train_score, val_score = validation_curve(jpm_svr(), X, y,
-                                              'svr__gamma',
-                                              gamma, cv=shuffle_split, n_jobs=7, scoring=evs)
-    t1 = time.time()
-    logger.error('It took {0} seconds to run.'.format(t1 - t0))
+    if gamma_search == 'halving':
+        survivors = candidate_gamma_indices
+        n_scored_splits = 0
+        for n_splits in [2, 5, 10, len(splits)]:
+            if n_scored_splits > 0:
+                # Keep the better half, ranked on the splits scored so far
+                median_scores = np.median(val_score[survivors, :n_scored_splits], axis=1)
+                survivors = survivors[np.argsort(-median_scores, kind='stable')[:int(np.ceil(len(survivors) / 2.0))]]
+            scores = _timed(parallel, deadline)(
+                delayed(_validation_scores)(X_train, y_train, gamma[k], splits[n_scored_splits:n_splits],
+                                            squared_distances, train_weight)
+                for k in survivors)
+            for k, (train_scores, val_scores) in zip(survivors, scores):
+                train_score[k, n_scored_splits:n_splits] = train_scores
+                val_score[k, n_scored_splits:n_splits] = val_scores
+            n_scored_splits = n_splits
+        if verbose:
+            logger.info('Successive halving scored {0} of {1} gamma and split combinations.'.format(
+                np.isfinite(val_score).sum(), val_score.size))
+    elif gamma_search == 'grid':
+        # validation_curve neither weights the inducing points nor takes a timeout
+        if precompute_kernel or train_weight is not None or deadline is not None:
+            scores = _timed(parallel, deadline)(
+                delayed(_validation_scores)(X_train, y_train, gamma[k], splits, squared_distances, train_weight)
+                for k in candidate_gamma_indices)
+            train_score[candidate_gamma_indices] = [train_scores for train_scores, _ in scores]
+            val_score[candidate_gamma_indices] = [val_scores for _, val_scores in scores]
+        else:
+            budget = get_concurrency_budget()
+            with budget.backend():
+                train_score[candidate_gamma_indices], val_score[candidate_gamma_indices] = validation_curve(
+                    jpm_svr(), X_train, y_train, 'svr__gamma', gamma[candidate_gamma_indices], cv=splits,
+                    n_jobs=budget.inner_jobs, scoring=evs)
+    else:
+        raise ValueError("gamma_search must be 'grid' or 'halving', got {0}.".format(gamma_search))
 
     if verbose:
         logger.info("Validation curve complete.")
 
     if plots_save_path:
-        plt.clf()
-        plt.style.use('jpm-transparent-light')
-        plt.plot(gamma, np.median(train_score, 1), label='training score')
-        plt.plot(gamma, np.median(val_score, 1), label='validation score')
-        ax = plt.axes()
-        plt.legend(loc='best')
-        plt.title("t$_0$ = " + datetimeindex_to_human(light_curve_df.index)[0])
-        ax.set_xscale('log')
-        plt.xlabel('gamma')
-        plt.ylabel('score')
-        plt.ylim(0, 1)
-        filename = plots_save_path + 'Validation Curve t0 ' + datetimeindex_to_human(light_curve_df.index)[0] + '.png'
-        plt.savefig(filename)
-        if verbose:
-            logger.info("Validation curve saved to %s" % filename)
+        _plot_validation_curve(light_curve_df.index, gamma, train_score, val_score, plots_save_path, verbose, logger)
 
-    # Identify the best score
+    # Identify the best score among the gammas scored on every split
     scores = np.median(val_score, axis=1)
-    best_fit_score = np.max(scores)
-    best_fit_gamma = gamma[np.argmax(scores)]
+    best_fit_score = np.nanmax(scores)
+    best_fit_gamma = gamma[np.nanargmax(scores)]
     if verbose:
         logger.info('Scores: ' + str(scores))
         logger.info('Best score: ' + str(best_fit_score))
         logger.info('Best fit gamma: ' + str(best_fit_gamma))
 
+    # Train and fit the best model, unless it will be rejected. Cached fits are always trained, so they can be reused
+    # with another minimum_score.
+    y_fit, fit_seconds = None, None
+    if best_fit_score >= minimum_score or fit_cache is not None:
+        t0 = time.monotonic()
+        if deadline is None:
+            y_fit = _fit_best_svr(X, y, 1 / uncertainty, best_fit_gamma, squared_distances, strata)
+        else:  # On the pool, so a fit that would outlive the budget is stopped at the deadline
+            y_fit = _timed(parallel, deadline)([delayed(_fit_best_svr)(X, y, 1 / uncertainty, best_fit_gamma,
+                                                                       squared_distances, strata)])[0]
+        fit_seconds = time.monotonic() - t0
+        if verbose:
+            logger.info("Best model trained and fitted.")
+            if strata is not None:
+                _log_inducing_fit_residuals(y, y_fit, logger)
+    fit_uncertainty, fit_replicates = bootstrap_fit(y_fit, best_fit_gamma, best_fit_score, fit_seconds)
+    if fit_cache is not None:
+        fit_cache.put(cache_key, y_fit, best_fit_gamma, best_fit_score, train_score, val_score, fit_uncertainty,
+                      fit_replicates)
+
+    return accept_fit(y_fit, best_fit_gamma, best_fit_score, fit_uncertainty)
+
+
+def automatic_fit_light_curves(light_curves_df, uncertainty=0.002545, minimum_score=0.3, plots_save_path=None,
+                               method='svr', precompute_kernel=True, gamma_search='grid', gamma_priors=None,
+                               random_state=None, fit_cache=None, max_training_points=None,
+                               fit_uncertainty_bootstraps=0, return_fit_replicates=False, time_budget=None,
+                               n_jobs=None, verbose=False, logger=None):
+    """Automatically fit every light curve (column) of a window, as automatic_fit_light_curve does for one of them.
+
+    All of the columns share one time axis, so the times, the squared distances between them, and the train/test
+    splits are computed once for the window and each column's fits use the rows where it is finite. The validation
+    fits of every column and gamma, and then the final fits, are spread over one pool of n_jobs workers that is kept
+    for the whole call, rather than a new pool for each column. A column with no NaNs gets exactly the splits, gamma,
+    and fit that automatic_fit_light_curve gives it with the same random_state.
+
+    This is a convenience for fitting a whole window, not a faster way to fit: the work shared between the columns
+    (the splits and distances) is trivial next to their SVR fits, which are all still made. On one worker it takes
+    about as long as fitting the columns one at a time with automatic_fit_light_curve. With several workers, the
+    column x gamma tasks keep the pool busier than one column's gammas would.
+
+    Inputs:
+        light_curves_df [pd DataFrame]: A pandas DataFrame with a DatetimeIndex and one column of irradiance per light
+                                        curve, e.g., all emission lines of an event in percent.
+
+    Optional Inputs:
+        uncertainty [float]:       The uncertainty of every irradiance, in the same units. Default is 0.002545.
+        minimum_score [float]:     Set this to the minimum explained variance score (0 - 1) acceptable for fits. Columns
+                                   whose best fit score is < minimum_score are NaN in light_curves_fit.
+                                   Default value is 0.3.
+        plots_save_path [str]:     Set to a path in order to save the validation curve and best fit overplot of each
+                                   column to disk, with the column name appended. Default is None, meaning no plots
+                                   will be saved to disk.
+        method [str]:              The fitting backend, as for automatic_fit_light_curve. Default is 'svr'.
+        precompute_kernel [bool]:  As for automatic_fit_light_curve. Default is True.
+        gamma_search [str]:        'grid' or 'halving', as for automatic_fit_light_curve. Default is 'grid'.
+        gamma_priors [dict]:       Set to the gamma_prior of some columns, keyed by column name (a pd Series works
+                                   too). Columns without one (or with NaN) try the full gamma range. Default is None.
+        random_state [int]:        Set to seed the ShuffleSplit of the validation curves for reproducible fits.
+                                   Default is None.
+        fit_cache [LightCurveFitCache]: As for automatic_fit_light_curve. Only the columns that are not in the cache
+                                        are fitted. Default is None.
+        max_training_points [int]: As for automatic_fit_light_curve, with the strata shared by all of the columns.
+                                   Default is None.
+        fit_uncertainty_bootstraps [int]: As for automatic_fit_light_curve, with the refits of the SVRs spread over the
+                                          pool. Set to also return light_curves_fit_uncertainty. Default is 0.
+        return_fit_replicates [bool]: Set to also return the bootstrap refits of every accepted column, so the
+                                      uncertainty of a quantity derived from several points of a fit (e.g., a slope)
+                                      can be taken over the refits, keeping the correlation between neighbouring
+                                      points. Needs fit_uncertainty_bootstraps. Default is False.
+        time_budget [float]:       Set to the wall-clock seconds that each column's fit may take, as for
+                                   automatic_fit_light_curve. Each column then has its own deadline: the columns are
+                                   fitted one after another (each still spread over the pool), and a column whose fit
+                                   runs past its budget is fitted with 'savgol' instead, without holding up the
+                                   others. fit_methods is returned. Default is None, meaning no limit.
+        n_jobs [int]:              The number of parallel workers. Default is None, meaning the inner_jobs of the
+                                   concurrency budget (see concurrency_budget.py).
+        verbose [bool]:            Set to log the processing messages to disk and console. Default is False.
+        logger [JpmLogger]:        A configured logger from jpm_logger.py. If set to None, will generate a
+                                   new one. Default is None.
+
+    Outputs:
+        light_curves_fit [pd DataFrame]: The same shape and index as light_curves_df, holding the fitted irradiance.
+                                         NaN where the input is NaN and in the columns whose fit was rejected or that
+                                         are all NaN.
+        best_fit_gammas [pd Series]:     The best gamma (or other hyperparameter, as for automatic_fit_light_curve)
+                                         of each column. NaN for columns that are all NaN.
+        best_fit_scores [pd Series]:     The best explained variance score of each column. NaN for columns that are
+                                         all NaN.
+
+    Optional Outputs:
+        light_curves_fit_uncertainty [pd DataFrame]: Returned fourth with fit_uncertainty_bootstraps. The same shape
+                                                     and index as light_curves_fit, holding the uncertainty of the fit.
+        light_curves_fit_replicates [dict]:          Returned next with return_fit_replicates. The bootstrap refits of
+                                                     each accepted column, keyed by column name: a pd DataFrame indexed
+                                                     by the column's finite times, with one column per refit.
+        fit_methods [pd Series]:                     Returned last with time_budget. The method of each column's fit:
+                                                     method, or 'savgol' if the budget ran out. NaN for columns that
+                                                     are all NaN.
+
+    Example:
+        light_curves_fit, best_fit_gammas, best_fit_scores = automatic_fit_light_curves(eve_lines_event_percentages,
+                                                                                         verbose=True)
+    """
+
+    # Prepare the logger for verbose
+    if verbose:
+        if not logger:
+            logger = JpmLogger(filename='automatic_fit_light_curve_log', path='/Users/jmason86/Desktop/')
+    if method not in ('svr', 'spline', 'savgol', 'nystroem'):
+        raise ValueError("method must be 'svr', 'spline', 'savgol', or 'nystroem', got {0}.".format(method))
+    if gamma_search not in ('grid', 'halving'):
+        raise ValueError("gamma_search must be 'grid' or 'halving', got {0}.".format(gamma_search))
+    if return_fit_replicates and not fit_uncertainty_bootstraps:
+        raise ValueError('return_fit_replicates needs fit_uncertainty_bootstraps.')
+
+    fit_settings = {'uncertainty': uncertainty, 'minimum_score': minimum_score, 'plots_save_path': plots_save_path,
+                    'precompute_kernel': precompute_kernel, 'gamma_search': gamma_search, 'gamma_priors': gamma_priors,
+                    'random_state': random_state, 'fit_cache': fit_cache, 'max_training_points': max_training_points,
+                    'fit_uncertainty_bootstraps': fit_uncertainty_bootstraps,
+                    'return_fit_replicates': return_fit_replicates, 'n_jobs': n_jobs, 'verbose': verbose,
+                    'logger': logger}
+    if time_budget is None:
+        return _automatic_fit_light_curves(light_curves_df, method, None, **fit_settings)
+
+    # As for automatic_fit_light_curve, each column's fit falls back to the Savitzky-Golay filter on its own
+    fit_outputs = [pd.DataFrame(np.nan, index=light_curves_df.index, columns=light_curves_df.columns),
+                   pd.Series(np.nan, index=light_curves_df.columns), pd.Series(np.nan, index=light_curves_df.columns)]
+    if fit_uncertainty_bootstraps:
+        fit_outputs.append(pd.DataFrame(np.nan, index=light_curves_df.index, columns=light_curves_df.columns))
+    if return_fit_replicates:
+        fit_outputs.append({})
+    fit_methods = pd.Series(np.nan, index=light_curves_df.columns, dtype=object)
+    with _budget_pool(_fit_budget(n_jobs)) as parallel:
+        for column in light_curves_df.columns[light_curves_df.notnull().any()]:
+            column_outputs, fit_methods[column] = None, method
+            if method != 'savgol':
+                try:
+                    column_outputs = _automatic_fit_light_curves(light_curves_df[[column]], method,
+                                                                 time.monotonic() + time_budget, parallel=parallel,
+                                                                 **fit_settings)
+                except _TIMEOUT_ERRORS:
+                    if verbose:
+                        logger.warning('{0} {1} fit ran past its {2} s budget. Falling back to savgol.'.format(
+                            column, method, time_budget))
+            if column_outputs is None:
+                column_outputs = _automatic_fit_light_curves(light_curves_df[[column]], 'savgol', None,
+                                                             parallel=parallel, **fit_settings)
+                fit_methods[column] = 'savgol'
+            for fit_output, column_output in zip(fit_outputs, column_outputs):
+                if isinstance(fit_output, dict):
+                    fit_output.update(column_output)
+                else:
+                    fit_output[column] = column_output[column]
+    return tuple(fit_outputs) + (fit_methods,)
+
+
+def _automatic_fit_light_curves(light_curves_df, method, deadline, uncertainty, minimum_score, plots_save_path,
+                                precompute_kernel, gamma_search, gamma_priors, random_state, fit_cache,
+                                max_training_points, fit_uncertainty_bootstraps, return_fit_replicates, n_jobs, verbose,
+                                logger, parallel=None):
+    # The fits of automatic_fit_light_curves, raising TimeoutError once time.monotonic() passes the deadline (if not
+    # None). The fits are spread over parallel if it is given, and otherwise over a pool kept for the call.
+    if verbose:
+        logger.info("Running on {0} light curves with start time of {1}.".format(len(light_curves_df.columns),
+                                                                              light_curves_df.index[0]))
+
+    light_curves_fit = pd.DataFrame(np.nan, index=light_curves_df.index, columns=light_curves_df.columns)
+    light_curves_fit_uncertainty = pd.DataFrame(np.nan, index=light_curves_df.index, columns=light_curves_df.columns)
+    best_fit_gammas = pd.Series(np.nan, index=light_curves_df.columns)
+    best_fit_scores = pd.Series(np.nan, index=light_curves_df.columns)
+    light_curves_fit_replicates = {}
+
+    # The time axis, training rows, kernel distances, and splits shared by all of the columns
+    X_window = metatimes_to_seconds_since_start(light_curves_df.index)
+    X_window = X_window.reshape(len(X_window), 1)
+    if fit_cache is not None and random_state is None:
+        random_state = fit_cache.random_state  # A cached fit has to be reproducible
+    X_train_window, window_strata = X_window, None
+    if method == 'svr' and max_training_points is not None and len(X_window) > max_training_points:
+        window_strata = _time_strata(len(X_window), max_training_points)
+        X_train_window = _inducing_points(X_window, np.zeros(len(X_window)), np.ones(len(X_window)), window_strata)[0]
+        if verbose:
+            logger.info("Choosing gamma and training on {0} inducing points.".format(max_training_points))
+    squared_distances_window = None
+    if method == 'svr' and precompute_kernel:
+        squared_distances_window = (X_train_window - X_train_window.T) ** 2
+    shuffle_split = ShuffleSplit(n_splits=20, train_size=0.5, test_size=0.5, random_state=random_state)
+    window_splits = list(shuffle_split.split(X_train_window))
+    gamma = np.logspace(-7, 1, num=20, base=10)
+
+    # Each column's finite points, with the shared splits and distances restricted to them
+    lines = []
+    for column in light_curves_df:
+        irradiance = light_curves_df[column].values.astype(float)
+        finite_irradiance_indices = np.isfinite(irradiance)
+        if not finite_irradiance_indices.any():
+            if verbose:
+                logger.info('{0} fitting skipped because all irradiances are NaN.'.format(column))
+            continue
+        line = {'column': column,
+                'finite_irradiance_indices': finite_irradiance_indices,
+                'X': X_window[finite_irradiance_indices],
+                'y': irradiance[finite_irradiance_indices],
+                'train_weight': None,
+                'strata': None,
+                'candidate_gamma_indices': np.arange(len(gamma))}
+        if window_strata is None:
+            finite_train_rows = finite_irradiance_indices
+            line['X_train'], line['y_train'] = line['X'], line['y']
+        else:
+            line['strata'] = window_strata[finite_irradiance_indices]
+            line['X_train'], line['y_train'], line['train_weight'], finite_train_rows = _inducing_points(
+                line['X'], line['y'], np.full(len(line['y']), 1 / uncertainty), line['strata'], max_training_points)
+        line['splits'] = window_splits if finite_train_rows.all() else _restrict_splits(window_splits,
+                                                                                        finite_train_rows)
+        if squared_distances_window is None or finite_irradiance_indices.all():
+            line['squared_distances'] = squared_distances_window
+        elif window_strata is None:
+            line['squared_distances'] = squared_distances_window[np.ix_(finite_train_rows, finite_train_rows)]
+        else:  # The inducing points of strata with NaNs are the means of fewer points
+            line['squared_distances'] = (line['X_train'] - line['X_train'].T) ** 2
+        gamma_prior = gamma_priors.get(column) if gamma_priors is not None else None
+        if gamma_prior is not None and not np.isfinite(gamma_prior):
+            gamma_prior = None
+        if method == 'svr' and gamma_prior is not None:
+            line['candidate_gamma_indices'] = np.flatnonzero(np.abs(np.log10(gamma) - np.log10(gamma_prior)) <= 2)
+
+        # A fit of the same points with the same settings is taken from the cache without refitting
+        line['cached'] = False
+        if fit_cache is not None:
+            line['cache_key'] = fit_cache.key(line['X'], line['y'], np.full(len(line['y']), uncertainty),
+                                              line['splits'], method=method, precompute_kernel=precompute_kernel,
+                                              gamma_search=gamma_search, gamma_prior=gamma_prior,
+                                              random_state=random_state,
+                                              max_training_points=max_training_points
+                                              if window_strata is not None else None,
+                                              fit_uncertainty_bootstraps=fit_uncertainty_bootstraps)
+            cached_fit = fit_cache.get(line['cache_key'])
+            if cached_fit is not None:
+                line['cached'] = True
+                (line['y_fit'], line['best_fit_gamma'], line['best_fit_score'], line['train_score'], line['val_score'],
+                 line['fit_uncertainty'], line['fit_replicates']) = cached_fit
+        lines.append(line)
+    fit_lines = [line for line in lines if not line['cached']]
+
+    if verbose:
+        logger.info("Fitting {0} light curves of up to {1} points.".format(len(fit_lines), len(light_curves_df)))
+        if fit_cache is not None:
+            logger.info("{0} fits taken from the cache.".format(len(lines) - len(fit_lines)))
+
+    with contextlib.nullcontext(parallel) if parallel is not None else _fit_budget(n_jobs).parallel() as parallel:
+        t0 = time.monotonic()  # The fast smoothers choose their hyperparameter and fit in one go
+        if method != 'svr':
+            fits = _timed(parallel, deadline)(delayed(_fit_fast_smoother)(method, line['X'], line['y'],
+                                                                          np.full(len(line['y']), 1 / uncertainty),
+                                                                          gamma, line['splits'], random_state,
+                                                                          deadline)
+                                              for line in fit_lines)
+            for line, (y_fit, best_fit_gamma, best_fit_score) in zip(fit_lines, fits):
+                line['y_fit'], line['best_fit_gamma'], line['best_fit_score'] = y_fit, best_fit_gamma, best_fit_score
+                line['train_score'] = line['val_score'] = None
+        else:
+            # Validation curves of every column at once -- test all them gammas!
+            for line in fit_lines:
+                line['train_score'] = np.full((len(gamma), len(window_splits)), np.nan)
+                line['val_score'] = np.full((len(gamma), len(window_splits)), np.nan)
+                line['survivors'] = line['candidate_gamma_indices']
+            rounds = [2, 5, 10, len(window_splits)] if gamma_search == 'halving' else [len(window_splits)]
+            n_scored_splits = 0
+            for n_splits in rounds:
+                if n_scored_splits > 0:
+                    # Keep the better half of each column's gammas, ranked on the splits scored so far
+                    for line in fit_lines:
+                        median_scores = np.median(line['val_score'][line['survivors'], :n_scored_splits], axis=1)
+                        line['survivors'] = line['survivors'][np.argsort(-median_scores, kind='stable')[
+                                                              :int(np.ceil(len(line['survivors']) / 2.0))]]
+                tasks = [(line, k) for line in fit_lines for k in line['survivors']]
+                scores = _timed(parallel, deadline)(delayed(_validation_scores)(
+                    line['X_train'], line['y_train'], gamma[k], line['splits'][n_scored_splits:n_splits],
+                    line['squared_distances'], line['train_weight']) for line, k in tasks)
+                for (line, k), (train_scores, val_scores) in zip(tasks, scores):
+                    line['train_score'][k, n_scored_splits:n_splits] = train_scores
+                    line['val_score'][k, n_scored_splits:n_splits] = val_scores
+                n_scored_splits = n_splits
+
+            if verbose:
+                logger.info("Validation curves complete.")
+
+            # Identify the best score of each column among the gammas scored on every split
+            for line in fit_lines:
+                scores = np.median(line['val_score'], axis=1)
+                line['best_fit_score'] = np.nanmax(scores)
+                line['best_fit_gamma'] = gamma[np.nanargmax(scores)]
+
+            # Train and fit the best model of every column that is good enough (or of every column, to cache them)
+            accepted_lines = [line for line in fit_lines
+                              if line['best_fit_score'] >= minimum_score or fit_cache is not None]
+            t0 = time.monotonic()
+            fits = _timed(parallel, deadline)(delayed(_fit_best_svr)(line['X'], line['y'],
+                                                                     np.full(len(line['y']), 1 / uncertainty),
+                                                                     line['best_fit_gamma'], line['squared_distances'],
+                                                                     line['strata'])
+                                              for line in accepted_lines)
+            for line, y_fit in zip(accepted_lines, fits):
+                line['y_fit'] = y_fit
+                if verbose and line['strata'] is not None:
+                    _log_inducing_fit_residuals(line['y'], y_fit, logger)
+        fit_seconds = time.monotonic() - t0
+
+        # The fit uncertainty of every accepted column that was not cached with one
+        uncertain_lines = []
+        if fit_uncertainty_bootstraps:
+            t0 = time.monotonic()
+            uncertain_lines = [line for line in lines
+                               if line['best_fit_score'] >= minimum_score and line.get('fit_uncertainty') is None]
+            for line in uncertain_lines:
+                line['fit_uncertainty'], line['fit_replicates'] = _bootstrap_fit_uncertainty(
+                    method, line['X'], line['y'], line['y_fit'], np.full(len(line['y']), 1 / uncertainty),
+                    line['best_fit_gamma'], fit_uncertainty_bootstraps, random_state, line['strata'],
+                    _timed(parallel, deadline), return_replicates=True)
+            if verbose and uncertain_lines:
+                _log_fit_uncertainty_timing(fit_uncertainty_bootstraps, time.monotonic() - t0,
+                                            fit_seconds if fit_lines else None, logger,
+                                            n_light_curves=len(uncertain_lines))
+
+    if fit_cache is not None:
+        for line in fit_lines + [line for line in uncertain_lines if line['cached']]:
+            fit_cache.put(line['cache_key'], line['y_fit'], line['best_fit_gamma'], line['best_fit_score'],
+                          line['train_score'], line['val_score'], line.get('fit_uncertainty'),
+                          line.get('fit_replicates'))
+
+    for line in lines:
+        column = line['column']
+        best_fit_gammas[column], best_fit_scores[column] = line['best_fit_gamma'], line['best_fit_score']
+        if plots_save_path and line['val_score'] is not None:
+            plt.close('all')
+            _plot_validation_curve(light_curves_df.index, gamma, line['train_score'], line['val_score'],
+                                   '{0}{1} '.format(plots_save_path, column), verbose, logger)
+        if verbose:
+            logger.info('{0} best score: {1}, best fit gamma: {2}'.format(column, line['best_fit_score'],
+                                                                          line['best_fit_gamma']))
+
+        # Leave NaN if only got bad fits
+        if not line['best_fit_score'] >= minimum_score:  # Also rejects a NaN score (too few points to fit)
+            if verbose:
+                logger.warning("Uh oh. {0} best fit score {1:.2f} is < user-defined minimum score {2:.2f}".format(
+                    column, line['best_fit_score'], minimum_score))
+            continue
+
+        light_curve_df = pd.DataFrame({'irradiance': light_curves_df[column]})
+        light_curve_df['uncertainty'] = uncertainty
+        if plots_save_path:
+            plt.close('all')
+        light_curve_fit = _light_curve_fit_output(
+            light_curve_df, line['finite_irradiance_indices'], line['X'], line['y'], line['y_fit'],
+            light_curve_df['uncertainty'][line['finite_irradiance_indices']],
+            '{0}{1} '.format(plots_save_path, column) if plots_save_path else None, verbose, logger,
+            line.get('fit_uncertainty'))
+        light_curves_fit[column] = light_curve_fit['irradiance']
+        if fit_uncertainty_bootstraps:
+            light_curves_fit_uncertainty[column] = light_curve_fit['uncertainty']
+        if return_fit_replicates:
+            light_curves_fit_replicates[column] = pd.DataFrame(line['fit_replicates'].T, index=light_curve_fit.index)
+
+    if verbose:
+        logger.info("{0} of {1} light curves fitted.".format(int(light_curves_fit.notnull().any().sum()),
+                                                            len(light_curves_df.columns)))
+
+    if return_fit_replicates:
+        return (light_curves_fit, best_fit_gammas, best_fit_scores, light_curves_fit_uncertainty,
+                light_curves_fit_replicates)
+    if fit_uncertainty_bootstraps:
+        return light_curves_fit, best_fit_gammas, best_fit_scores, light_curves_fit_uncertainty
+    return light_curves_fit, best_fit_gammas, best_fit_scores
+
+
+def _check_time_budget(deadline):
+    if deadline is not None and time.monotonic() > deadline:
+        raise TimeoutError('The fit time budget is spent.')
+
+
+def _time_left(deadline):
+    # The joblib timeout of the tasks started now: the rest of the budget, or None for no limit
+    if deadline is None:
+        return None
+    return max(deadline - time.monotonic(), 1e-3)
+
+
+def _timed(parallel, deadline):
+    # The pool with the time left now as the timeout of its next tasks, so a stuck task is stopped at the deadline
+    _check_time_budget(deadline)
+    parallel.timeout = _time_left(deadline)
+    return parallel
+
+
+def _budget_pool(budget):
+    # The pool of a fit with a time budget. joblib runs the tasks of a one job pool in this process, where its timeout
+    # cannot stop them, so one job gets a worker process of its own instead.
+    if budget.inner_jobs > 1:
+        return budget.parallel()
+    return _WorkerProcess(budget.blas_threads)
+
+
+class _WorkerProcess:
+    # A stand-in for joblib.Parallel(n_jobs=1) that runs its tasks in one loky worker process when it has a timeout,
+    # and kills the worker if the tasks outlive it. The worker is reused between calls (and fits) until it is killed.
+    def __init__(self, blas_threads=1):
+        self.blas_threads = blas_threads
+        self.timeout = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def __call__(self, tasks):
+        if self.timeout is None:
+            return [function(*args, **kwargs) for function, args, kwargs in tasks]
+        deadline = time.monotonic() + self.timeout
+        executor = get_reusable_executor(max_workers=1)
+        results = []
+        for function, args, kwargs in tasks:  # One at a time, so only the running task is lost to a kill
+            future = executor.submit(_run_with_blas_threads, self.blas_threads, function, args, kwargs)
+            try:
+                results.append(future.result(timeout=max(deadline - time.monotonic(), 1e-3)))
+            except _TIMEOUT_ERRORS:
+                executor.shutdown(wait=True, kill_workers=True)
+                raise
+        return results
+
+
+def _run_with_blas_threads(blas_threads, function, args, kwargs):
+    # A task of _WorkerProcess, with the worker's BLAS libraries limited as those of joblib's workers are
+    with threadpool_limits(limits=blas_threads):
+        return function(*args, **kwargs)
+
+
+def _fit_budget(n_jobs=None):
+    # The concurrency budget of the fitting pool, with n_jobs workers if it is given
+    budget = get_concurrency_budget()
+    if n_jobs is not None:
+        budget = ConcurrencyBudget(total_threads=n_jobs * budget.blas_threads, blas_threads=budget.blas_threads)
+    return budget
+
+
+def _log_inducing_fit_residuals(y, y_fit, logger):
+    # How well the returned fit, trained on the inducing points, describes every point
+    residuals = y - y_fit
+    logger.info('Inducing point fit on all {0} points: explained variance {1:.4f}, residual RMS {2:.4g}, median '
+                'absolute {3:.4g}, maximum absolute {4:.4g}.'.format(len(y), explained_variance_score(y, y_fit),
+                                                                  np.sqrt(np.mean(residuals ** 2)),
+                                                                  np.median(np.abs(residuals)),
+                                                                  np.max(np.abs(residuals))))
+
+
+def _log_fit_uncertainty_timing(n_bootstraps, bootstrap_seconds, fit_seconds, logger, n_light_curves=1):
+    # The cost of the bootstrap against that of the fits it is the uncertainty of (unknown for cached fits), in total
+    # and per refit
+    message = 'Fit uncertainty of {0} light curve(s) from {1} bootstrap refits each took {2:.2f} s'.format(
+        n_light_curves, n_bootstraps, bootstrap_seconds)
+    if fit_seconds:
+        message += ', {0:.1f} times the {1:.2f} s of the fits ({2:.2f} times per refit)'.format(
+            bootstrap_seconds / fit_seconds, fit_seconds, bootstrap_seconds / fit_seconds / n_bootstraps)
+    logger.info(message + '.')
+
+
+def _accept_light_curve_fit(light_curve_df, finite_irradiance_indices, X, y, y_fit, uncertainty, best_fit_gamma,
+                            best_fit_score, minimum_score, plots_save_path, verbose, logger, fit_uncertainty=None):
     # Return np.nan if only got bad fits
-    if best_fit_score < minimum_score:
+    if not best_fit_score >= minimum_score:  # Also rejects a NaN score (too few points to fit)
         if verbose:
             logger.warning("Uh oh. Best fit score {0:.2f} is < user-defined minimum score {1:.2f}".format(best_fit_score, minimum_score))
         return np.nan, best_fit_gamma, best_fit_score
+    return (_light_curve_fit_output(light_curve_df, finite_irradiance_indices, X, y, y_fit, uncertainty,
+                                    plots_save_path, verbose, logger, fit_uncertainty), best_fit_gamma, best_fit_score)
 
-    # Otherwise train and fit the best model
-    sample_weight = 1 / uncertainty
-    model = SVR(kernel='rbf', C=1e3, gamma=best_fit_gamma).fit(X, y, sample_weight)
-    y_fit = model.predict(X)
-
-    if verbose:
-        logger.info("Best model trained and fitted.")
 
+def _light_curve_fit_output(light_curve_df, finite_irradiance_indices, X, y, y_fit, uncertainty, plots_save_path,
+                            verbose, logger, fit_uncertainty=None):
+    # Plot the fit and package it the same way for every method
     if plots_save_path:
         plt.clf()
         plt.errorbar(X.ravel(), y, yerr=uncertainty, color='black', fmt='o', label='Input light curve')
         plt.plot(X.ravel(), y_fit, linewidth=6, label='Fit')
+        if fit_uncertainty is not None:
+            plt.fill_between(X.ravel(), y_fit - fit_uncertainty, y_fit + fit_uncertainty, alpha=0.5,
+                             label='Fit uncertainty')
         plt.title("t$_0$ = " + datetimeindex_to_human(light_curve_df.index)[0])
         plt.xlabel('time [seconds since start]')
         plt.ylabel('irradiance [%]')
@@ -146,9 +815,9 @@ def automatic_fit_light_curve(light_curve_df, minimum_score=0.3, plots_save_path
         if verbose:
             logger.info("Fitted curve saved to %s" % filename)
 
-    # TODO: Get uncertainty of fit at each point... if that's even possible
-    # Placeholder for now just so that the function can complete: output uncertainty = input uncertainty
-    fit_uncertainty = uncertainty
+    # Without a bootstrapped fit uncertainty, the output uncertainty is the input uncertainty
+    if fit_uncertainty is None:
+        fit_uncertainty = uncertainty
 
     # Construct a pandas DataFrame with DatetimeIndex, y_fit, and fit_uncertainty
     light_curve_fit_df = pd.DataFrame({'irradiance': y_fit,
@@ -157,4 +826,230 @@ def automatic_fit_light_curve(light_curve_df, minimum_score=0.3, plots_save_path
     if verbose:
         logger.info("Created output DataFrame")
 
-    return light_curve_fit_df, best_fit_gamma, best_fit_score
+    return light_curve_fit_df
+
+
+def _plot_validation_curve(index, gamma, train_score, val_score, plots_save_path, verbose, logger):
+    plt.clf()
+    plt.style.use('jpm-transparent-light')
+    plt.plot(gamma, np.nanmedian(train_score, 1), label='training score')
+    plt.plot(gamma, np.nanmedian(val_score, 1), label='validation score')
+    ax = plt.axes()
+    plt.legend(loc='best')
+    plt.title("t$_0$ = " + datetimeindex_to_human(index)[0])
+    ax.set_xscale('log')
+    plt.xlabel('gamma')
+    plt.ylabel('score')
+    plt.ylim(0, 1)
+    filename = plots_save_path + 'Validation Curve t0 ' + datetimeindex_to_human(index)[0] + '.png'
+    plt.savefig(filename)
+    if verbose:
+        logger.info("Validation curve saved to %s" % filename)
+
+
+def _fit_best_svr(X, y, sample_weight, gamma, squared_distances=None, strata=None):
+    # Train the SVR of the chosen gamma on every point, or on the mean point of each stratum when strata are given, and
+    # predict them all
+    if strata is not None:
+        return _fit_inducing_svr(X, y, sample_weight, gamma, strata)
+    if squared_distances is not None:
+        return _fit_precomputed_svr(np.exp(-gamma * squared_distances), y, sample_weight)
+    model = SVR(kernel='rbf', C=1e3, gamma=gamma).fit(X, y, sample_weight)
+    return model.predict(X)
+
+
+def _fit_precomputed_svr(kernel, y, sample_weight, tol=1e-3):
+    model = SVR(kernel='precomputed', C=1e3, tol=tol).fit(kernel, y, sample_weight)
+    return model.predict(kernel)
+
+
+def _time_strata(n_points, n_strata):
+    # Cut the points (in time order) into n_strata consecutive strata of equal size, covering the whole window evenly
+    return np.arange(n_points) * n_strata // n_points
+
+
+def _inducing_points(X, y, sample_weight, strata, n_strata=None):
+    # One inducing point per occupied stratum (strata can be empty where the irradiance is NaN): the weighted mean of
+    # its points. The weights are the strata's total weights normalized to a mean of 1, so libsvm's C is the C=1e3 of
+    # the unweighted validation curve of the full data, and only strata that lost points to NaNs weigh less.
+    sample_weight = np.asarray(sample_weight, dtype=np.float64)
+    n_strata = strata.max() + 1 if n_strata is None else n_strata
+    stratum_weight = np.bincount(strata, weights=sample_weight, minlength=n_strata)
+    occupied = stratum_weight > 0
+    X_inducing = (np.bincount(strata, weights=sample_weight * X.ravel(), minlength=n_strata)[occupied] /
+                  stratum_weight[occupied])
+    y_inducing = np.bincount(strata, weights=sample_weight * y, minlength=n_strata)[occupied] / stratum_weight[occupied]
+    inducing_weight = stratum_weight[occupied] / stratum_weight[occupied].mean()
+    return X_inducing.reshape(-1, 1), y_inducing, inducing_weight, occupied
+
+
+def _fit_inducing_svr(X, y, sample_weight, gamma, strata, chunk_points=100000):
+    # Train the SVR on the inducing points of the strata, the same model the validation curve scored. The RBF kernel is
+    # evaluated by libsvm point by point, and the prediction is made in chunks, so memory stays bounded by the number
+    # of strata and chunk_points.
+    X_inducing, y_inducing, inducing_weight, _ = _inducing_points(X, y, sample_weight, strata)
+    model = SVR(kernel='rbf', C=1e3, gamma=gamma).fit(X_inducing, y_inducing, inducing_weight)
+    return np.concatenate([model.predict(X[chunk_start:chunk_start + chunk_points])
+                           for chunk_start in range(0, len(X), chunk_points)])
+
+
+def _bootstrap_fit_uncertainty(method, X, y, y_fit, sample_weight, best_fit_gamma, n_bootstraps, random_state=None,
+                               strata=None, parallel=None, return_replicates=False):
+    # Wild bootstrap: every replicate is the fit plus its residuals with random signs, which keeps each residual at its
+    # own time, and is refitted with the best hyperparameter. The standard deviation of the refits at each point is the
+    # fit uncertainty, returned with the refits (replicates x points) if return_replicates is set. All of the replicates
+    # are drawn at once and refitted as a batch where the method allows it: one filter call along the replicates
+    # (savgol), one multi-output ridge solve (nystroem), or one RBF kernel shared by the SVRs spread over the parallel
+    # pool.
+    random_generator = np.random.RandomState(random_state)
+    signs = random_generator.choice([-1.0, 1.0], size=(n_bootstraps, len(y)))
+    y_bootstraps = y_fit + signs * (y - y_fit)
+    sample_weight = np.asarray(sample_weight, dtype=np.float64)
+
+    if method == 'savgol':
+        fits = savgol_filter(y_bootstraps, int(best_fit_gamma), 2, axis=1)
+    elif method == 'spline':
+        t = _spline_time(X)
+        fits = np.array([make_smoothing_spline(t, y_bootstrap, w=sample_weight, lam=best_fit_gamma)(t)
+                         for y_bootstrap in y_bootstraps])
+    elif method == 'nystroem':
+        model = _nystroem_ridge(best_fit_gamma, len(y), random_state).fit(X, y_bootstraps.T,
+                                                                          ridge__sample_weight=sample_weight)
+        fits = model.predict(X).T
+    else:
+        if parallel is None:
+            parallel = Parallel(n_jobs=1)
+        if strata is not None:
+            fits = parallel(delayed(_fit_inducing_svr)(X, y_bootstrap, sample_weight, best_fit_gamma, strata)
+                            for y_bootstrap in y_bootstraps)
+        else:
+            # libsvm converges slowly at the C of the weighted fit (C=1e3 times weights of ~400), so the refits stop at
+            # tol=1e-2: 2.4 times faster, and the uncertainties of a 98 point fit move by at most 12%, within the 16%
+            # sampling error of 20 refits
+            kernel = np.exp(-best_fit_gamma * (X - X.T) ** 2)
+            fits = parallel(delayed(_fit_precomputed_svr)(kernel, y_bootstrap, sample_weight, tol=1e-2)
+                            for y_bootstrap in y_bootstraps)
+        fits = np.array(fits)
+    if return_replicates:
+        return np.std(fits, axis=0, ddof=1), fits
+    return np.std(fits, axis=0, ddof=1)
+
+
+def _restrict_splits(splits, finite):
+    # Keep the finite points of each train/test split of all rows, renumbered as positions among the finite points
+    finite_positions = np.cumsum(finite) - 1
+    return [(finite_positions[train[finite[train]]], finite_positions[test[finite[test]]]) for train, test in splits]
+
+
+def _fit_fast_smoother(method, X, y, sample_weight, gamma, splits, random_state=None, deadline=None):
+    # Raises TimeoutError once time.monotonic() passes the deadline (if not None), checked between hyperparameters
+    if method == 'spline':
+        return _fit_smoothing_spline(X, y, sample_weight, splits, deadline)
+    elif method == 'savgol':
+        return _fit_savitzky_golay(y)
+    elif method == 'nystroem':
+        return _fit_nystroem(X, y, sample_weight, gamma, splits, random_state, deadline=deadline)
+    raise ValueError("method must be 'svr', 'spline', 'savgol', or 'nystroem', got {0}.".format(method))
+
+
+def _validation_scores(X, y, gamma, splits, squared_distances=None, sample_weight=None):
+    # The training and validation explained variance scores of one gamma for each train/test split, slicing the
+    # kernel out of squared_distances when it is given. sample_weight weights the training points (the inducing points).
+    if squared_distances is not None:
+        kernel = np.exp(-gamma * squared_distances)
+    train_scores = np.empty(len(splits))
+    val_scores = np.empty(len(splits))
+    for i, (train, test) in enumerate(splits):
+        train_weight = sample_weight[train] if sample_weight is not None else None
+        if squared_distances is not None:
+            model = SVR(kernel='precomputed', C=1e3).fit(kernel[np.ix_(train, train)], y[train], train_weight)
+            train_prediction = model.predict(kernel[np.ix_(train, train)])
+            test_prediction = model.predict(kernel[np.ix_(test, train)])
+        else:
+            model = SVR(kernel='rbf', C=1e3, gamma=gamma).fit(X[train], y[train], train_weight)
+            train_prediction = model.predict(X[train])
+            test_prediction = model.predict(X[test])
+        train_scores[i] = explained_variance_score(y[train], train_prediction)
+        val_scores[i] = explained_variance_score(y[test], test_prediction)
+    return train_scores, val_scores
+
+
+def _fit_smoothing_spline(X, y, sample_weight, splits, deadline=None):
+    # Choose the spline penalty by the median validation explained variance over the splits, as for the SVR gamma
+    t = _spline_time(X)
+    penalties = np.logspace(-10, 0, num=11, base=10)
+    scores = np.full(len(penalties), -np.inf)
+    for k, penalty in enumerate(penalties):
+        _check_time_budget(deadline)
+        val_scores = []
+        for train, test in splits:
+            train = np.sort(train)
+            spline = make_smoothing_spline(t[train], y[train], w=sample_weight[train], lam=penalty)
+            val_scores.append(explained_variance_score(y[test], spline(t[test])))
+        scores[k] = np.median(val_scores)
+    best_penalty = penalties[np.argmax(scores)]
+    y_fit = make_smoothing_spline(t, y, w=sample_weight, lam=best_penalty)(t)
+    return y_fit, best_penalty, np.max(scores)
+
+
+def _spline_time(X):
+    # Time is scaled to 0 - 1 so that the same spline penalties suit any window length
+    return (X.ravel() - X[0, 0]) / max(X[-1, 0] - X[0, 0], 1.0)
+
+
+def _fit_savitzky_golay(y, polyorder=2):
+    # Choose the window length by leave-one-out cross-validation. Each point's fit is a least squares polynomial over
+    # a window holding it, with weight h on its own value, so its leave-one-out prediction is y - residual / (1 - h).
+    # Windows are at most half the points, so most points are fitted by the sliding window rather than an edge fit.
+    largest_window = len(y) // 2 if (len(y) // 2) % 2 == 1 else len(y) // 2 - 1
+    if largest_window <= polyorder + 2:
+        return y.copy(), np.nan, np.nan
+    window_lengths = np.unique(np.geomspace(polyorder + 3, largest_window, num=20).astype(int) // 2 * 2 + 1)
+    window_lengths = window_lengths[window_lengths <= largest_window]
+    best = (np.inf, None, None, None)
+    for window_length in window_lengths:
+        y_fit = savgol_filter(y, window_length, polyorder)
+        loo_residuals = (y - y_fit) / (1 - _savitzky_golay_self_weights(len(y), window_length, polyorder))
+        loo_error = np.mean(loo_residuals ** 2)
+        if loo_error < best[0]:
+            best = (loo_error, window_length, y_fit, y - loo_residuals)
+    _, best_window_length, y_fit, loo_prediction = best
+    return y_fit, best_window_length, explained_variance_score(y, loo_prediction)
+
+
+def _savitzky_golay_self_weights(n_points, window_length, polyorder):
+    # The diagonal of the smoother matrix of savgol_filter in its default 'interp' mode: the centre coefficient where
+    # the window slides, and in the first and last half windows, the leverage of each point in the polynomial that is
+    # fitted to the first (or last) window_length points
+    half_window = window_length // 2
+    self_weights = np.full(n_points, savgol_coeffs(window_length, polyorder)[half_window])
+    vandermonde = np.vander(np.arange(window_length) - half_window, polyorder + 1)
+    edge_leverages = np.sum(np.linalg.qr(vandermonde)[0] ** 2, axis=1)
+    self_weights[:half_window] = edge_leverages[:half_window]
+    self_weights[n_points - half_window:] = edge_leverages[window_length - half_window:]
+    return self_weights
+
+
+def _fit_nystroem(X, y, sample_weight, gamma, splits, random_state=None, n_components=100, deadline=None):
+    # Kernel ridge regression on a low rank approximation of the RBF kernel, with gamma chosen as for the SVR
+    def median_val_score(gamma_value):
+        val_scores = []
+        for train, test in splits:
+            model = _nystroem_ridge(gamma_value, len(train), random_state, n_components).fit(
+                X[train], y[train], ridge__sample_weight=sample_weight[train])
+            val_scores.append(explained_variance_score(y[test], model.predict(X[test])))
+        return np.median(val_scores)
+
+    scores = np.array(get_concurrency_budget().parallel(timeout=_time_left(deadline))(
+        delayed(median_val_score)(gamma_value) for gamma_value in gamma))
+    _check_time_budget(deadline)
+    best_gamma = gamma[np.argmax(scores)]
+    model = _nystroem_ridge(best_gamma, len(y), random_state, n_components).fit(X, y,
+                                                                                ridge__sample_weight=sample_weight)
+    return model.predict(X), best_gamma, np.max(scores)
+
+
+def _nystroem_ridge(gamma, n_samples, random_state=None, n_components=100):
+    # alpha = 1 / C matches the regularization of the SVR
+    return make_pipeline(Nystroem(gamma=gamma, n_components=min(n_components, n_samples), random_state=random_state),
+                         Ridge(alpha=1e-3))
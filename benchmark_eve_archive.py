@@ -0,0 +1,106 @@
+# Standard modules
+import sys
+import time
+import resource
+import multiprocessing
+import pandas as pd
+
+# Custom modules
+from eve_archive import convert_eve_csv_to_archive, is_eve_archive, read_eve_archive
+from jpm_logger import JpmLogger
+
+__author__ = 'Tyler J Albee & Shawn A Polson'
+__contact__ = 'tyal7988@colorado.edu'
+
+
+def benchmark_eve_archive(output_path='/Users/tyleralbee/Desktop/StealthCME/',
+                          eve_data_path='/Users/tyleralbee/Desktop/savesets/eve_selected_lines.csv',
+                          archive_path='/Users/tyleralbee/Desktop/savesets/eve_selected_lines_archive/',
+                          n_repeats=3,
+                          verbose=True):
+    """Compare the load time and memory of the EVE lines read from the csv and from the memory-mapped EVE archive.
+
+    Each load runs in a fresh process, so the memory it reports is its own and no load is sped up by another's
+    imports. The time and peak resident memory are measured after the load, and again after one pass over every
+    irradiance (a sum of each line), which is when the archive's pages are actually read. Memory is the growth of the
+    process's peak resident set size over its size before loading.
+
+    Inputs:
+        None.
+
+    Optional Inputs:
+        output_path [str]:   Set to a path for saving the benchmark table and log.
+        eve_data_path [str]: The preprocessed SDO EVE extracted emission lines data (eve_selected_lines.csv).
+        archive_path [str]:  The EVE archive of eve_data_path. Converted from it first if it does not exist.
+        n_repeats [int]:     The number of times to load the data each way. Default is 3.
+        verbose [bool]:      Set to log the processing messages to disk and console. Default is True.
+
+    Outputs:
+        summary [pd DataFrame]: One row per format with its median load time [s], time to load and sum every line
+                                [s], and memory after each [MB]. Also written to benchmark_eve_archive_summary.csv.
+
+    Optional Outputs:
+        None
+
+    Example:
+        summary = benchmark_eve_archive(n_repeats=5)
+    """
+
+    if verbose:
+        logger = JpmLogger(filename='benchmark_eve_archive_log', path=output_path, console=True)
+        logger.info('Starting EVE archive benchmark.')
+
+    if not is_eve_archive(archive_path):
+        t0 = time.time()
+        convert_eve_csv_to_archive(eve_data_path, archive_path)
+        if verbose:
+            logger.info('Converted {0} to an EVE archive in {1:.1f} s.'.format(eve_data_path, time.time() - t0))
+
+    loads = []
+    context = multiprocessing.get_context('spawn')
+    for repeat in range(n_repeats):
+        for data_format, path in (('csv', eve_data_path), ('archive', archive_path)):
+            with context.Pool(1) as pool:
+                load = pool.apply(_timed_load, (data_format, path))
+            load['Format'] = data_format
+            loads.append(load)
+            if verbose:
+                logger.info('Repeat {0} of {1}, {2}: {3}'.format(repeat + 1, n_repeats, data_format, load))
+
+    loads = pd.DataFrame(loads)
+    summary = loads.groupby('Format', sort=False).median()
+    summary.to_csv(output_path + 'benchmark_eve_archive_summary.csv')
+
+    if verbose:
+        logger.info('Median of {0} loads per format:\n{1}'.format(n_repeats, summary.to_string()))
+
+    return summary
+
+
+def _timed_load(data_format, path):
+    # Runs in its own process
+    peak_memory_before = _peak_memory_mb()
+    t0 = time.time()
+    if data_format == 'csv':
+        eve_lines = pd.read_csv(path, index_col=0)
+        eve_lines.index = pd.to_datetime(eve_lines.index)
+    else:
+        eve_lines = read_eve_archive(path)
+    load_time = time.time() - t0
+    load_memory = _peak_memory_mb() - peak_memory_before
+    eve_lines.sum()
+    return {'Rows': len(eve_lines),
+            'Load Time [s]': load_time,
+            'Load And Sum Time [s]': time.time() - t0,
+            'Load Memory [MB]': load_memory,
+            'Load And Sum Memory [MB]': _peak_memory_mb() - peak_memory_before}
+
+
+def _peak_memory_mb():
+    # ru_maxrss is in bytes on macOS and kilobytes on Linux
+    peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_memory / 1e6 if sys.platform == 'darwin' else peak_memory / 1e3
+
+
+if __name__ == '__main__':
+    benchmark_eve_archive(verbose=True)
@@ -0,0 +1,139 @@
+# Standard modules
+import time
+import numpy as np
+import pandas as pd
+import matplotlib.pyplot as plt
+
+# Custom modules
+from automatic_fit_light_curve import automatic_fit_light_curve
+from jpm_logger import JpmLogger
+from concurrency_budget import configure_concurrency
+from eve_archive import read_eve_lines
+
+__author__ = 'Tyler J Albee & Shawn A Polson'
+__contact__ = 'tyal7988@colorado.edu'
+
+
+def benchmark_light_curve_fitting(output_path='/Users/tyleralbee/Desktop/StealthCME/',
+                                  eve_data_path='/Users/tyleralbee/Desktop/savesets/eve_selected_lines.csv',
+                                  methods=('svr', 'spline', 'savgol', 'nystroem'),
+                                  window_rows=360,
+                                  n_windows=20,
+                                  n_lines=5,
+                                  max_training_points=None,
+                                  random_state=0,
+                                  max_threads=None,
+                                  verbose=True):
+    """Compare the runtime and explained variance score of the automatic_fit_light_curve backends on EVE windows.
+
+    Windows of real EVE data are drawn at random, converted to percent of their first irradiance as the correlation
+    scan does, and every selected line of every window is fitted by every method.
+
+    Inputs:
+        None.
+
+    Optional Inputs:
+        output_path [str]:   Set to a path for saving the benchmark tables and log.
+        eve_data_path [str]: The preprocessed SDO EVE extracted emission lines data (eve_selected_lines.csv), or the
+                             EVE archive converted from it (see eve_archive.py).
+        methods [tuple]:     The automatic_fit_light_curve methods to compare. Default is all of them.
+        window_rows [int]:   The number of rows in each window. Default is 360 (6 hours of 1-minute data).
+        n_windows [int]:     The number of windows to draw. Default is 20.
+        n_lines [int]:       The number of emission lines to fit in each window, drawn at random. Default is 5.
+        max_training_points [int]: Set to also fit every line with the 'svr' method subsampled to this many training
+                                   points (method 'svr-subsampled'), and record the RMS of its difference from the
+                                   full 'svr' fit. Default is None.
+        random_state [int]:  Seeds the choice of windows and lines and the fit cross-validation. Default is 0.
+        max_threads [int]:   The most threads the fits may use at once (see concurrency_budget.py). Fix it to compare
+                             runs on different machines. Default is None, meaning all available cores.
+        verbose [bool]:      Set to log the processing messages to disk and console. Default is True.
+
+    Outputs:
+        summary [pd DataFrame]: One row per method with its median and total runtime [s], median score, and the
+                                fraction of fits with a score of at least 0.3 (the default minimum_score).
+                                Also written to benchmark_light_curve_fitting_summary.csv, with every individual fit
+                                in benchmark_light_curve_fitting_fits.csv.
+
+    Optional Outputs:
+        None
+
+    Example:
+        summary = benchmark_light_curve_fitting(n_windows=50, methods=('svr', 'savgol'))
+    """
+
+    if verbose:
+        logger = JpmLogger(filename='benchmark_light_curve_fitting_log', path=output_path, console=True)
+        logger.info('Starting light curve fitting benchmark.')
+
+    concurrency_budget = configure_concurrency(total_threads=max_threads)
+    if verbose:
+        logger.info('Running with {0}.'.format(concurrency_budget))
+
+    eve_lines = read_eve_lines(eve_data_path)
+
+    random_generator = np.random.RandomState(random_state)
+    window_starts = random_generator.randint(0, len(eve_lines) - window_rows, size=n_windows)
+
+    fits = []
+    for i, window_start in enumerate(window_starts):
+        event_time_slice = eve_lines.iloc[window_start:window_start + window_rows]
+        preflare_irradiance = event_time_slice.iloc[0]
+        event_time_slice_percentages = (event_time_slice - preflare_irradiance) / preflare_irradiance * 100.0
+
+        for column in random_generator.choice(eve_lines.columns, size=min(n_lines, len(eve_lines.columns)),
+                                              replace=False):
+            light_curve = pd.DataFrame({'irradiance': event_time_slice_percentages[column]})
+            light_curve['uncertainty'] = 0.002545
+            if light_curve['irradiance'].notnull().sum() < 10:
+                continue
+
+            for method in methods:
+                plt.close('all')
+                t0 = time.time()
+                light_curve_fit, best_fit_gamma, best_fit_score = automatic_fit_light_curve(light_curve, method=method,
+                                                                                            random_state=random_state)
+                fits.append({'Window Start': event_time_slice.index[0], 'Line': column, 'Method': method,
+                             'Runtime [s]': time.time() - t0, 'Score': best_fit_score,
+                             'Hyperparameter': best_fit_gamma})
+                if method == 'svr' and max_training_points is not None:
+                    t0 = time.time()
+                    subsampled_fit, subsampled_gamma, subsampled_score = automatic_fit_light_curve(
+                        light_curve, method=method, random_state=random_state,
+                        max_training_points=max_training_points)
+                    fits.append({'Window Start': event_time_slice.index[0], 'Line': column,
+                                 'Method': 'svr-subsampled', 'Runtime [s]': time.time() - t0,
+                                 'Score': subsampled_score, 'Hyperparameter': subsampled_gamma,
+                                 'RMS Difference From svr': _rms_difference(subsampled_fit, light_curve_fit)})
+
+        if verbose:
+            logger.info('Window {0} of {1} fitted.'.format(i + 1, n_windows))
+
+    fits = pd.DataFrame(fits)
+    fits.to_csv(output_path + 'benchmark_light_curve_fitting_fits.csv', index=False)
+
+    grouped_fits = fits.groupby('Method', sort=False)
+    summary = pd.DataFrame({'Median Runtime [s]': grouped_fits['Runtime [s]'].median(),
+                            'Total Runtime [s]': grouped_fits['Runtime [s]'].sum(),
+                            'Median Score': grouped_fits['Score'].median(),
+                            'Accepted Fraction': grouped_fits['Score'].apply(lambda scores: (scores >= 0.3).mean()),
+                            'Fits': grouped_fits.size()})
+    if 'RMS Difference From svr' in fits:
+        summary['Median RMS Difference From svr'] = grouped_fits['RMS Difference From svr'].median()
+    summary.to_csv(output_path + 'benchmark_light_curve_fitting_summary.csv')
+
+    if verbose:
+        logger.info('Benchmark of {0} fits per method:\n{1}'.format(int(summary['Fits'].iloc[0]),
+                                                                   summary.to_string()))
+
+    return summary
+
+
+def _rms_difference(light_curve_fit, reference_fit):
+    # The fits are np.nan when they were rejected
+    if not isinstance(light_curve_fit, pd.DataFrame) or not isinstance(reference_fit, pd.DataFrame):
+        return np.nan
+    return np.sqrt(np.nanmean((light_curve_fit['irradiance'] - reference_fit['irradiance']) ** 2))
+
+
+if __name__ == '__main__':
+    benchmark_light_curve_fitting(verbose=True)
@@ -0,0 +1,181 @@
+# Standard modules
+import os
+import json
+import time
+import tempfile
+import pandas as pd
+from astropy.time import Time
+
+__author__ = 'Tyler J Albee & Shawn A Polson'
+__contact__ = 'tyal7988@colorado.edu'
+
+
+class CatalogWriter:
+    def __init__(self, filename, columns, flush_rows=100, flush_seconds=60.0):
+        """Write a catalog csv row by row with linear I/O: rows are buffered and appended to one file in batches.
+
+        The rows go to filename + '.partial' until close(), which renames it to filename in one atomic step, so
+        filename only ever holds a finished catalog. The buffer is appended (and synced to disk) once it holds
+        flush_rows rows or flush_seconds have passed since the last append, whichever comes first. After each append,
+        the sidecar filename + '.progress.json' records the rows written so far, the caller's progress marker, and
+        whether the catalog is complete, so a long run can be followed (or its partial catalog used) while it goes.
+
+        Inputs:
+            filename [str]: The catalog csv to write.
+            columns [list]: The catalog columns, written as its header. Rows are written in this column order.
+
+        Optional Inputs:
+            flush_rows [int]:      The number of buffered rows that triggers an append. Default is 100.
+            flush_seconds [float]: The most seconds a row may wait in the buffer before an append. Default is 60.
+
+        Outputs:
+            A CatalogWriter object. Use it in a with statement, or call close() when all rows are added.
+
+        Optional Outputs:
+            None
+
+        Example:
+            with CatalogWriter(output_path + 'stealth_soho_catalog.csv', soho.columns) as catalog_writer:
+                for i in range(len(soho)):
+                    catalog_writer.add(soho.iloc[[i]], progress=i + 1)
+        """
+
+        # Other catalog formats (e.g., the JEDI catalog of jedi_catalog.py) subclass this writer and only replace how
+        # rows are opened, buffered, written, finished, and recorded: the _open, _buffer_rows, _n_buffered,
+        # _write_buffer, _finish, and _write_progress methods
+        self.filename = filename
+        self.columns = list(columns)
+        self.flush_rows = flush_rows
+        self.flush_seconds = flush_seconds
+        self.rows_written = 0
+        self.progress = None
+        self._last_flush_time = time.time()
+        self._closed = False
+
+        self._open()
+        self._write_progress(complete=False)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception, traceback):
+        if exception_type is None:
+            self.close()
+        else:
+            self.flush()  # Keep what was done, in the partial catalog, for inspection
+
+    def add(self, rows, progress=None):
+        """Buffer rows to write, appending the buffer to the partial catalog if it is due.
+
+        Inputs:
+            rows [pd DataFrame or pd Series]: The rows to add, or one row as a Series indexed by column. Columns not in
+                                              the catalog are dropped and missing ones are left empty.
+
+        Optional Inputs:
+            progress [any JSON value]: Set to record how far the run has got (e.g., the next input row) in the
+                                       sidecar with the next append. Default is None, meaning unchanged.
+
+        Outputs:
+            None
+
+        Optional Outputs:
+            None
+
+        Example:
+            catalog_writer.add(jedi_row, progress=t + 1)
+        """
+        if self._closed:
+            raise ValueError('{0} is already closed.'.format(self.filename))
+        self._buffer_rows(rows)
+        if progress is not None:
+            self.progress = progress
+        if self._n_buffered() >= self.flush_rows or time.time() - self._last_flush_time >= self.flush_seconds:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered rows (appended to the partial catalog and synced to disk) and update the progress record.
+
+        Inputs:
+            None.
+
+        Optional Inputs:
+            None
+
+        Outputs:
+            None
+
+        Optional Outputs:
+            None
+
+        Example:
+            catalog_writer.flush()
+        """
+        if self._n_buffered() > 0:
+            self.rows_written += self._write_buffer()
+            self._write_progress(complete=False)
+        self._last_flush_time = time.time()
+
+    def close(self):
+        """Write the remaining rows and finish the catalog: the partial csv is renamed to filename in one atomic step.
+
+        Inputs:
+            None.
+
+        Optional Inputs:
+            None
+
+        Outputs:
+            None
+
+        Optional Outputs:
+            None
+
+        Example:
+            catalog_writer.close()
+        """
+        if self._closed:
+            return
+        self.flush()
+        self._finish()
+        self._closed = True
+        self._write_progress(complete=True)
+
+    def _open(self):
+        self.partial_filename = self.filename + '.partial'
+        self.progress_filename = self.filename + '.progress.json'
+        self._buffer = []
+        pd.DataFrame(columns=self.columns).to_csv(self.partial_filename, header=True, index=False, mode='w')
+
+    def _buffer_rows(self, rows):
+        if isinstance(rows, pd.Series):
+            rows = rows.to_frame().T
+        self._buffer.append(rows.reindex(columns=self.columns))
+
+    def _n_buffered(self):
+        return sum(len(buffered_rows) for buffered_rows in self._buffer)
+
+    def _write_buffer(self):
+        # Append the buffered rows to the partial catalog, synced to disk, and return how many were written
+        rows = pd.concat(self._buffer)
+        with open(self.partial_filename, 'a') as catalog_file:
+            rows.to_csv(catalog_file, header=False, index=False)
+            catalog_file.flush()
+            os.fsync(catalog_file.fileno())
+        self._buffer = []
+        return len(rows)
+
+    def _finish(self):
+        os.replace(self.partial_filename, self.filename)
+
+    def _write_progress(self, complete):
+        # Written to a temporary file and renamed, so the sidecar is never partly written
+        progress = {'catalog': os.path.basename(self.filename),
+                    'rows_written': self.rows_written,
+                    'progress': self.progress,
+                    'complete': complete,
+                    'updated': Time.now().iso}
+        file_descriptor, temporary_filename = tempfile.mkstemp(suffix='.tmp',
+                                                               dir=os.path.dirname(os.path.abspath(self.filename)))
+        with os.fdopen(file_descriptor, 'w') as progress_file:
+            json.dump(progress, progress_file, indent=2)
+        os.replace(temporary_filename, self.progress_filename)
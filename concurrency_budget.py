@@ -0,0 +1,205 @@
+# Standard modules
+import os
+from contextlib import contextmanager
+from joblib import Parallel, parallel_backend
+from threadpoolctl import threadpool_limits
+
+__author__ = 'Tyler J Albee & Shawn A Polson'
+__contact__ = 'tyal7988@colorado.edu'
+
+# Set this environment variable to cap the threads of every pipeline run on a shared node
+MAX_THREADS_ENVIRONMENT_VARIABLE = 'STEALTH_CME_MAX_THREADS'
+
+_concurrency_budget = None
+
+
+class ConcurrencyBudget:
+    def __init__(self, total_threads=None, outer_processes=1, blas_threads=1):
+        """Split a number of threads between the levels of parallelism of the pipelines, so they never multiply past it.
+
+        The levels are the outer processes (e.g., the shards of the correlation scan), the inner joblib workers of each
+        process (the cross-validation fits of automatic_fit_light_curve), and the BLAS threads of each worker. Each
+        outer process gets total_threads // outer_processes threads, which are split into inner workers of
+        blas_threads each, so outer_processes * inner_jobs * blas_threads <= total_threads.
+
+        Inputs:
+            None.
+
+        Optional Inputs:
+            total_threads [int]:   The most threads to use at once. Default is None, meaning the STEALTH_CME_MAX_THREADS
+                                   environment variable if it is set, and otherwise the cores available to this
+                                   process.
+            outer_processes [int]: The number of processes that run side by side. Reduced to at most
+                                   total_threads // blas_threads. Default is 1.
+            blas_threads [int]:    The BLAS threads of each worker. The fits are many small problems that scale better
+                                   across workers than across BLAS threads. Default is 1.
+
+        Outputs:
+            A ConcurrencyBudget object with total_threads, outer_processes, inner_jobs, and blas_threads attributes.
+
+        Optional Outputs:
+            None
+
+        Example:
+            budget = ConcurrencyBudget(outer_processes=8)
+            print(budget)
+        """
+
+        if total_threads is None:
+            total_threads = int(os.environ.get(MAX_THREADS_ENVIRONMENT_VARIABLE, 0)) or available_cores()
+        self.total_threads = max(int(total_threads), 1)
+        self.blas_threads = min(max(int(blas_threads), 1), self.total_threads)
+        self.outer_processes = min(max(int(outer_processes), 1), self.total_threads // self.blas_threads)
+        self.inner_jobs = max(self.total_threads // (self.outer_processes * self.blas_threads), 1)
+
+    def __repr__(self):
+        return ('ConcurrencyBudget({0} threads: {1} processes x {2} workers x {3} BLAS threads)'.format(
+            self.total_threads, self.outer_processes, self.inner_jobs, self.blas_threads))
+
+    def worker_budget(self):
+        """Get the budget of one of the outer processes, for configure_concurrency in that process.
+
+        Inputs:
+            None.
+
+        Optional Inputs:
+            None
+
+        Outputs:
+            budget [ConcurrencyBudget]: A budget of inner_jobs * blas_threads threads in one process.
+
+        Optional Outputs:
+            None
+
+        Example:
+            configure_concurrency(budget.worker_budget())
+        """
+        return ConcurrencyBudget(total_threads=self.inner_jobs * self.blas_threads, blas_threads=self.blas_threads)
+
+    def parallel(self, **parallel_kwargs):
+        """Get a joblib Parallel with inner_jobs workers whose BLAS libraries are limited to blas_threads.
+
+        Inputs:
+            None.
+
+        Optional Inputs:
+            parallel_kwargs [dict]: Any other keyword arguments of joblib.Parallel, e.g., timeout.
+
+        Outputs:
+            parallel [joblib.Parallel]: The pool, ready to call with delayed tasks.
+
+        Optional Outputs:
+            None
+
+        Example:
+            scores = budget.parallel()(delayed(score)(gamma_value) for gamma_value in gamma)
+        """
+        with self.backend():
+            return Parallel(n_jobs=self.inner_jobs, **parallel_kwargs)
+
+    @contextmanager
+    def backend(self):
+        """Make the loky workers started by joblib (including those of scikit-learn's n_jobs) use blas_threads.
+
+        Inputs:
+            None.
+
+        Optional Inputs:
+            None
+
+        Outputs:
+            A context manager.
+
+        Optional Outputs:
+            None
+
+        Example:
+            with budget.backend():
+                validation_curve(model, X, y, 'svr__gamma', gamma, n_jobs=budget.inner_jobs)
+        """
+        with parallel_backend('loky', inner_max_num_threads=self.blas_threads):
+            yield
+
+
+def available_cores():
+    """Get the number of cores this process may run on, which can be fewer than the machine has (e.g., under a
+    batch scheduler).
+
+    Inputs:
+        None.
+
+    Optional Inputs:
+        None
+
+    Outputs:
+        n_cores [int]: The number of cores.
+
+    Optional Outputs:
+        None
+
+    Example:
+        n_cores = available_cores()
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def configure_concurrency(budget=None, limit_blas=False, **budget_settings):
+    """Set the concurrency budget of this process, which the fitting code reads.
+
+    The BLAS threads of the fitting workers are limited through their joblib backend (see ConcurrencyBudget.backend),
+    so the main process keeps all of its BLAS threads for the work it does itself (e.g., the vectorized scan), and its
+    environment is left as it is.
+
+    Inputs:
+        None.
+
+    Optional Inputs:
+        budget [ConcurrencyBudget]: The budget. Default is None, meaning one made from budget_settings.
+        limit_blas [bool]:          Set in a worker process (e.g., a shard of the correlation scan) to also limit the
+                                    BLAS libraries loaded in it to its share of the cores, the budget's total_threads.
+                                    Default is False.
+        budget_settings [dict]:     The keyword arguments of ConcurrencyBudget (total_threads, outer_processes,
+                                    blas_threads), when budget is None.
+
+    Outputs:
+        budget [ConcurrencyBudget]: The budget now in use.
+
+    Optional Outputs:
+        None
+
+    Example:
+        budget = configure_concurrency(total_threads=max_threads, outer_processes=n_processes)
+    """
+    global _concurrency_budget
+    if budget is None:
+        budget = ConcurrencyBudget(**budget_settings)
+    if limit_blas:
+        threadpool_limits(limits=budget.total_threads)
+    _concurrency_budget = budget
+    return budget
+
+
+def get_concurrency_budget():
+    """Get the concurrency budget of this process, set by configure_concurrency.
+
+    Inputs:
+        None.
+
+    Optional Inputs:
+        None
+
+    Outputs:
+        budget [ConcurrencyBudget]: The budget. If configure_concurrency has not been called, a budget of all of the
+                                    threads allowed (see ConcurrencyBudget) for this one process.
+
+    Optional Outputs:
+        None
+
+    Example:
+        n_jobs = get_concurrency_budget().inner_jobs
+    """
+    if _concurrency_budget is None:
+        return ConcurrencyBudget()
+    return _concurrency_budget
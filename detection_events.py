@@ -0,0 +1,175 @@
+# Standard modules
+import heapq
+import itertools  # Only to read checkpoints pickled when the sequence was an itertools.count
+import pandas as pd
+
+__author__ = 'Tyler J Albee & Shawn A Polson'
+__contact__ = 'tyal7988@colorado.edu'
+
+
+class DetectionEvents:
+    def __init__(self, max_events=None, max_group_windows=10000):
+        """Merge overlapping detection windows into events with non-maximum suppression, keeping the best max_events.
+
+        Detections are added in time order, as the scan produces them. Windows that overlap (directly or through a chain
+        of overlapping windows) are held as one open group until a window arrives that starts after the group ends. The
+        closed group is then reduced by non-maximum suppression: its highest scoring window becomes an event peak, every
+        window that overlaps the peak is folded into that event's extent, and the rest of the group is reduced the same
+        way. Closed events go into a min-heap of at most max_events, keyed by peak score, so memory and output stay
+        proportional to the number of events kept rather than the number of windows that crossed the threshold. An open
+        group is also closed once it holds max_group_windows windows, so a long unbroken run of overlapping detections
+        cannot grow it without limit; such a run is then reported as several events.
+
+        Inputs:
+            None.
+
+        Optional Inputs:
+            max_events [int]:        The number of highest scoring events to keep. Default is None, meaning all of
+                                     them.
+            max_group_windows [int]: The most windows held in the open group before it is closed. Default is 10000.
+
+        Outputs:
+            A DetectionEvents object. Its events() method returns the event catalog.
+
+        Optional Outputs:
+            None
+
+        Example:
+            detection_events = DetectionEvents(max_events=100)
+            for window_starts in batches:
+                detection_events.add(score_windows(eve_lines, cme_template, window_starts, fit_light_curves=False))
+            events = detection_events.events()
+        """
+
+        if max_events is not None and max_events < 1:
+            raise ValueError('max_events must be at least 1, got {0}.'.format(max_events))
+        if max_group_windows < 1:
+            raise ValueError('max_group_windows must be at least 1, got {0}.'.format(max_group_windows))
+        self.max_events = max_events
+        self.max_group_windows = max_group_windows
+        self.n_windows = 0
+        self._heap = []  # (peak score, sequence number, event) with the lowest scoring event on top
+        self._sequence = 0  # A plain int, so the object pickles (into the scan checkpoint) on every Python version
+        self._open_group = []  # Detection rows (as dicts) of the overlapping windows not yet closed
+        self._open_group_end = None
+        self._detection_columns = None
+
+    def add(self, detections):
+        """Add detections, in time order and after any detections added before.
+
+        Inputs:
+            detections [pd DataFrame]: Detections as returned by score_windows, with at least 'Start Time',
+                                       'End Time', and 'Correlation Coefficient' columns.
+
+        Optional Inputs:
+            None
+
+        Outputs:
+            None
+
+        Optional Outputs:
+            None
+
+        Example:
+            detection_events.add(batch_detections)
+        """
+        if self._detection_columns is None:
+            self._detection_columns = list(detections.columns)
+        for detection in detections.to_dict('records'):
+            if self._open_group and (detection['Start Time'] > self._open_group_end or
+                                     len(self._open_group) >= self.max_group_windows):
+                self._close_group()
+            self._open_group.append(detection)
+            if self._open_group_end is None or detection['End Time'] > self._open_group_end:
+                self._open_group_end = detection['End Time']
+            self.n_windows += 1
+
+    def events(self):
+        """Get the kept events in time order, including those of the group still open.
+
+        The open group is reduced without being closed, so more detections can still be added after this.
+
+        Inputs:
+            None.
+
+        Optional Inputs:
+            None
+
+        Outputs:
+            events [pd DataFrame]: One row per event with its extent ('Start Time' of its first window to 'End Time'
+                                   of its last), the start of its best window ('Peak Time'), the best window's
+                                   'Correlation Coefficient' and other detection columns, and the number of windows
+                                   merged into it ('Windows Merged').
+
+        Optional Outputs:
+            None
+
+        Example:
+            events = detection_events.events()
+        """
+        events = [event for _, _, event in self._heap]
+        events += _suppress_non_maxima(self._open_group)
+        if self.max_events is not None:
+            events = heapq.nlargest(self.max_events, events, key=lambda event: event['Correlation Coefficient'])
+        events.sort(key=lambda event: event['Start Time'])
+        return pd.DataFrame(events, columns=self.columns())
+
+    def columns(self):
+        """Get the columns of the event catalog, which follow those of the detections added.
+
+        Inputs:
+            None.
+
+        Optional Inputs:
+            None
+
+        Outputs:
+            columns [list]: The event catalog columns, without 'Event #'.
+
+        Optional Outputs:
+            None
+
+        Example:
+            output_columns = ['Event #'] + detection_events.columns()
+        """
+        detection_columns = self._detection_columns or ['Start Time', 'End Time', 'Correlation Coefficient']
+        return (['Start Time', 'End Time', 'Peak Time', 'Correlation Coefficient', 'Windows Merged'] +
+                [column for column in detection_columns
+                 if column not in ('Start Time', 'End Time', 'Correlation Coefficient')])
+
+    def __setstate__(self, state):
+        # Checkpoints written before the open group was capped hold an itertools.count and no max_group_windows
+        if not isinstance(state['_sequence'], int):
+            state['_sequence'] = next(state['_sequence'])
+        state.setdefault('max_group_windows', 10000)
+        self.__dict__.update(state)
+
+    def _close_group(self):
+        for event in _suppress_non_maxima(self._open_group):
+            self._sequence += 1
+            entry = (event['Correlation Coefficient'], self._sequence, event)
+            if self.max_events is None or len(self._heap) < self.max_events:
+                heapq.heappush(self._heap, entry)
+            elif entry[0] > self._heap[0][0]:
+                heapq.heapreplace(self._heap, entry)
+        self._open_group = []
+        self._open_group_end = None
+
+
+def _suppress_non_maxima(detections):
+    # Greedy non-maximum suppression: the best remaining window is a peak and absorbs every window that overlaps it
+    remaining = sorted(detections, key=lambda detection: detection['Correlation Coefficient'], reverse=True)
+    events = []
+    while remaining:
+        peak = remaining[0]
+        overlaps_peak = [detection['Start Time'] <= peak['End Time'] and detection['End Time'] >= peak['Start Time']
+                         for detection in remaining]
+        merged = [detection for detection, overlaps in zip(remaining, overlaps_peak) if overlaps]
+        remaining = [detection for detection, overlaps in zip(remaining, overlaps_peak) if not overlaps]
+        event = dict(peak)
+        event['Start Time'] = min(detection['Start Time'] for detection in merged)
+        event['End Time'] = max(detection['End Time'] for detection in merged)
+        event['Peak Time'] = peak['Start Time']
+        event['Windows Merged'] = len(merged)
+        events.append(event)
+    return events
@@ -0,0 +1,163 @@
+# Standard modules
+import numpy as np
+import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy.ndimage import minimum_filter1d
+
+# Custom modules
+from sliding_window_correlation import sliding_window_starts
+
+__author__ = 'Tyler J Albee & Shawn A Polson'
+__contact__ = 'tyal7988@colorado.edu'
+
+
+def dimming_prefilter(data, window_rows, window_stride=60, window_starts=None, baseline_rows=60, smooth_rows=10,
+                      z_threshold=3.0, min_lines=3, block_windows=1024):
+    """Cheaply flag the sliding windows in which several lines dim, so only those go on to be fitted and scored.
+
+    The first baseline_rows of each window are its pre-event baseline, as for the signature, whose windows start
+    before the dimming and are converted to percent of their first row. The robust z-score of a line's drop is
+    (baseline median - lowest smooth_rows point running mean in the rest of the window) / (1.4826 * baseline median
+    absolute deviation / sqrt(smooth_rows)). A window passes if at least min_lines lines drop by z_threshold or more.
+    The running means are computed once for all rows from cumulative sums, and so is the lowest of the running means
+    that each row starts, with a running minimum filter. The windows are then processed in blocks of strided views of
+    their baselines, so the cost is a few passes over the data.
+
+    Inputs:
+        data [np.array]:   A 2-D array (rows x lines) of the raw light curves to scan, e.g., eve_lines.values.
+        window_rows [int]: The number of rows in each window, i.e., the length of the CME signature.
+
+    Optional Inputs:
+        window_stride [int]:      The number of rows to advance the window. Default is 60.
+        window_starts [np.array]: Set to test only these window start rows. Default is None, meaning every window from
+                                  row 0.
+        baseline_rows [int]:      The number of rows at the start of each window that make up its baseline.
+                                  Default is 60 (1 hour of 1-minute EVE data).
+        smooth_rows [int]:        The number of rows averaged to find the lowest point, which beats down the noise
+                                  by sqrt(smooth_rows). Default is 10.
+        z_threshold [float]:      The robust z-score a line must drop by to count as dimming. Default is 3.
+        min_lines [int]:          The number of lines that must dim for a window to pass. Default is 3.
+        block_windows [int]:      The number of windows to test at a time. Bounds the memory used. Default is 1024.
+
+    Outputs:
+        window_starts [np.array]: The first row index of each tested window.
+        passed [np.array]:        True for the windows that passed.
+        drop_z_scores [np.array]: A 2-D array (windows x lines) of the robust z-score of each line's drop. NaN where
+                                  a line has no finite baseline or a constant one.
+
+    Optional Outputs:
+        None
+
+    Example:
+        window_starts, passed, drop_z_scores = dimming_prefilter(eve_lines.values, len(cme_event), window_stride=1)
+        print('{0:.1%} of windows passed'.format(passed.mean()))
+    """
+    data = np.asarray(data, dtype=np.float64)
+    if data.ndim == 1:
+        data = data.reshape(-1, 1)
+    search_rows = window_rows - baseline_rows - smooth_rows + 1
+    if search_rows < 1:
+        raise ValueError('window_rows ({0}) must be longer than baseline_rows ({1}) plus smooth_rows ({2}).'.format(
+            window_rows, baseline_rows, smooth_rows))
+    if window_starts is None:
+        window_starts = sliding_window_starts(data.shape[0], window_rows, window_stride)
+    window_starts = np.asarray(window_starts, dtype=int)
+    drop_z_scores = np.full((len(window_starts), data.shape[1]), np.nan)
+    if len(window_starts) == 0:
+        return window_starts, np.zeros(0, dtype=bool), drop_z_scores
+
+    # The running mean of every smooth_rows rows, NaN where any of them is NaN
+    finite = np.isfinite(data)
+    zero_row = np.zeros((1, data.shape[1]))
+    running_sum = np.concatenate((zero_row, np.cumsum(np.where(finite, data, 0.0), axis=0)))
+    running_count = np.concatenate((zero_row, np.cumsum(finite, axis=0)))
+    window_sum = running_sum[smooth_rows:] - running_sum[:-smooth_rows]
+    window_count = running_count[smooth_rows:] - running_count[:-smooth_rows]
+    running_mean = np.where(window_count == smooth_rows, window_sum / smooth_rows, np.nan)
+
+    # The lowest running mean of the search_rows starting at each row, skipping NaNs as fmin does. minimum_filter1d
+    # centres its window on the row, so its output is shifted to start the window there.
+    lowest_running_mean = minimum_filter1d(np.where(np.isnan(running_mean), np.inf, running_mean), search_rows,
+                                           axis=0)[search_rows // 2:]
+    lowest_running_mean[lowest_running_mean == np.inf] = np.nan
+
+    baselines = sliding_window_view(data, baseline_rows, axis=0)  # rows x lines x baseline_rows
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for block_start in range(0, len(window_starts), block_windows):
+            block_window_starts = window_starts[block_start:block_start + block_windows]
+            baseline = baselines[block_window_starts]
+            baseline_median = np.nanmedian(baseline, axis=2)
+            baseline_sigma = 1.4826 * np.nanmedian(np.abs(baseline - baseline_median[:, :, np.newaxis]), axis=2)
+            lowest = lowest_running_mean[block_window_starts + baseline_rows]
+            drop_z_scores[block_start:block_start + len(block_window_starts)] = np.where(
+                baseline_sigma > 0, (baseline_median - lowest) * np.sqrt(smooth_rows) / baseline_sigma, np.nan)
+
+    passed = (drop_z_scores >= z_threshold).sum(axis=1) >= min_lines  # NaN never counts as a drop
+    return window_starts, passed, drop_z_scores
+
+
+def labeled_event_times(labeled_catalog_path):
+    """Get the times of the CMEs labeled as stealth CMEs in the SOHO catalog with the "Stealth?" column.
+
+    Inputs:
+        labeled_catalog_path [str]: The labeled catalog, e.g., the stealth_soho_catalog_best_window.csv.
+
+    Optional Inputs:
+        None
+
+    Outputs:
+        event_times [pd DatetimeIndex]: The time of each stealth CME, in time order.
+
+    Optional Outputs:
+        None
+
+    Example:
+        event_times = labeled_event_times('Labeled SOHO Catalog/stealth_soho_catalog_best_window.csv')
+    """
+    soho_catalog = pd.read_csv(labeled_catalog_path)
+    stealth_cmes = soho_catalog[soho_catalog['Stealth?'] == 'yes']
+    return pd.DatetimeIndex(pd.to_datetime(stealth_cmes['Date'] + ' ' + stealth_cmes['Time'])).sort_values()
+
+
+def prefilter_recall(window_start_times, window_end_times, passed, event_times):
+    """Get the fraction of known events that at least one passing window covers, out of those any window covers.
+
+    Inputs:
+        window_start_times [pd DatetimeIndex]: The first time of each tested window, in time order.
+        window_end_times [pd DatetimeIndex]:   The last time of each tested window.
+        passed [np.array]:                     True for the windows that passed dimming_prefilter.
+        event_times [pd DatetimeIndex]:        The times of the known events, e.g., from labeled_event_times().
+
+    Optional Inputs:
+        None
+
+    Outputs:
+        recall [float]:  The fraction of the covered events that a passing window covers. NaN if none are covered.
+        n_events [int]:  The number of events covered by any tested window.
+
+    Optional Outputs:
+        None
+
+    Example:
+        recall, n_events = prefilter_recall(eve_lines.index[window_starts],
+                                            eve_lines.index[window_starts + len(cme_event) - 1], passed, event_times)
+    """
+    window_start_times = np.asarray(window_start_times, dtype='datetime64[ns]')
+    window_end_times = np.asarray(window_end_times, dtype='datetime64[ns]')
+    event_times = np.asarray(event_times, dtype='datetime64[ns]')
+
+    # The windows that cover an event are those that start at or before it and end at or after it. Counting the
+    # windows (and passing windows) that start by each time and end before it gives how many cover it.
+    end_order = np.argsort(window_end_times, kind='stable')
+    sorted_end_times = window_end_times[end_order]
+    passed_by_start = np.concatenate(([0], np.cumsum(passed)))
+    passed_by_end = np.concatenate(([0], np.cumsum(np.asarray(passed)[end_order])))
+    started = np.searchsorted(window_start_times, event_times, side='right')
+    ended = np.searchsorted(sorted_end_times, event_times, side='left')
+    covering_windows = started - ended
+    covering_passed = passed_by_start[started] - passed_by_end[ended]
+
+    covered = covering_windows > 0
+    if not covered.any():
+        return np.nan, 0
+    return float(np.mean(covering_passed[covered] > 0)), int(covered.sum())
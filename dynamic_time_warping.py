@@ -0,0 +1,212 @@
+# Standard modules
+from collections import OrderedDict
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+# Custom modules
+from sliding_window_correlation import sliding_window_starts
+
+__author__ = 'Tyler J Albee & Shawn A Polson'
+__contact__ = 'tyal7988@colorado.edu'
+
+
+def keogh_envelope(template, band_rows):
+    """Get the upper and lower envelope of a template over a Sakoe-Chiba band, as used by the LB_Keogh lower bound.
+
+    Inputs:
+        template [np.array]: A 2-D array (template rows x lines).
+        band_rows [int]:     The half width of the Sakoe-Chiba band in rows.
+
+    Optional Inputs:
+        None
+
+    Outputs:
+        upper [np.array]: A 2-D array (template rows x lines) of the template maximum within band_rows of each row.
+        lower [np.array]: A 2-D array (template rows x lines) of the template minimum within band_rows of each row.
+
+    Optional Outputs:
+        None
+
+    Example:
+        upper, lower = keogh_envelope(z_normalized_template, band_rows=30)
+    """
+    template = np.asarray(template, dtype=np.float64)
+    padding = ((band_rows, band_rows), (0, 0))
+    upper = sliding_window_view(np.pad(template, padding, constant_values=-np.inf), 2 * band_rows + 1, axis=0)
+    lower = sliding_window_view(np.pad(template, padding, constant_values=np.inf), 2 * band_rows + 1, axis=0)
+    return upper.max(axis=2), lower.min(axis=2)
+
+
+def dtw_sliding_window_correlation(data, template, band_rows, correlation_threshold, window_stride=60,
+                                   window_starts=None, block_windows=4096, chunk_windows=256):
+    """Score every sliding window of data against a template with dynamic time warping, pruning with lower bounds.
+
+    Each line of each window and of the template is z-normalized, and the squared-difference DTW distance D between
+    them is found within a Sakoe-Chiba band of band_rows. It is reported on the scale of a correlation coefficient as
+    1 - D / (2 * template rows), which is exactly the Pearson correlation coefficient when band_rows is 0 (no warping)
+    and can only grow as the band widens, so stretched or compressed events score closer to a perfect match.
+
+    A window is kept when its coefficients summed over all lines reach correlation_threshold, i.e., when its DTW
+    distances sum to no more than a budget. Most windows are discarded before any DTW is run by a cascade of lower
+    bounds on that sum: LB_Kim (the first and last rows, which every warping path must match) and then LB_Keogh (the
+    distance from each window row to the template envelope). Survivors are warped row by row, and a window is
+    abandoned as soon as its partial distances plus the LB_Keogh bound of its remaining rows exceed the budget.
+
+    Inputs:
+        data [np.array]:              A 2-D array (rows x lines) of the light curves to scan, e.g., eve_lines.values.
+        template [np.array]:          A 2-D array (template rows x lines) of the CME signature, with its columns in
+                                      the same order as data.
+        band_rows [int]:              The most rows a point of a window may be matched away from its place in the
+                                      template.
+        correlation_threshold [float]: The minimum total coefficient (summed over all lines) of a window to score it
+                                       completely.
+
+    Optional Inputs:
+        window_stride [int]:      The number of rows to advance the window between scores. Default is 60.
+        window_starts [np.array]: Set to score only these window start rows, which must be increasing and spaced by
+                                  window_stride. Default is None, meaning every window from row 0.
+        block_windows [int]:      The number of windows whose statistics are computed together. The same as
+                                  sliding_window_correlation, so scans split with correlation_block_windows() give
+                                  the same result as one pass. Default is 4096.
+        chunk_windows [int]:      The number of windows warped together. Bounds memory. Default is 256.
+
+    Outputs:
+        window_starts [np.array]:                The first row index of each scored window.
+        dtw_correlation_coefficients [np.array]: A 2-D array (windows x lines) of DTW correlation coefficients. NaN
+                                                 for windows that contain a NaN or were pruned below the threshold.
+        pruned_windows [OrderedDict]:            The number of windows that were discarded for containing NaN or a
+                                                 flat line, by LB_Kim, by LB_Keogh, and by early abandoning, and the
+                                                 number whose DTW distance was computed in full.
+
+    Optional Outputs:
+        None
+
+    Example:
+        window_starts, dtw_correlation_coefficients, pruned_windows = dtw_sliding_window_correlation(
+            eve_lines.values, cme_event[eve_lines.columns].values, band_rows=30, correlation_threshold=4.2)
+    """
+    data = np.asarray(data, dtype=np.float64)
+    template = np.array(template, dtype=np.float64, order='C')
+    if data.ndim == 1:
+        data = data.reshape(-1, 1)
+    if template.ndim == 1:
+        template = template.reshape(-1, 1)
+    if data.shape[1] != template.shape[1]:
+        raise ValueError('data has {0} lines but template has {1}.'.format(data.shape[1], template.shape[1]))
+    if band_rows < 0:
+        raise ValueError('band_rows must be >= 0, got {0}.'.format(band_rows))
+
+    window_rows, n_lines = template.shape
+    band_rows = min(int(band_rows), window_rows - 1)
+    if window_starts is None:
+        window_starts = sliding_window_starts(data.shape[0], window_rows, window_stride)
+    window_starts = np.asarray(window_starts, dtype=int)
+    dtw_correlation_coefficients = np.full((len(window_starts), n_lines), np.nan)
+    pruned_windows = OrderedDict([('NaN', 0), ('LB_Kim', 0), ('LB_Keogh', 0), ('early abandon', 0), ('full DTW', 0)])
+
+    # Windows whose DTW distances sum to more than this cannot reach the threshold
+    distance_budget = 2.0 * window_rows * (n_lines - correlation_threshold)
+
+    z_template = (template - np.mean(template, axis=0)) / np.std(template, axis=0)  # template rows x lines
+    upper, lower = keogh_envelope(z_template, band_rows)
+    z_template, upper, lower = z_template.T, upper.T, lower.T  # lines x template rows, to match the windows
+
+    for block_start in range(0, len(window_starts), block_windows):
+        block_window_starts = window_starts[block_start:block_start + block_windows]
+        first_row = block_window_starts[0]
+        last_row = block_window_starts[-1] + window_rows
+        block = np.array(data[first_row:last_row], order='C')  # See template_bank_correlation
+
+        # Window statistics from running sums, exactly as in template_bank_correlation
+        finite = np.isfinite(block)
+        block_center = np.where(finite, block, 0.0).sum(axis=0) / np.maximum(finite.sum(axis=0), 1)
+        x = np.where(finite, block - block_center, 0.0)
+        zero_row = np.zeros((1, n_lines))
+        sum_x = np.concatenate((zero_row, np.cumsum(x, axis=0)))
+        sum_x2 = np.concatenate((zero_row, np.cumsum(x * x, axis=0)))
+        nan_count = np.concatenate((zero_row, np.cumsum(~finite, axis=0)))
+
+        local_starts = block_window_starts - first_row
+        local_ends = local_starts + window_rows
+        window_mean = (sum_x[local_ends] - sum_x[local_starts]) / window_rows
+        window_variance = (sum_x2[local_ends] - sum_x2[local_starts]) / window_rows - window_mean ** 2
+        window_std = np.sqrt(np.clip(window_variance, 0.0, None))
+        valid = ((nan_count[local_ends] - nan_count[local_starts]) == 0).all(axis=1) & (window_std > 0).all(axis=1)
+        pruned_windows['NaN'] += int((~valid).sum())
+
+        # LB_Kim: every warping path matches the first rows and the last rows to each other
+        with np.errstate(divide='ignore', invalid='ignore'):
+            z_first = (x[local_starts] - window_mean) / window_std
+            z_last = (x[local_ends - 1] - window_mean) / window_std
+        lb_kim = ((z_first - z_template[:, 0]) ** 2 + (z_last - z_template[:, -1]) ** 2).sum(axis=1)
+        survivors = np.flatnonzero(valid & (lb_kim <= distance_budget))
+        pruned_windows['LB_Kim'] += int(valid.sum()) - len(survivors)
+
+        windows = sliding_window_view(x, window_rows, axis=0)  # offsets x lines x window rows
+        for chunk_start in range(0, len(survivors), chunk_windows):
+            chunk = survivors[chunk_start:chunk_start + chunk_windows]
+            z_windows = ((windows[local_starts[chunk]] - window_mean[chunk, :, np.newaxis]) /
+                         window_std[chunk, :, np.newaxis])  # windows x lines x window rows
+
+            # LB_Keogh: every window row is matched to a template row within the band, so it costs at least its
+            # distance to the template envelope there
+            keogh_rows = (np.where(z_windows > upper, z_windows - upper, 0.0) ** 2 +
+                          np.where(z_windows < lower, lower - z_windows, 0.0) ** 2)
+            keogh_remaining = np.cumsum(keogh_rows[:, :, ::-1], axis=2)[:, :, ::-1]  # Bound of rows j onward
+            keep = keogh_remaining[:, :, 0].sum(axis=1) <= distance_budget
+            pruned_windows['LB_Keogh'] += int((~keep).sum())
+            chunk, z_windows, keogh_remaining = chunk[keep], z_windows[keep], keogh_remaining[keep]
+
+            distances = _banded_dtw(z_windows, z_template, band_rows, keogh_remaining, distance_budget)
+            finished = np.isfinite(distances).all(axis=1)
+            pruned_windows['early abandon'] += int((~finished).sum())
+            pruned_windows['full DTW'] += int(finished.sum())
+            dtw_correlation_coefficients[block_start + chunk[finished]] = \
+                1.0 - distances[finished] / (2.0 * window_rows)
+
+    return window_starts, dtw_correlation_coefficients, pruned_windows
+
+
+def _banded_dtw(z_windows, z_template, band_rows, keogh_remaining, distance_budget):
+    # The cost matrix is kept one template row at a time, indexed by the offset k = j - i + band_rows of window row j
+    # from the diagonal, for all windows and lines at once. Windows are dropped (left at inf) once their lower bound
+    # exceeds the budget.
+    n_windows, n_lines, window_rows = z_windows.shape
+    band_width = 2 * band_rows + 1
+    distances = np.full((n_windows, n_lines), np.inf)
+    active = np.arange(n_windows)
+
+    previous = np.full((n_windows, n_lines, band_width + 1), np.inf)  # The extra column stands for cells off the band
+    previous[:, :, band_rows] = 0.0  # A virtual row before the first, so every path starts at (0, 0)
+    offsets = np.arange(band_width)
+    for i in range(window_rows):
+        columns = i + offsets - band_rows
+        in_band = (columns >= 0) & (columns < window_rows)
+        cost = (z_windows[:, :, np.clip(columns, 0, window_rows - 1)] - z_template[:, i, np.newaxis]) ** 2
+        cost[:, :, ~in_band] = 0.0
+
+        # Step from (i - 1, j - 1) or (i - 1, j), then along the row from (i, j - 1). The sweep along the row,
+        # D[k] = cost[k] + min(vertical[k], D[k - 1]), is the prefix scan D[k] = C[k] + min over m <= k of
+        # (vertical[m] - C[m - 1]), with C the running sum of the row costs.
+        vertical = np.minimum(previous[:, :, :band_width], previous[:, :, 1:])
+        vertical[:, :, ~in_band] = np.inf
+        running_cost = np.cumsum(cost, axis=2)
+        current = np.full(previous.shape, np.inf)
+        current[:, :, :band_width] = running_cost + np.minimum.accumulate(vertical - (running_cost - cost), axis=2)
+        current[:, :, np.flatnonzero(~in_band)] = np.inf
+        previous = current
+
+        # Early abandon: the best partial path, plus the LB_Keogh bound of the window rows that no path has reached
+        next_row = i + band_rows + 1
+        lower_bound = current[:, :, :band_width].min(axis=2)
+        if next_row < window_rows:
+            lower_bound = lower_bound + keogh_remaining[:, :, next_row]
+        keep = lower_bound.sum(axis=1) <= distance_budget
+        if not keep.all():
+            active, previous = active[keep], previous[keep]
+            z_windows, keogh_remaining = z_windows[keep], keogh_remaining[keep]
+            if len(active) == 0:
+                break
+
+    distances[active] = previous[:, :, band_rows]
+    return distances
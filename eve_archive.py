@@ -0,0 +1,469 @@
+# Standard modules
+import os
+import json
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+
+__author__ = 'Tyler J Albee & Shawn A Polson'
+__contact__ = 'tyal7988@colorado.edu'
+
+# Bump this whenever the layout of the archive files changes
+ARCHIVE_VERSION = 2
+
+# The archive is a directory holding this header and one raw binary file for the times and for each line
+HEADER_FILENAME = 'eve_archive.json'
+TIME_FILENAME = 'time.int64'
+
+NANOSECONDS_PER_DAY = 86400 * 10 ** 9
+
+
+class EveArchive:
+    def __init__(self, archive_path):
+        """Open an EVE archive to read time windows of it, each for the cost of a binary search and the window's rows.
+
+        The header's day index partitions the column files by day. read_window binary searches the index for the days
+        a window touches, then the times of only those days for its first and last rows, and memory-maps just those
+        rows of each line, so slicing an event out of a multi-year archive takes O(log n + window) time and memory,
+        rather than the O(n) of loading the whole archive and masking its index.
+
+        Inputs:
+            archive_path [str]: The archive directory, made by convert_eve_csv_to_archive or append_eve_archive.
+
+        Optional Inputs:
+            None
+
+        Outputs:
+            An EveArchive object. Its columns attribute holds the line names and len() gives its number of rows.
+
+        Optional Outputs:
+            None
+
+        Example:
+            eve_archive = EveArchive('/Users/tyleralbee/Desktop/savesets/eve_selected_lines_archive/')
+            eve_lines_event = eve_archive.read_window('2010-08-07 17:12:11', '2010-08-07 21:18:11')
+        """
+
+        self.archive_path = archive_path
+        self.header = read_eve_archive_header(archive_path)
+        self.n_rows = self.header['n_rows']
+        self.columns = pd.Index([line['name'] for line in self.header['lines']])
+        self._line_filenames = {line['name']: line['filename'] for line in self.header['lines']}
+        self._day_numbers = np.array([day for day, _ in self.header['days']], dtype='datetime64[D]').astype(np.int64)
+        self._day_first_rows = np.array([first_row for _, first_row in self.header['days']] + [self.n_rows],
+                                        dtype=np.int64)
+
+    def __len__(self):
+        return self.n_rows
+
+    def __repr__(self):
+        return 'EveArchive({0}: {1} rows of {2} lines over {3} days)'.format(self.archive_path, self.n_rows,
+                                                                           len(self.columns), len(self._day_numbers))
+
+    def read_window(self, start, end, lines=None):
+        """Read the rows from start to end (both included) as a DataFrame, like the csv sliced to the same times.
+
+        Inputs:
+            start [str or datetime]: The first time of the window.
+            end [str or datetime]:   The last time of the window.
+
+        Optional Inputs:
+            lines [list]: Set to the names of the lines to read. Default is None, meaning all of them.
+
+        Outputs:
+            eve_lines_event [pd DataFrame]: The EVE lines in the window with a DatetimeIndex. Empty if none are in it.
+
+        Optional Outputs:
+            None
+
+        Example:
+            eve_lines_event = eve_archive.read_window(dateTime - timedelta(hours=1.5), dateTime + timedelta(hours=4))
+        """
+        first_row, last_row = self.window_rows(start, end)
+        return self.read_rows(first_row, last_row, lines=lines)
+
+    def window_rows(self, start, end):
+        """Get the row range of the times from start to end (both included) by binary search.
+
+        Inputs:
+            start [str or datetime]: The first time of the window.
+            end [str or datetime]:   The last time of the window.
+
+        Optional Inputs:
+            None
+
+        Outputs:
+            first_row [int]: The first row at or after start.
+            last_row [int]:  One past the last row at or before end.
+
+        Optional Outputs:
+            None
+
+        Example:
+            first_row, last_row = eve_archive.window_rows('2010-08-07 17:12:11', '2010-08-07 21:18:11')
+        """
+        start_ns = pd.Timestamp(start).value
+        end_ns = pd.Timestamp(end).value
+        first_day = max(np.searchsorted(self._day_numbers, start_ns // NANOSECONDS_PER_DAY, side='right') - 1, 0)
+        last_day = np.searchsorted(self._day_numbers, end_ns // NANOSECONDS_PER_DAY, side='right') - 1
+        if end_ns < start_ns or last_day < first_day:
+            return 0, 0
+
+        # Only the times of the days the window touches are searched
+        partition_first_row = self._day_first_rows[first_day]
+        times = _memory_map(os.path.join(self.archive_path, TIME_FILENAME), np.int64,
+                            self._day_first_rows[last_day + 1] - partition_first_row, first_row=partition_first_row)
+        return (int(partition_first_row + np.searchsorted(times, start_ns, side='left')),
+                int(partition_first_row + np.searchsorted(times, end_ns, side='right')))
+
+    def read_rows(self, first_row=0, last_row=None, lines=None):
+        """Memory-map a range of rows as a DataFrame.
+
+        Inputs:
+            None.
+
+        Optional Inputs:
+            first_row [int]: The first row to read. Default is 0.
+            last_row [int]:  One past the last row to read. Default is None, meaning to the end of the archive.
+            lines [list]:    Set to the names of the lines to read. Default is None, meaning all of them.
+
+        Outputs:
+            eve_lines [pd DataFrame]: The EVE lines in the rows with a DatetimeIndex.
+
+        Optional Outputs:
+            None
+
+        Example:
+            eve_lines = eve_archive.read_rows(first_row=checkpoint['n_rows'])
+        """
+        if lines is None:
+            lines = list(self.columns)
+        missing_lines = [name for name in lines if name not in self._line_filenames]
+        if missing_lines:
+            raise ValueError('{0} has no lines {1}.'.format(self.archive_path, missing_lines))
+        first_row = min(max(first_row, 0), self.n_rows)
+        last_row = self.n_rows if last_row is None else min(max(last_row, first_row), self.n_rows)
+
+        times = _memory_map(os.path.join(self.archive_path, TIME_FILENAME), np.int64, last_row - first_row,
+                            first_row=first_row)
+        index = pd.DatetimeIndex(np.asarray(times).view('datetime64[ns]'), name=self.header['index_name'])
+        irradiances = {name: _memory_map(os.path.join(self.archive_path, self._line_filenames[name]),
+                                         self.header['line_dtype'], last_row - first_row, first_row=first_row)
+                       for name in lines}
+        return pd.DataFrame(irradiances, index=index, columns=lines, copy=False)  # copy=False keeps the memory maps
+
+
+def convert_eve_csv_to_archive(csv_path, archive_path, chunk_rows=100000, line_dtype='float64', overwrite=False,
+                               verbose=False, logger=None):
+    """Convert the EVE extracted emission lines csv to a columnar binary archive that read_eve_archive memory-maps.
+
+    The csv is read in chunks of chunk_rows, so the conversion needs little memory however long the data set is. Each
+    chunk is appended with append_eve_archive.
+
+    Inputs:
+        csv_path [str]:     The preprocessed SDO EVE extracted emission lines data (eve_selected_lines.csv).
+        archive_path [str]: The directory to write the archive to.
+
+    Optional Inputs:
+        chunk_rows [int]:  The number of csv rows to convert at a time. Default is 100000.
+        line_dtype [str]:  The type to store the irradiances as. 'float32' halves the size of the archive at the cost
+                           of precision. Default is 'float64', which keeps the values of the csv exactly.
+        overwrite [bool]:  Set to replace an archive already at archive_path. Default is False, which raises an error.
+                           Anything at archive_path other than an EVE archive is never replaced.
+        verbose [bool]:    Set to log the processing messages to disk and console. Default is False.
+        logger [JpmLogger]: A configured logger from jpm_logger.py. If set to None, will generate a new one.
+                            Default is None.
+
+    Outputs:
+        n_rows [int]: The number of rows in the archive.
+
+    Optional Outputs:
+        None
+
+    Example:
+        convert_eve_csv_to_archive('/Users/tyleralbee/Desktop/savesets/eve_selected_lines.csv',
+                                   '/Users/tyleralbee/Desktop/savesets/eve_selected_lines_archive/')
+    """
+    if verbose and logger is None:
+        from jpm_logger import JpmLogger
+        logger = JpmLogger(filename='convert_eve_csv_to_archive_log', path=os.path.dirname(csv_path), console=True)
+
+    if os.path.exists(archive_path):
+        if not overwrite:
+            raise ValueError('{0} already exists. Set overwrite=True to replace it.'.format(archive_path))
+        if not is_eve_archive(archive_path):
+            raise ValueError('{0} is not an EVE archive, so it will not be replaced.'.format(archive_path))
+        shutil.rmtree(archive_path)
+
+    n_rows = 0
+    for eve_lines in pd.read_csv(csv_path, index_col=0, chunksize=chunk_rows):
+        eve_lines.index = pd.to_datetime(eve_lines.index)
+        n_rows = append_eve_archive(archive_path, eve_lines, line_dtype=line_dtype)
+        if verbose:
+            logger.info('Converted {0} rows of {1}.'.format(n_rows, csv_path))
+
+    if verbose:
+        logger.info('EVE archive of {0} rows written to {1}.'.format(n_rows, archive_path))
+    return n_rows
+
+
+def append_eve_archive(archive_path, eve_lines, line_dtype='float64'):
+    """Append rows of EVE lines to an archive, creating it if it does not exist.
+
+    The rows are written to the end of each column file before the header's row count is updated in one atomic step,
+    so an interrupted append leaves the archive as it was; the partial rows past the row count are overwritten by the
+    next append. The header also records the first row of each day, which partitions the column files by day for
+    EveArchive.read_window.
+
+    Inputs:
+        archive_path [str]:       The archive directory.
+        eve_lines [pd DataFrame]: EVE extracted emission lines with a DatetimeIndex. Its columns must match those of
+                                  the archive, and its times must start after the last one in the archive.
+
+    Optional Inputs:
+        line_dtype [str]: The type to store the irradiances as, when a new archive is created. Default is 'float64'.
+
+    Outputs:
+        n_rows [int]: The number of rows in the archive.
+
+    Optional Outputs:
+        None
+
+    Example:
+        n_rows = append_eve_archive('/Users/tyleralbee/Desktop/savesets/eve_selected_lines_archive/', new_eve_lines)
+    """
+    header = read_eve_archive_header(archive_path) if is_eve_archive(archive_path) else None
+    if header is None:
+        if not os.path.exists(archive_path):
+            os.makedirs(archive_path)
+        header = {'version': ARCHIVE_VERSION,
+                  'n_rows': 0,
+                  'last_time_ns': None,
+                  'days': [],
+                  'index_name': eve_lines.index.name,
+                  'line_dtype': np.dtype(line_dtype).name,
+                  'lines': [{'name': str(name), 'filename': 'line_{0:03d}.{1}'.format(i, np.dtype(line_dtype).name)}
+                            for i, name in enumerate(eve_lines.columns)]}
+    line_names = [line['name'] for line in header['lines']]
+    if [str(name) for name in eve_lines.columns] != line_names:
+        raise ValueError('The lines {0} do not match the lines of {1}: {2}.'.format(
+            list(eve_lines.columns), archive_path, line_names))
+    if len(eve_lines) == 0:
+        return header['n_rows']
+
+    times = _time_ns(eve_lines.index)
+    if np.any(np.diff(times) < 0) or (header['last_time_ns'] is not None and times[0] <= header['last_time_ns']):
+        raise ValueError('Rows appended to {0} must be in time order and after its last time.'.format(archive_path))
+
+    columns = [(TIME_FILENAME, times)]
+    columns += [(line['filename'], eve_lines[name].values.astype(header['line_dtype']))
+                for line, name in zip(header['lines'], eve_lines.columns)]
+    for filename, values in columns:
+        _append_column(os.path.join(archive_path, filename), values, header['n_rows'])
+
+    # Start a partition at the first new row of each day, unless the archive already ends on that day
+    day_numbers = times // NANOSECONDS_PER_DAY
+    day_starts = np.flatnonzero(np.diff(day_numbers, prepend=day_numbers[0] - 1))
+    if header['days'] and header['days'][-1][0] == _day_string(day_numbers[0]):
+        day_starts = day_starts[1:]
+    header['days'] += [[_day_string(day_numbers[row]), header['n_rows'] + int(row)] for row in day_starts]
+
+    header['n_rows'] += len(eve_lines)
+    header['last_time_ns'] = int(times[-1])
+    _write_header(archive_path, header)
+    return header['n_rows']
+
+
+def read_eve_archive(archive_path, lines=None, first_row=0):
+    """Memory-map an EVE archive as a DataFrame, reading almost nothing until the irradiances are used.
+
+    Each line is a read-only (copy-on-write) memory map of its column file, so loading takes about as long as reading
+    the times, and only the pages of the rows actually used are read from disk and kept in memory (by the operating
+    system, which can drop them again when memory runs low). Writes to the DataFrame are private to this process.
+
+    Inputs:
+        archive_path [str]: The archive directory, made by convert_eve_csv_to_archive or append_eve_archive.
+
+    Optional Inputs:
+        lines [list]:    Set to the names of the lines to load. Default is None, meaning all of them.
+        first_row [int]: The first row to load. Default is 0.
+
+    Outputs:
+        eve_lines [pd DataFrame]: EVE extracted emission lines with a DatetimeIndex, like that of the csv.
+
+    Optional Outputs:
+        None
+
+    Example:
+        eve_lines = read_eve_archive('/Users/tyleralbee/Desktop/savesets/eve_selected_lines_archive/')
+    """
+    return EveArchive(archive_path).read_rows(first_row=first_row, lines=lines)
+
+
+def read_eve_archive_header(archive_path):
+    """Get the header of an EVE archive.
+
+    Inputs:
+        archive_path [str]: The archive directory.
+
+    Optional Inputs:
+        None
+
+    Outputs:
+        header [dict]: The archive 'version', number of rows ('n_rows'), last time ('last_time_ns', in ns since 1970),
+                       'days' (the date and first row of each day with data, in order), 'index_name', 'line_dtype',
+                       and 'lines' (the 'name' and 'filename' of each line, in order).
+
+    Optional Outputs:
+        None
+
+    Example:
+        n_rows = read_eve_archive_header(archive_path)['n_rows']
+    """
+    with open(os.path.join(archive_path, HEADER_FILENAME)) as header_file:
+        header = json.load(header_file)
+    if header['version'] != ARCHIVE_VERSION:
+        raise ValueError('{0} is an EVE archive of version {1}, but this code reads version {2}.'.format(
+            archive_path, header['version'], ARCHIVE_VERSION))
+    return header
+
+
+def is_eve_archive(path):
+    """Tell whether a path is an EVE archive directory rather than a csv.
+
+    Inputs:
+        path [str]: The path to check.
+
+    Optional Inputs:
+        None
+
+    Outputs:
+        is_archive [bool]: True if path is a directory with an EVE archive header.
+
+    Optional Outputs:
+        None
+
+    Example:
+        if is_eve_archive(eve_data_path): ...
+    """
+    return os.path.isfile(os.path.join(path, HEADER_FILENAME))
+
+
+def read_eve_lines(eve_data_path, first_row=0):
+    """Load the EVE extracted emission lines from either the csv or an EVE archive made from it.
+
+    Inputs:
+        eve_data_path [str]: The eve_selected_lines.csv, or an archive directory from convert_eve_csv_to_archive.
+
+    Optional Inputs:
+        first_row [int]: The first row to load, skipping those before it. Default is 0.
+
+    Outputs:
+        eve_lines [pd DataFrame]: EVE extracted emission lines with a DatetimeIndex.
+
+    Optional Outputs:
+        None
+
+    Example:
+        eve_lines = read_eve_lines('/Users/tyleralbee/Desktop/savesets/eve_selected_lines_archive/')
+    """
+    if is_eve_archive(eve_data_path):
+        return read_eve_archive(eve_data_path, first_row=first_row)
+    eve_lines = pd.read_csv(eve_data_path, index_col=0, skiprows=range(1, first_row + 1))
+    eve_lines.index = pd.to_datetime(eve_lines.index)
+    return eve_lines
+
+
+def open_eve_lines(eve_data_path):
+    """Open the EVE extracted emission lines for slicing event windows out of them with read_eve_window.
+
+    An EVE archive is opened without loading any rows, so each window is read on its own. A csv has to be loaded in
+    full.
+
+    Inputs:
+        eve_data_path [str]: The eve_selected_lines.csv, or an archive directory from convert_eve_csv_to_archive.
+
+    Optional Inputs:
+        None
+
+    Outputs:
+        eve_lines [EveArchive or pd DataFrame]: The opened archive, or the csv loaded with a DatetimeIndex. Either has
+                                                the line names as its columns attribute.
+
+    Optional Outputs:
+        None
+
+    Example:
+        eve_lines = open_eve_lines('/Users/tyleralbee/Desktop/savesets/eve_selected_lines_archive/')
+    """
+    if is_eve_archive(eve_data_path):
+        return EveArchive(eve_data_path)
+    return read_eve_lines(eve_data_path)
+
+
+def read_eve_window(eve_lines, start, end, lines=None):
+    """Get the EVE lines from start to end (both included) by binary search on the time index.
+
+    Inputs:
+        eve_lines [EveArchive or pd DataFrame]: The EVE lines from open_eve_lines, or any DataFrame of them with a
+                                                sorted DatetimeIndex.
+        start [str or datetime]:                The first time of the window.
+        end [str or datetime]:                  The last time of the window.
+
+    Optional Inputs:
+        lines [list]: Set to the names of the lines to get. Default is None, meaning all of them.
+
+    Outputs:
+        eve_lines_event [pd DataFrame]: The EVE lines in the window with a DatetimeIndex.
+
+    Optional Outputs:
+        None
+
+    Example:
+        eve_lines_event = read_eve_window(eve_lines, startTime, endTime)
+    """
+    if isinstance(eve_lines, EveArchive):
+        return eve_lines.read_window(start, end, lines=lines)
+    first_row = eve_lines.index.searchsorted(pd.Timestamp(start), side='left')
+    last_row = eve_lines.index.searchsorted(pd.Timestamp(end), side='right')
+    if lines is not None:
+        eve_lines = eve_lines[lines]
+    return eve_lines.iloc[first_row:max(last_row, first_row)]
+
+
+def _append_column(filename, values, n_rows):
+    # Cut off any rows past n_rows left by an interrupted append, then add the new ones
+    values = np.ascontiguousarray(values)
+    with open(filename, 'r+b' if os.path.exists(filename) else 'w+b') as column_file:
+        column_file.truncate(n_rows * values.itemsize)
+        column_file.seek(n_rows * values.itemsize)
+        column_file.write(values.tobytes())
+        column_file.flush()
+        os.fsync(column_file.fileno())
+
+
+def _write_header(archive_path, header):
+    # Written to a temporary file and renamed, so readers never see a partial header
+    file_descriptor, temporary_filename = tempfile.mkstemp(suffix='.tmp', dir=archive_path)
+    with os.fdopen(file_descriptor, 'w') as header_file:
+        json.dump(header, header_file, indent=2)
+        header_file.flush()
+        os.fsync(header_file.fileno())
+    os.replace(temporary_filename, os.path.join(archive_path, HEADER_FILENAME))
+
+
+def _time_ns(index):
+    # Converted to ns first, since pandas may parse times at s, ms or us resolution and asi8 is in the index's own unit
+    return np.asarray(pd.DatetimeIndex(index).values.astype('datetime64[ns]').view(np.int64))
+
+
+def _memory_map(filename, dtype, n_rows, first_row=0):
+    # np.memmap cannot map an empty file
+    if n_rows == 0:
+        return np.empty(0, dtype=dtype)
+    return np.memmap(filename, dtype=dtype, mode='c', offset=first_row * np.dtype(dtype).itemsize, shape=(n_rows,))
+
+
+def _day_string(day_number):
+    return str(np.datetime64(int(day_number), 'D'))
@@ -0,0 +1,279 @@
+# Standard modules
+import os
+import glob
+import json
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from astropy.io import fits
+from scipy.io.idl import readsav
+
+# Custom modules
+from eve_archive import EveArchive, append_eve_archive, is_eve_archive, read_eve_archive_header
+from jpm_logger import JpmLogger
+
+__author__ = 'Tyler J Albee & Shawn A Polson'
+__contact__ = 'tyal7988@colorado.edu'
+
+# Lists the level 2 files already in an archive, one JSON record per line, kept in the archive directory
+MANIFEST_FILENAME = 'ingest_manifest.jsonl'
+
+
+def ingest_eve_lines(level2_path='/Users/tyleralbee/Desktop/savesets/EVL_L2/',
+                     archive_path='/Users/tyleralbee/Desktop/savesets/eve_selected_lines_archive/',
+                     lines=None,
+                     file_patterns=('EVL_L2_*.fit*', 'EVL_L2_*.sav'),
+                     cadence='1min',
+                     n_processes=1,
+                     verbose=True):
+    """Append the selected lines of SDO EVE level 2 extracted emission line files to an EVE archive, one file at a time.
+
+    The files under level2_path are read in name (i.e., time) order, in parallel across n_processes, and each is
+    appended to the archive as soon as it and every file before it have been read. Each process only ever holds the
+    file it is reading, and at most a few files' worth of lines wait to be appended, so memory does not grow with the
+    number of files. Every appended file is recorded in ingest_manifest.jsonl in the archive directory, and files
+    already listed there are skipped, so a rerun (e.g., after new files are downloaded, or after an interruption)
+    ingests only what is missing. A file is noted in the manifest before its rows are appended, so a rerun after an
+    interruption can tell whether that append finished. A file may start inside the last minutes of the archive, in
+    which case its rows already in the archive are dropped, but a file of times the archive is past (e.g., one
+    backfilled or out of order) raises an error rather than being dropped, since the archive can only be appended to.
+
+    Inputs:
+        None.
+
+    Optional Inputs:
+        level2_path [str]:     The directory of EVE level 2 lines files (EVL_L2_YYYYDOY_HH_VVV_RR.fit[.gz], or IDL .sav
+                               files of the same LinesMeta and LinesData structures). Searched recursively.
+        archive_path [str]:    The EVE archive to append to. Created if it does not exist.
+        lines [list]:          The names of the lines to keep, as wavelengths in nm to one decimal (e.g., '17.1'), the
+                               column names of eve_selected_lines.csv. Lines a file lacks are filled with NaN.
+                               Default is None, meaning the lines of the archive, or all lines of the first file for a
+                               new archive.
+        file_patterns [tuple]: The glob patterns of the files to ingest. Default is the level 2 lines FITS and .sav
+                               files.
+        cadence [str]:         Set to a pandas frequency to average each file to, e.g., '1min' as in
+                               eve_selected_lines.csv. Default is '1min'. None keeps the native 10 s cadence.
+        n_processes [int]:     The number of files to read at once. Default is 1.
+        verbose [bool]:        Set to log the processing messages to disk and console. Default is True.
+
+    Outputs:
+        n_files [int]: The number of files ingested by this call.
+
+    Optional Outputs:
+        None
+
+    Example:
+        ingest_eve_lines(level2_path='/Users/tyleralbee/Desktop/savesets/EVL_L2/', n_processes=8)
+    """
+
+    if verbose:
+        logger = JpmLogger(filename='ingest_eve_lines_log', path=os.path.dirname(os.path.normpath(archive_path)),
+                           console=True)
+        logger.info('Starting EVE level 2 lines ingest.')
+
+    if not os.path.exists(archive_path):
+        os.makedirs(archive_path)
+    manifest = _finish_interrupted_append(archive_path, read_ingest_manifest(archive_path))
+    if lines is None and is_eve_archive(archive_path):
+        lines = [line['name'] for line in read_eve_archive_header(archive_path)['lines']]
+
+    filenames = sorted(set(filename for file_pattern in file_patterns
+                           for filename in glob.glob(os.path.join(level2_path, '**', file_pattern), recursive=True)),
+                       key=os.path.basename)
+    filenames = [filename for filename in filenames if os.path.basename(filename) not in manifest]
+    if verbose:
+        logger.info('{0} files to ingest, {1} already in the manifest.'.format(len(filenames), len(manifest)))
+
+    # A new archive takes the lines of its first file, which every later file is then selected to
+    if lines is None and filenames:
+        first_file_lines = read_eve_level2_lines(filenames[0], cadence=cadence)
+        lines = list(first_file_lines.columns)
+
+    n_files = 0
+    with ProcessPoolExecutor(max_workers=max(n_processes, 1)) as pool:
+        # Submit a few files per process at a time, so files read ahead of a slow one cannot pile up in memory
+        files_per_batch = max(n_processes, 1) * 4
+        for batch_start in range(0, len(filenames), files_per_batch):
+            batch_filenames = filenames[batch_start:batch_start + files_per_batch]
+            batch = pool.map(read_eve_level2_lines, batch_filenames, [lines] * len(batch_filenames),
+                             [cadence] * len(batch_filenames))
+            for filename, eve_lines in zip(batch_filenames, batch):  # map yields in submission (time) order
+                eve_lines = _drop_archived_rows(archive_path, filename, eve_lines)
+                n_rows = len(eve_lines)
+                first_row = read_eve_archive_header(archive_path)['n_rows'] if is_eve_archive(archive_path) else 0
+                record_ingested_file(archive_path, filename, n_rows, first_row=first_row, status='appending')
+                append_eve_archive(archive_path, eve_lines)
+                record_ingested_file(archive_path, filename, n_rows, first_row=first_row)
+                n_files += 1
+                if verbose:
+                    logger.info('Ingested {0} ({1} of {2}): {3} rows appended.'.format(
+                        os.path.basename(filename), n_files, len(filenames), n_rows))
+
+    if verbose:
+        logger.info('Ingested {0} files into {1}.'.format(n_files, archive_path))
+    return n_files
+
+
+def read_eve_level2_lines(filename, lines=None, cadence=None):
+    """Read the line irradiances of one SDO EVE level 2 extracted emission lines file.
+
+    Inputs:
+        filename [str]: An EVE level 2 lines FITS file (EVL_L2_*.fit or .fit.gz), or an IDL .sav file holding its
+                        LinesMeta and LinesData structures (as linesmeta and linesdata).
+
+    Optional Inputs:
+        lines [list]:  The names of the lines to keep (see ingest_eve_lines). Default is None, meaning all of them.
+        cadence [str]: Set to a pandas frequency to average the irradiances to, e.g., '1min'. Default is None.
+
+    Outputs:
+        eve_lines [pd DataFrame]: The irradiances [W/m2] with a DatetimeIndex and one column per line, named by its
+                                  central wavelength in nm to one decimal. Fill values are NaN.
+
+    Optional Outputs:
+        None
+
+    Example:
+        eve_lines = read_eve_level2_lines('EVL_L2_2010219_17_006_02.fit.gz', lines=['17.1', '19.3', '21.1'])
+    """
+    if filename.endswith('.sav'):
+        eve_level2 = readsav(filename)
+        lines_meta, lines_data = eve_level2['linesmeta'], eve_level2['linesdata']
+    else:
+        with fits.open(filename, memmap=False) as hdus:
+            lines_meta, lines_data = hdus['LinesMeta'].data, hdus['LinesData'].data
+            lines_meta, lines_data = np.array(lines_meta), np.array(lines_data)  # Copied so the file can be closed
+
+    line_names = ['{0:.1f}'.format(wave_center) for wave_center in lines_meta['WAVE_CENTER']]
+    irradiance = np.asarray(np.stack(lines_data['LINE_IRRADIANCE']), dtype=np.float64)  # .sav rows are objects
+    irradiance[irradiance < 0] = np.nan  # The fill value is -1
+    # Parsed as dates, since the float arithmetic of yyyydoy_sod_to_datetime is off by a day on about half of them
+    times = (pd.to_datetime(np.asarray(lines_data['YYYYDOY']).astype(int).astype(str), format='%Y%j') +
+             pd.to_timedelta(np.asarray(lines_data['SOD'], dtype=np.float64), unit='s'))
+    eve_lines = pd.DataFrame(irradiance, columns=line_names, index=pd.DatetimeIndex(times))
+    eve_lines = eve_lines.loc[:, ~eve_lines.columns.duplicated()]  # Blended lines can share a wavelength
+    eve_lines = eve_lines[~eve_lines.index.duplicated()].sort_index()
+
+    if cadence is not None:
+        eve_lines = eve_lines.resample(cadence).mean()
+    if lines is not None:
+        eve_lines = eve_lines.reindex(columns=lines)
+    return eve_lines
+
+
+def read_ingest_manifest(archive_path):
+    """Get the manifest of the level 2 files ingested into an EVE archive.
+
+    Inputs:
+        archive_path [str]: The EVE archive.
+
+    Optional Inputs:
+        None
+
+    Outputs:
+        manifest [dict]: The 'rows' appended from, 'first_row' in the archive of, 'size' [bytes] of, and 'status' of
+                         each file, keyed by file name. The status is 'ingested', or 'appending' for a file whose
+                         append may have been interrupted. Empty if nothing has been ingested.
+
+    Optional Outputs:
+        None
+
+    Example:
+        manifest = read_ingest_manifest('/Users/tyleralbee/Desktop/savesets/eve_selected_lines_archive/')
+    """
+    manifest = {}
+    manifest_filename = os.path.join(archive_path, MANIFEST_FILENAME)
+    if not os.path.exists(manifest_filename):
+        return manifest
+    with open(manifest_filename) as manifest_file:
+        for manifest_line in manifest_file:
+            try:
+                record = json.loads(manifest_line)
+            except ValueError:  # A record cut short by an interruption; its file is ingested again
+                continue
+            manifest[record['file']] = {'rows': record['rows'], 'first_row': record.get('first_row'),
+                                        'size': record['size'], 'status': record.get('status', 'ingested')}
+    return manifest
+
+
+def record_ingested_file(archive_path, filename, n_rows, first_row=None, status='ingested'):
+    """Durably add a level 2 file to the manifest of an EVE archive, by appending one record to it.
+
+    Later records of a file replace earlier ones.
+
+    Inputs:
+        archive_path [str]: The EVE archive.
+        filename [str]:     The ingested file.
+        n_rows [int]:       The number of rows appended from it.
+
+    Optional Inputs:
+        first_row [int]: The row of the archive its rows start at. Default is None, meaning not recorded.
+        status [str]:    'ingested' once its rows are in the archive, or 'appending' just before they are appended.
+                         Default is 'ingested'.
+
+    Outputs:
+        None
+
+    Optional Outputs:
+        None
+
+    Example:
+        record_ingested_file(archive_path, filename, n_rows)
+    """
+    _append_manifest_record(archive_path, {'file': os.path.basename(filename), 'rows': int(n_rows),
+                                           'first_row': None if first_row is None else int(first_row),
+                                           'size': os.path.getsize(filename), 'status': status})
+
+
+def _finish_interrupted_append(archive_path, manifest):
+    # A file left 'appending' was either appended in full (the archive's row count moved past it) or not at all
+    for filename, record in list(manifest.items()):
+        if record['status'] != 'appending':
+            continue
+        n_rows = read_eve_archive_header(archive_path)['n_rows'] if is_eve_archive(archive_path) else 0
+        if n_rows == record['first_row'] + record['rows']:
+            record['status'] = 'ingested'
+            _append_manifest_record(archive_path, dict(record, file=filename))
+        elif n_rows == record['first_row']:
+            del manifest[filename]
+        else:
+            raise ValueError('{0} has {1} rows, but its append of {2} was interrupted at row {3}. The archive was '
+                             'changed outside of the ingest.'.format(archive_path, n_rows, filename,
+                                                                      record['first_row']))
+    return manifest
+
+
+def _append_manifest_record(archive_path, record):
+    # A record cut short by an interruption is ended first, so it cannot swallow the next one
+    manifest_filename = os.path.join(archive_path, MANIFEST_FILENAME)
+    with open(manifest_filename, 'a+b') as manifest_file:
+        manifest_file.seek(0, os.SEEK_END)
+        if manifest_file.tell() > 0:
+            manifest_file.seek(-1, os.SEEK_END)
+            if manifest_file.read(1) != b'\n':
+                manifest_file.write(b'\n')
+        manifest_file.write((json.dumps(record) + '\n').encode())
+        manifest_file.flush()
+        os.fsync(manifest_file.fileno())
+
+
+def _drop_archived_rows(archive_path, filename, eve_lines):
+    # Only a file that starts inside the tail of the archive and runs past it may lose rows, and only rows already in it
+    if not is_eve_archive(archive_path) or len(eve_lines) == 0:
+        return eve_lines
+    last_time_ns = read_eve_archive_header(archive_path)['last_time_ns']
+    times = eve_lines.index.values.astype('datetime64[ns]').view(np.int64)
+    if last_time_ns is None or times[0] > last_time_ns:
+        return eve_lines
+    overlap = times <= last_time_ns
+    archived_times = EveArchive(archive_path).read_window(pd.Timestamp(times[0]), pd.Timestamp(last_time_ns),
+                                                          lines=[]).index
+    archived_times = archived_times.values.astype('datetime64[ns]').view(np.int64)
+    if overlap.all() or not np.isin(times[overlap], archived_times).all():
+        raise ValueError('{0} has times at or before the last time in {1} ({2}) that are not its tail. The archive can '
+                         'only be appended to, so a backfilled or out-of-order file has to be ingested into a rebuilt '
+                         'archive.'.format(os.path.basename(filename), archive_path, pd.Timestamp(last_time_ns)))
+    return eve_lines[~overlap]
+
+
+if __name__ == '__main__':
+    ingest_eve_lines(verbose=True)
@@ -0,0 +1,337 @@
+# Standard modules
+import os
+import json
+import tempfile
+import itertools
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+
+# Custom modules
+from catalog_writer import CatalogWriter
+
+__author__ = 'Tyler J Albee & Shawn A Polson'
+__contact__ = 'tyal7988@colorado.edu'
+
+# Bump this whenever the layout of the catalog files changes
+CATALOG_VERSION = 1
+
+# The catalog is a directory holding this header and, for each row group, one file per column type
+HEADER_FILENAME = 'jedi_catalog.json'
+
+# The storage type and the empty value of each column type
+COLUMN_TYPES = OrderedDict([('float32', (np.float32, np.nan)),
+                            ('int64', (np.int64, np.iinfo(np.int64).min)),
+                            ('datetime64', ('datetime64[ns]', np.datetime64('NaT', 'ns'))),
+                            ('str', ('U16', ''))])
+
+# The parameters of each line and of each pair of lines, in catalog order
+_EVENT_COLUMNS = [('Event #', 'int64'), ('Start Time', 'datetime64'), ('End Time', 'datetime64'),
+                  ('GOES Flare Class', 'str'), ('Pre-Flare Start Time', 'datetime64'),
+                  ('Pre-Flare End Time', 'datetime64'), ('Flare Interrupt', 'float32')]
+_DIMMING_PARAMETERS = [('Slope Start Time', 'datetime64'), ('Slope End Time', 'datetime64'),
+                       ('Slope Min [%/s]', 'float32'), ('Slope Max [%/s]', 'float32'), ('Slope Mean [%/s]', 'float32'),
+                       ('Slope Uncertainty [%/s]', 'float32'), ('Depth Time', 'datetime64'), ('Depth [%]', 'float32'),
+                       ('Depth Uncertainty [%]', 'float32'), ('Duration Start Time', 'datetime64'),
+                       ('Duration End Time', 'datetime64'), ('Duration [s]', 'float32')]
+_FITTING_PARAMETERS = [('Fitting Gamma', 'float32'), ('Fitting Score', 'float32')]
+_CORRECTION_PARAMETERS = [('Correction Time Shift [s]', 'float32'), ('Correction Scale Factor', 'float32')]
+
+
+class JediCatalogSchema:
+    def __init__(self, columns):
+        """The ordered, typed columns of a JEDI catalog, with each column's place among those of its type.
+
+        Built once per catalog, so filling a row or reading a column is a dictionary lookup and an array index. Use
+        jedi_catalog_schema() for the schema of the characterization pipelines.
+
+        Inputs:
+            columns [list]: (name, type) pairs in catalog order, with the types from COLUMN_TYPES.
+
+        Optional Inputs:
+            None
+
+        Outputs:
+            A JediCatalogSchema object. Its columns attribute holds the column names, types maps each name to its type,
+            positions maps each name to its index among the columns of its type, and type_columns lists the names of
+            each type.
+
+        Optional Outputs:
+            None
+
+        Example:
+            schema = JediCatalogSchema([('Event #', 'int64'), ('17.1 Depth [%]', 'float32')])
+        """
+
+        self.columns = [name for name, _ in columns]
+        self.types = OrderedDict(columns)
+        if len(self.types) != len(self.columns):
+            raise ValueError('JEDI catalog column names must be unique.')
+        unknown_types = set(self.types.values()) - set(COLUMN_TYPES)
+        if unknown_types:
+            raise ValueError('Unknown JEDI catalog column types {0}.'.format(sorted(unknown_types)))
+        self.type_columns = OrderedDict((column_type, [name for name in self.columns
+                                                       if self.types[name] == column_type])
+                                        for column_type in COLUMN_TYPES)
+        self.positions = {name: position for names in self.type_columns.values()
+                          for position, name in enumerate(names)}
+
+    def __len__(self):
+        return len(self.columns)
+
+    def empty_arrays(self, n_rows):
+        # One (columns x rows) array per type, so the values of a column in consecutive rows are contiguous
+        return OrderedDict((column_type, np.full((len(names), n_rows), COLUMN_TYPES[column_type][1],
+                                                 dtype=COLUMN_TYPES[column_type][0]))
+                           for column_type, names in self.type_columns.items())
+
+
+class JediRecord:
+    def __init__(self, schema):
+        """One row of a JEDI catalog, held in preallocated typed arrays and filled cell by cell like a DataFrame row.
+
+        Inputs:
+            schema [JediCatalogSchema]: The catalog columns.
+
+        Optional Inputs:
+            None
+
+        Outputs:
+            A JediRecord object with every value empty (NaN, NaT, or '').
+
+        Optional Outputs:
+            None
+
+        Example:
+            jedi_row = JediRecord(schema)
+            jedi_row['17.1 Depth [%]'] = depth_percent
+            jedi_row['17.1 Depth Time'] = depth_time
+        """
+
+        self.schema = schema
+        self.values = schema.empty_arrays(1)
+
+    def __setitem__(self, name, value):
+        column_type = self.schema.types[name]
+        if column_type == 'datetime64':
+            value = np.datetime64('NaT', 'ns') if pd.isnull(value) else pd.Timestamp(value).to_datetime64()
+        elif column_type == 'int64' and pd.isnull(value):
+            value = COLUMN_TYPES['int64'][1]
+        elif column_type == 'str':
+            value = '' if pd.isnull(value) else str(value)
+        self.values[column_type][self.schema.positions[name], 0] = value
+
+    def __getitem__(self, name):
+        return self.values[self.schema.types[name]][self.schema.positions[name], 0]
+
+    def clear(self):
+        """Empty every value, ready for the next event.
+
+        Inputs:
+            None.
+
+        Optional Inputs:
+            None
+
+        Outputs:
+            None
+
+        Optional Outputs:
+            None
+
+        Example:
+            jedi_row.clear()
+        """
+        for column_type, values in self.values.items():
+            values.fill(COLUMN_TYPES[column_type][1])
+
+
+class JediCatalogWriter(CatalogWriter):
+    def __init__(self, catalog_path, schema, rows_per_group=64, flush_seconds=600.0):
+        """Write JEDI catalog rows to a typed columnar catalog that can be read back one parameter at a time.
+
+        The buffering, flushing, and closing are those of CatalogWriter (see catalog_writer.py). Rows are copied into
+        preallocated arrays of rows_per_group rows, one array per column type (float32, int64, datetime64, and short
+        strings). When the arrays are full, or flush_seconds have passed since the last write, they are saved as a row
+        group: one .npy file per type, laid out so that each column's values in the group are contiguous. The header,
+        which lists the schema, the row groups, and the caller's progress marker, is then replaced in one atomic step,
+        so an interrupted run leaves a readable catalog of the row groups written. read_jedi_catalog reads only the
+        columns asked for, with a memory map of each row group.
+
+        Inputs:
+            catalog_path [str]:         The directory to write the catalog to. Created if it does not exist.
+            schema [JediCatalogSchema]: The catalog columns.
+
+        Optional Inputs:
+            rows_per_group [int]:  The most rows in a row group. Default is 64.
+            flush_seconds [float]: The most seconds a row may wait before its row group is written. Default is 600.
+
+        Outputs:
+            A JediCatalogWriter object. Use it in a with statement, or call close() when all rows are added.
+
+        Optional Outputs:
+            None
+
+        Example:
+            with JediCatalogWriter(output_path + 'jedi_catalog/', schema) as catalog_writer:
+                catalog_writer.add(jedi_row)
+        """
+
+        self.catalog_path = catalog_path
+        self.schema = schema
+        self.rows_per_group = rows_per_group
+        CatalogWriter.__init__(self, catalog_path, schema.columns, flush_rows=rows_per_group,
+                               flush_seconds=flush_seconds)
+
+    def add(self, record, progress=None):
+        """Copy a row into the current row group, writing the group if it is due.
+
+        Inputs:
+            record [JediRecord]: The row, with the schema of this catalog.
+
+        Optional Inputs:
+            progress [any JSON value]: Set to record how far the run has got (e.g., the next event) in the header
+                                       with the next row group. Default is None, meaning unchanged.
+
+        Outputs:
+            None
+
+        Optional Outputs:
+            None
+
+        Example:
+            catalog_writer.add(jedi_row)
+        """
+        CatalogWriter.add(self, record, progress)
+
+    def _open(self):
+        self._row_groups = []
+        self._blocks = self.schema.empty_arrays(self.rows_per_group)
+        self._n_rows_buffered = 0
+        if not os.path.exists(self.catalog_path):
+            os.makedirs(self.catalog_path)
+
+    def _buffer_rows(self, record):
+        for column_type, values in record.values.items():
+            self._blocks[column_type][:, self._n_rows_buffered] = values[:, 0]
+        self._n_rows_buffered += 1
+
+    def _n_buffered(self):
+        return self._n_rows_buffered
+
+    def _write_buffer(self):
+        # Save the buffered rows as the next row group and return how many were written
+        row_group = 'row_group_{0:05d}'.format(len(self._row_groups))
+        for column_type, block in self._blocks.items():
+            _save_array(os.path.join(self.catalog_path, '{0}_{1}.npy'.format(row_group, column_type)),
+                        block[:, :self._n_rows_buffered])
+            block.fill(COLUMN_TYPES[column_type][1])
+        self._row_groups.append([row_group, self._n_rows_buffered])
+        n_rows, self._n_rows_buffered = self._n_rows_buffered, 0
+        return n_rows
+
+    def _finish(self):
+        pass  # Every row group is already in the header
+
+    def _write_progress(self, complete):
+        # The header is the catalog's progress record
+        header = {'version': CATALOG_VERSION,
+                  'columns': [[name, self.schema.types[name]] for name in self.schema.columns],
+                  'row_groups': self._row_groups,
+                  'n_rows': self.rows_written,
+                  'progress': self.progress,
+                  'complete': complete}
+        file_descriptor, temporary_filename = tempfile.mkstemp(suffix='.tmp', dir=self.catalog_path)
+        with os.fdopen(file_descriptor, 'w') as header_file:
+            json.dump(header, header_file)
+            header_file.flush()
+            os.fsync(header_file.fileno())
+        os.replace(temporary_filename, os.path.join(self.catalog_path, HEADER_FILENAME))
+
+
+def jedi_catalog_schema(line_names, fitting_methods=False):
+    """Get the schema of the JEDI catalog: event columns, then the parameters of each line and of each pair of lines.
+
+    Inputs:
+        line_names [list]: The names of the EVE lines, e.g., eve_lines.columns.
+
+    Optional Inputs:
+        fitting_methods [bool]: Set to add a 'Fitting Method' column for each line. Default is False.
+
+    Outputs:
+        schema [JediCatalogSchema]: The catalog columns. Times are datetime64, counts int64, the flare class and
+                                    fitting methods short strings, and every other parameter float32.
+
+    Optional Outputs:
+        None
+
+    Example:
+        schema = jedi_catalog_schema(eve_lines.columns, fitting_methods=True)
+    """
+    line_names = [str(name) for name in line_names]
+    line_parameters = ([('Pre-Flare Irradiance [W/m2]', 'float32')] + _DIMMING_PARAMETERS + _FITTING_PARAMETERS +
+                       ([('Fitting Method', 'str')] if fitting_methods else []))
+    ion_permutations = [' by '.join(ion_tuple) for ion_tuple in itertools.permutations(line_names, 2)]
+    ion_parameters = _DIMMING_PARAMETERS + _CORRECTION_PARAMETERS + _FITTING_PARAMETERS
+
+    # Grouped by parameter, then by line, as the catalog csv was
+    columns = list(_EVENT_COLUMNS)
+    columns += [(name + ' ' + parameter, column_type) for parameter, column_type in line_parameters
+                for name in line_names]
+    columns += [(name + ' ' + parameter, column_type) for parameter, column_type in ion_parameters
+                for name in ion_permutations]
+    return JediCatalogSchema(columns)
+
+
+def read_jedi_catalog(catalog_path, columns=None):
+    """Read columns of a JEDI catalog for all of its events, reading only those columns from disk.
+
+    Inputs:
+        catalog_path [str]: The catalog directory, written by JediCatalogWriter.
+
+    Optional Inputs:
+        columns [list]: The names of the columns to read. Default is None, meaning all of them.
+
+    Outputs:
+        jedi_catalog [pd DataFrame]: One row per event, with the typed columns. Empty int64 values (never set) are the
+                                     smallest int64 and empty strings are ''.
+
+    Optional Outputs:
+        None
+
+    Example:
+        depths = read_jedi_catalog(output_path + 'jedi_catalog/', columns=['Event #', '17.1 Depth [%]'])
+    """
+    with open(os.path.join(catalog_path, HEADER_FILENAME)) as header_file:
+        header = json.load(header_file)
+    if header['version'] != CATALOG_VERSION:
+        raise ValueError('{0} is a JEDI catalog of version {1}, but this code reads version {2}.'.format(
+            catalog_path, header['version'], CATALOG_VERSION))
+    schema = JediCatalogSchema([tuple(column) for column in header['columns']])
+    if columns is None:
+        columns = schema.columns
+    missing_columns = [name for name in columns if name not in schema.types]
+    if missing_columns:
+        raise ValueError('{0} has no columns {1}.'.format(catalog_path, missing_columns))
+
+    jedi_catalog = OrderedDict((name, []) for name in columns)
+    for row_group, _ in header['row_groups']:
+        for column_type in set(schema.types[name] for name in columns):
+            block = np.load(os.path.join(catalog_path, '{0}_{1}.npy'.format(row_group, column_type)), mmap_mode='r')
+            for name in columns:
+                if schema.types[name] == column_type:
+                    jedi_catalog[name].append(np.array(block[schema.positions[name]]))
+    return pd.DataFrame(OrderedDict((name, np.concatenate(values) if values else
+                                     np.empty(0, dtype=COLUMN_TYPES[schema.types[name]][0]))
+                                    for name, values in jedi_catalog.items()),
+                        columns=columns)
+
+
+def _save_array(filename, array):
+    # Written to a temporary file and renamed, so a row group is never partly written
+    temporary_filename = filename + '.tmp'
+    with open(temporary_filename, 'wb') as array_file:
+        np.save(array_file, array)
+        array_file.flush()
+        os.fsync(array_file.fileno())
+    os.replace(temporary_filename, filename)
@@ -0,0 +1,292 @@
+# Standard modules
+import os
+import glob
+import hashlib
+import tempfile
+from collections import OrderedDict
+import numpy as np
+
+__author__ = 'Tyler J Albee & Shawn A Polson'
+__contact__ = 'tyal7988@colorado.edu'
+
+# Bump this whenever a change to the fitting code changes its results, so fits cached before are not reused
+CACHE_VERSION = 4
+
+
+class LightCurveFitCache:
+    def __init__(self, path, max_size_mb=1024, random_state=0):
+        """Keep light curve fits on disk, keyed by their input data and fitting settings, so reruns skip refitting.
+
+        Each fit is stored in its own file named by a SHA-256 hash of the fitted times, irradiances, and uncertainties,
+        the cross-validation splits, and every other setting that changes the fit. Fits whose settings leave out a
+        seed are given random_state, so the same data always get the same splits and map to the same cached fit.
+        Reading a fit marks it as recently used, and the least recently used fits are deleted once the cache grows past
+        max_size_mb. The directory is scanned once, when the cache is opened, and the sizes and order of use of the fits
+        are then kept in memory, so a lookup or a new fit costs the same however many fits are cached. Each process
+        (e.g., each shard of the correlation scan) keeps its own order and only evicts the fits it knows of: those
+        cached when it opened the cache and those it cached since. Settings that only change what is done with a fit
+        (minimum_score, plotting) are not part of the key, so changing them reuses it.
+
+        Inputs:
+            path [str]: The directory to keep the cached fits in. Created if it does not exist.
+
+        Optional Inputs:
+            max_size_mb [float]: The most disk space the cached fits may use, in megabytes. Default is 1024.
+            random_state [int]:  The cross-validation seed given to fits that do not set one. Default is 0.
+
+        Outputs:
+            A LightCurveFitCache object. Its hits and misses attributes count the lookups made through it.
+
+        Optional Outputs:
+            None
+
+        Example:
+            fit_cache = LightCurveFitCache('/Users/tyleralbee/Desktop/StealthCME/fit_cache/')
+            light_curve_fit, best_fit_gamma, best_fit_score = automatic_fit_light_curve(light_curve_df,
+                                                                                        fit_cache=fit_cache)
+            print(fit_cache.info())
+        """
+
+        self.path = path
+        self.max_size_mb = max_size_mb
+        self.random_state = random_state
+        self.hits = 0
+        self.misses = 0
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self._scan()
+
+    def key(self, X, y, uncertainty, splits, **fit_settings):
+        """Get the cache key of a fit.
+
+        Inputs:
+            X [np.array]:           The times of the fitted points [seconds since start].
+            y [np.array]:           The fitted irradiances.
+            uncertainty [np.array]: The irradiance uncertainties.
+            splits [list]:          The (train, test) indices of the cross-validation splits.
+            **fit_settings:         Every other setting that changes the fit, e.g., method='svr', random_state=0.
+
+        Optional Inputs:
+            None
+
+        Outputs:
+            key [str]: The hexadecimal SHA-256 hash of the inputs.
+
+        Optional Outputs:
+            None
+
+        Example:
+            cache_key = fit_cache.key(X, y, uncertainty, splits, method='svr', gamma_search='grid', random_state=0)
+        """
+        hasher = hashlib.sha256()
+        for values in (X, y, uncertainty):
+            values = np.ascontiguousarray(values, dtype=np.float64)
+            hasher.update(str(values.shape).encode())
+            hasher.update(values.tobytes())
+        for train, test in splits:
+            for indices in (train, test):
+                indices = np.ascontiguousarray(indices, dtype=np.int64)
+                hasher.update(str(indices.shape).encode())
+                hasher.update(indices.tobytes())
+        settings = [(name, str(value)) for name, value in sorted(fit_settings.items())]  # str() so 0.1 == np.float64(0.1)
+        hasher.update(repr(settings + [('cache version', str(CACHE_VERSION))]).encode())
+        return hasher.hexdigest()
+
+    def get(self, key):
+        """Get a cached fit, counting a hit or a miss.
+
+        Inputs:
+            key [str]: The cache key of the fit, from key().
+
+        Optional Inputs:
+            None
+
+        Outputs:
+            cached_fit [tuple]: The fitted irradiances [np.array], best fit gamma [float], best fit score [float],
+                                training and validation scores [np.array] (gammas x splits, or None for methods that do
+                                not score gammas), and fit uncertainty [np.array] and bootstrap refits [np.array]
+                                (replicates x points, both None if the fit was cached without them), as given to put().
+                                None if the fit is not cached.
+
+        Optional Outputs:
+            None
+
+        Example:
+            cached_fit = fit_cache.get(cache_key)
+        """
+        filename = self._filename(key)
+        try:
+            with np.load(filename, allow_pickle=False) as cached:
+                cached_fit = (cached['y_fit'], float(cached['best_fit_gamma']), float(cached['best_fit_score']),
+                              cached['train_score'] if cached['train_score'].size else None,
+                              cached['val_score'] if cached['val_score'].size else None,
+                              cached['fit_uncertainty'] if cached['fit_uncertainty'].size else None,
+                              cached['fit_replicates'] if cached['fit_replicates'].size else None)
+            os.utime(filename)  # Mark it as recently used, for the processes that open the cache later
+        except (IOError, OSError, KeyError, ValueError):  # Not cached, evicted meanwhile, or unreadable
+            self.misses += 1
+            return None
+        self.hits += 1
+        if filename in self._sizes:
+            self._sizes.move_to_end(filename)
+        else:  # Cached by another process since this one opened the cache
+            self._add(filename, _file_size(filename))
+        return cached_fit
+
+    def put(self, key, y_fit, best_fit_gamma, best_fit_score, train_score=None, val_score=None, fit_uncertainty=None,
+            fit_replicates=None):
+        """Cache a fit, then evict the least recently used fits if the cache is over its size limit.
+
+        Inputs:
+            key [str]:              The cache key of the fit, from key().
+            y_fit [np.array]:       The fitted irradiances.
+            best_fit_gamma [float]: The best fit hyperparameter.
+            best_fit_score [float]: The best explained variance score.
+
+        Optional Inputs:
+            train_score [np.array]:     The training scores of the validation curve (gammas x splits). Default is
+                                        None.
+            val_score [np.array]:       The validation scores of the validation curve (gammas x splits). Default is
+                                        None.
+            fit_uncertainty [np.array]: The bootstrapped uncertainty of the fitted irradiances. Default is None.
+            fit_replicates [np.array]:  The bootstrap refits the fit uncertainty is the standard deviation of
+                                        (replicates x points). Default is None.
+
+        Outputs:
+            None
+
+        Optional Outputs:
+            None
+
+        Example:
+            fit_cache.put(cache_key, y_fit, best_fit_gamma, best_fit_score, train_score, val_score, fit_uncertainty,
+                          fit_replicates)
+        """
+
+        # Written to a temporary file and renamed, so other processes never read a partial fit
+        file_descriptor, temporary_filename = tempfile.mkstemp(suffix='.tmp', dir=self.path)
+        with os.fdopen(file_descriptor, 'wb') as temporary_file:
+            np.savez(temporary_file, y_fit=np.asarray(y_fit, dtype=np.float64), best_fit_gamma=best_fit_gamma,
+                     best_fit_score=best_fit_score,
+                     train_score=np.empty(0) if train_score is None else train_score,
+                     val_score=np.empty(0) if val_score is None else val_score,
+                     fit_uncertainty=np.empty(0) if fit_uncertainty is None else fit_uncertainty,
+                     fit_replicates=np.empty(0) if fit_replicates is None else fit_replicates)
+        filename = self._filename(key)
+        os.replace(temporary_filename, filename)
+        self._add(filename, _file_size(filename))
+        self._evict()
+
+    def info(self):
+        """Get the size of the cache and the hits and misses of the lookups made through this object.
+
+        Inputs:
+            None.
+
+        Optional Inputs:
+            None
+
+        Outputs:
+            info [dict]: The cache 'path', number of cached 'fits', 'size [MB]', 'max size [MB]', 'hits', and 'misses'.
+
+        Optional Outputs:
+            None
+
+        Example:
+            logger.info('Fit cache: {0}'.format(fit_cache.info()))
+        """
+        filenames = self._filenames()
+        return {'path': self.path,
+                'fits': len(filenames),
+                'size [MB]': sum(_file_size(filename) for filename in filenames) / 1e6,
+                'max size [MB]': self.max_size_mb,
+                'hits': self.hits,
+                'misses': self.misses}
+
+    def summary(self):
+        """Get a one line report of the hits and misses of the lookups made through this object and the cache size.
+
+        Inputs:
+            None.
+
+        Optional Inputs:
+            None
+
+        Outputs:
+            summary [str]: The report, for logging at the end of a run.
+
+        Optional Outputs:
+            None
+
+        Example:
+            logger.info(fit_cache.summary())
+        """
+        info = self.info()
+        return 'Light curve fit cache: {0} hits, {1} misses. {2} fits ({3:.2f} of {4} MB) cached in {5}.'.format(
+            info['hits'], info['misses'], info['fits'], info['size [MB]'], info['max size [MB]'], info['path'])
+
+    def clear(self):
+        """Delete every cached fit and reset the hit and miss counts.
+
+        Inputs:
+            None.
+
+        Optional Inputs:
+            None
+
+        Outputs:
+            None
+
+        Optional Outputs:
+            None
+
+        Example:
+            fit_cache.clear()
+        """
+        for filename in self._filenames():
+            _remove(filename)
+        self._scan()
+        self.hits = 0
+        self.misses = 0
+
+    def _filename(self, key):
+        return os.path.join(self.path, key + '.npz')
+
+    def _filenames(self):
+        return glob.glob(os.path.join(self.path, '*.npz'))
+
+    def _scan(self):
+        # The size of every cached fit, least recently used first
+        entries = []
+        for filename in self._filenames():
+            try:
+                status = os.stat(filename)
+            except OSError:  # Evicted by another process meanwhile
+                continue
+            entries.append((status.st_mtime, status.st_size, filename))
+        self._sizes = OrderedDict((filename, entry_size) for _, entry_size, filename in sorted(entries))
+        self._size = sum(self._sizes.values())
+
+    def _add(self, filename, entry_size):
+        self._size += entry_size - self._sizes.pop(filename, 0)
+        self._sizes[filename] = entry_size
+
+    def _evict(self):
+        while self._size > self.max_size_mb * 1e6 and self._sizes:
+            filename, entry_size = self._sizes.popitem(last=False)
+            _remove(filename)
+            self._size -= entry_size
+
+
+def _file_size(filename):
+    try:
+        return os.path.getsize(filename)
+    except OSError:
+        return 0
+
+
+def _remove(filename):
+    try:
+        os.remove(filename)
+    except OSError:
+        pass
@@ -0,0 +1,456 @@
+# Standard modules
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy.signal import fftconvolve
+
+__author__ = 'Tyler J Albee & Shawn A Polson'
+__contact__ = 'tyal7988@colorado.edu'
+
+
+def sliding_window_starts(n_rows, window_rows, window_stride=60):
+    """Get the first row index of every complete sliding window that fits in a data set.
+
+    Inputs:
+        n_rows [int]:        The number of rows in the data set being scanned.
+        window_rows [int]:   The number of rows in each window, i.e., the length of the CME signature.
+
+    Optional Inputs:
+        window_stride [int]: The number of rows to advance the window between scores. Default is 60 (1 hour of
+                             1-minute EVE data).
+
+    Outputs:
+        window_starts [np.array]: The first row index of each window.
+
+    Optional Outputs:
+        None
+
+    Example:
+        window_starts = sliding_window_starts(len(eve_lines), len(cme_event), window_stride=1)
+    """
+    if window_stride < 1:
+        raise ValueError('window_stride must be at least 1 row, got {0}.'.format(window_stride))
+    return np.arange(0, max(n_rows - window_rows + 1, 0), window_stride)
+
+
+def correlation_block_windows(window_stride=60, lagged=False, block_windows=4096, block_rows=16384):
+    """Get the number of windows the correlation engines score together in one block.
+
+    Each block is computed from its own rows only, so splitting a scan into pieces that start on a block boundary
+    (a multiple of this many windows from the first window) gives bit-for-bit the same coefficients as one pass.
+
+    Inputs:
+        None.
+
+    Optional Inputs:
+        window_stride [int]: The number of rows between windows. Default is 60.
+        lagged [bool]:       Set for lagged_sliding_window_correlation, which blocks by rows rather than windows.
+                             Default is False.
+        block_windows [int]: The block_windows passed to sliding_window_correlation. Default is 4096.
+        block_rows [int]:    The block_rows passed to lagged_sliding_window_correlation. Default is 16384.
+
+    Outputs:
+        windows_per_block [int]: The number of windows per block.
+
+    Optional Outputs:
+        None
+
+    Example:
+        windows_per_block = correlation_block_windows(window_stride=1, lagged=True)
+    """
+    if lagged:
+        return max(1, block_rows // window_stride)
+    return block_windows
+
+
+def sliding_window_correlation(data, template, window_stride=60, window_starts=None, block_windows=4096):
+    """Compute the Pearson correlation coefficient of every sliding window of data with a template, for all lines at once.
+
+    The window means and standard deviations come from running (cumulative) sums of x and x^2, so they cost O(lines)
+    per window. Because the template is centered once up front, the only remaining cross term is the dot product of
+    the raw window with the centered template, which is batched as a matrix multiply over strided views of the data
+    (see template_bank_correlation, of which this is the single-template case).
+    Any window that contains a NaN gets a NaN coefficient for that line, the same as the iterrows() summation in
+    correlationCoefficientScan used to produce.
+
+    Inputs:
+        data [np.array]:     A 2-D array (rows x lines) of the light curves to scan, e.g., eve_lines.values.
+        template [np.array]: A 2-D array (template rows x lines) of the CME signature, with its columns in the same
+                             order as data.
+
+    Optional Inputs:
+        window_stride [int]: The number of rows to advance the window between scores. Any stride >= 1 is supported.
+                             Default is 60 (1 hour of 1-minute EVE data).
+        window_starts [np.array]: Set to score only these window start rows, which must be increasing and spaced by
+                                  window_stride. Default is None, meaning every window from row 0.
+        block_windows [int]: The number of windows to score at a time. Bounds the memory used by the running sums
+                             and keeps them well conditioned. Default is 4096.
+
+    Outputs:
+        window_starts [np.array]:            The first row index of each scored window.
+        correlation_coefficients [np.array]: A 2-D array (windows x lines) of Pearson correlation coefficients.
+
+    Optional Outputs:
+        None
+
+    Example:
+        window_starts, correlation_coefficients = sliding_window_correlation(eve_lines.values,
+                                                                             cme_event[eve_lines.columns].values,
+                                                                             window_stride=1)
+        total_correlation_coefficients = correlation_coefficients.sum(axis=1)
+    """
+    template = np.asarray(template, dtype=np.float64)
+    if template.ndim == 1:
+        template = template.reshape(-1, 1)
+    window_starts, correlation_coefficients = template_bank_correlation(data, template[np.newaxis],
+                                                                        window_stride=window_stride,
+                                                                        window_starts=window_starts,
+                                                                        block_windows=block_windows)
+    return window_starts, correlation_coefficients[:, 0, :]
+
+
+def template_bank_correlation(data, templates, window_stride=60, window_starts=None, block_windows=4096):
+    """Compute the Pearson correlation coefficient of every sliding window of data with every template in a bank.
+
+    The window statistics come from running sums exactly as in sliding_window_correlation, and are shared by all
+    templates. The dot products of each window with every centered template are batched, line by line, as one matrix
+    multiply of (windows x window rows) by (window rows x templates), so one pass over the data scores the whole bank.
+
+    Inputs:
+        data [np.array]:      A 2-D array (rows x lines) of the light curves to scan, e.g., eve_lines.values.
+        templates [np.array]: A 3-D array (templates x template rows x lines) of CME signatures of equal length, with
+                              their columns in the same order as data.
+
+    Optional Inputs:
+        window_stride [int]:      The number of rows to advance the window between scores. Default is 60.
+        window_starts [np.array]: Set to score only these window start rows, which must be increasing and spaced by
+                                  window_stride. Default is None, meaning every window from row 0.
+        block_windows [int]:      The number of windows to score at a time. Default is 4096.
+
+    Outputs:
+        window_starts [np.array]:            The first row index of each scored window.
+        correlation_coefficients [np.array]: A 3-D array (windows x templates x lines) of Pearson correlation
+                                             coefficients.
+
+    Optional Outputs:
+        None
+
+    Example:
+        window_starts, correlation_coefficients = template_bank_correlation(eve_lines.values, templates)
+        best_template_indices = np.nanargmax(correlation_coefficients.sum(axis=2), axis=1)
+    """
+    data = np.asarray(data, dtype=np.float64)
+    templates = np.array(templates, dtype=np.float64, order='C')  # A fresh copy; see the block copy below
+    if data.ndim == 1:
+        data = data.reshape(-1, 1)
+    if templates.ndim != 3:
+        raise ValueError('templates must be a 3-D array (templates x rows x lines), got {0} dimensions.'.format(
+            templates.ndim))
+    if data.shape[1] != templates.shape[2]:
+        raise ValueError('data has {0} lines but templates have {1}.'.format(data.shape[1], templates.shape[2]))
+
+    n_templates, window_rows, n_lines = templates.shape
+    if window_starts is None:
+        window_starts = sliding_window_starts(data.shape[0], window_rows, window_stride)
+    window_starts = np.asarray(window_starts, dtype=int)
+    correlation_coefficients = np.full((len(window_starts), n_templates, n_lines), np.nan)
+
+    # Center the templates once so that sum((a - meanA) * (b - meanB)) reduces to sum(a * (b - meanB))
+    template_mean = np.nanmean(templates, axis=1, keepdims=True)
+    template_std = np.nanstd(templates, axis=1)  # templates x lines
+    centered_templates = templates - template_mean  # NaNs propagate, as they did in the old summation
+
+    for block_start in range(0, len(window_starts), block_windows):
+        block_window_starts = window_starts[block_start:block_start + block_windows]
+        first_row = block_window_starts[0]
+        last_row = block_window_starts[-1] + window_rows
+
+        # Copy each block into a fresh C-ordered array. The rounding of vectorized sums depends on memory layout and
+        # alignment, so this keeps the coefficients bit-for-bit the same for any input (e.g., unpickled in a worker).
+        block = np.array(data[first_row:last_row], order='C')
+
+        # Running sums of x, x^2, and the NaN count, centered on the block to keep the variance well conditioned
+        finite = np.isfinite(block)
+        block_center = np.where(finite, block, 0.0).sum(axis=0) / np.maximum(finite.sum(axis=0), 1)
+        x = np.where(finite, block - block_center, 0.0)
+        zero_row = np.zeros((1, n_lines))
+        sum_x = np.concatenate((zero_row, np.cumsum(x, axis=0)))
+        sum_x2 = np.concatenate((zero_row, np.cumsum(x * x, axis=0)))
+        nan_count = np.concatenate((zero_row, np.cumsum(~finite, axis=0)))
+
+        local_starts = block_window_starts - first_row
+        local_ends = local_starts + window_rows
+        window_std = _window_std(block, sum_x, sum_x2, local_starts, window_rows)
+        window_has_nan = (nan_count[local_ends] - nan_count[local_starts]) > 0
+
+        # Dot product of each (strided) window with every centered template, one matrix multiply per line
+        windows = sliding_window_view(x, window_rows, axis=0)[::window_stride]  # windows x lines x window_rows
+        numerator = np.empty((len(block_window_starts), n_templates, n_lines))
+        for line in range(n_lines):
+            numerator[:, :, line] = np.dot(windows[:, line, :], centered_templates[:, :, line].T)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            block_coefficients = numerator / (window_rows * window_std[:, np.newaxis, :] * template_std)
+        block_coefficients[np.broadcast_to(window_has_nan[:, np.newaxis, :], block_coefficients.shape)] = np.nan
+        correlation_coefficients[block_start:block_start + len(block_window_starts)] = block_coefficients
+
+    return window_starts, correlation_coefficients
+
+
+def lagged_sliding_window_correlation(data, template, max_lag_rows, window_stride=60, window_starts=None,
+                                      block_rows=16384):
+    """Compute the best normalized cross-correlation of every sliding window with a template over a range of lags.
+
+    For every line, the numerator of the normalized cross-correlation at every row offset is computed in one FFT
+    convolution over a long block of data, and the normalization comes from the same running sums of x and x^2 as
+    sliding_window_correlation. Every lag is therefore scored in one pass, so the cost stays close to that of a
+    fixed-lag scan rather than growing with the number of lags. Each window then keeps, per line, the lag in
+    [-max_lag_rows, +max_lag_rows] with the highest coefficient.
+
+    Inputs:
+        data [np.array]:     A 2-D array (rows x lines) of the light curves to scan, e.g., eve_lines.values.
+        template [np.array]: A 2-D array (template rows x lines) of the CME signature, with its columns in the same
+                             order as data.
+        max_lag_rows [int]:  The largest shift (in rows) of each line relative to the window start that is searched,
+                             in either direction.
+
+    Optional Inputs:
+        window_stride [int]: The number of rows to advance the window between scores. Default is 60.
+        window_starts [np.array]: Set to score only these window start rows, which must be increasing and spaced by
+                                  window_stride. Default is None, meaning every window from row 0.
+        block_rows [int]:    The number of row offsets to convolve per FFT block. Bounds memory. Default is 16384.
+
+    Outputs:
+        window_starts [np.array]:                 The first row index of each scored window.
+        best_correlation_coefficients [np.array]: A 2-D array (windows x lines) of the best coefficient over all lags.
+                                                  NaN when no lag gave a finite coefficient.
+        best_lags [np.array]:                     A 2-D array (windows x lines) of the lag in rows that gave the best
+                                                  coefficient. Positive means the line lags behind the signature.
+
+    Optional Outputs:
+        None
+
+    Example:
+        window_starts, best_correlation_coefficients, best_lags = lagged_sliding_window_correlation(
+            eve_lines.values, cme_event[eve_lines.columns].values, max_lag_rows=30)
+    """
+    data = np.asarray(data, dtype=np.float64)
+    template = np.array(template, dtype=np.float64, order='C')
+    if data.ndim == 1:
+        data = data.reshape(-1, 1)
+    if template.ndim == 1:
+        template = template.reshape(-1, 1)
+    if data.shape[1] != template.shape[1]:
+        raise ValueError('data has {0} lines but template has {1}.'.format(data.shape[1], template.shape[1]))
+    if max_lag_rows < 0:
+        raise ValueError('max_lag_rows must be >= 0, got {0}.'.format(max_lag_rows))
+
+    n_rows, n_lines = data.shape
+    window_rows = template.shape[0]
+    if window_starts is None:
+        window_starts = sliding_window_starts(n_rows, window_rows, window_stride)
+    window_starts = np.asarray(window_starts, dtype=int)
+    best_correlation_coefficients = np.full((len(window_starts), n_lines), np.nan)
+    best_lags = np.zeros((len(window_starts), n_lines), dtype=int)
+    last_offset = n_rows - window_rows  # The last row offset at which a full template fits
+
+    template_std = np.nanstd(template, axis=0)
+    centered_template = template - np.nanmean(template, axis=0)
+    reversed_template = centered_template[::-1]  # Convolving with the reversed template is a cross-correlation
+
+    windows_per_block = correlation_block_windows(window_stride, lagged=True, block_rows=block_rows)
+    for block_start in range(0, len(window_starts), windows_per_block):
+        block_window_starts = window_starts[block_start:block_start + windows_per_block]
+
+        # Every row offset that any window in this block can reach with its lags
+        first_offset = max(block_window_starts[0] - max_lag_rows, 0)
+        last_block_offset = min(block_window_starts[-1] + max_lag_rows, last_offset)
+        block = np.array(data[first_offset:last_block_offset + window_rows], order='C')  # See template_bank_correlation
+
+        finite = np.isfinite(block)
+        block_center = np.where(finite, block, 0.0).sum(axis=0) / np.maximum(finite.sum(axis=0), 1)
+        x = np.where(finite, block - block_center, 0.0)
+
+        # Numerator at every offset, for every line, in one FFT pass
+        numerator = fftconvolve(x, reversed_template, mode='valid', axes=0)  # offsets x lines
+
+        zero_row = np.zeros((1, n_lines))
+        sum_x = np.concatenate((zero_row, np.cumsum(x, axis=0)))
+        sum_x2 = np.concatenate((zero_row, np.cumsum(x * x, axis=0)))
+        nan_count = np.concatenate((zero_row, np.cumsum(~finite, axis=0)))
+        offset_starts = np.arange(numerator.shape[0])
+        offset_ends = offset_starts + window_rows
+        offset_std = _window_std(block, sum_x, sum_x2, offset_starts, window_rows)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            offset_coefficients = numerator / (window_rows * offset_std * template_std)
+        offset_coefficients[(nan_count[offset_ends] - nan_count[offset_starts]) > 0] = np.nan
+        offset_coefficients[~np.isfinite(offset_coefficients)] = -np.inf
+
+        # Pad so that lags reaching past either end of the data are never chosen, then take the best lag per window
+        padded = np.full((numerator.shape[0] + 2 * max_lag_rows, n_lines), -np.inf)
+        padded[max_lag_rows:max_lag_rows + numerator.shape[0]] = offset_coefficients
+        lag_windows = sliding_window_view(padded, 2 * max_lag_rows + 1, axis=0)  # offsets x lines x lags
+        lag_windows = lag_windows[block_window_starts - first_offset]
+        best_lag_indices = np.argmax(lag_windows, axis=2)
+        block_best = np.take_along_axis(lag_windows, best_lag_indices[:, :, np.newaxis], axis=2)[:, :, 0]
+
+        block_slice = slice(block_start, block_start + len(block_window_starts))
+        best_correlation_coefficients[block_slice] = np.where(np.isfinite(block_best), block_best, np.nan)
+        best_lags[block_slice] = best_lag_indices - max_lag_rows
+
+    return window_starts, best_correlation_coefficients, best_lags
+
+
+def discriminating_line_order(data, template, window_stride=60, n_sample_windows=1000):
+    """Order the lines so that those that most often rule a window out are scored first, for early abandoning.
+
+    A window can only reach a total threshold if its lines score well, so the lines that usually score lowest (or NaN,
+    which rules a window out at once) tighten the bound of early_abandon_correlation fastest. This scores an evenly
+    spaced sample of windows with sliding_window_correlation and sorts the lines by their mean coefficient, counting
+    NaN as -1.
+
+    Inputs:
+        data [np.array]:     A 2-D array (rows x lines) of the light curves to scan, e.g., eve_lines.values.
+        template [np.array]: A 2-D array (template rows x lines) of the CME signature, with its columns in the same
+                             order as data.
+
+    Optional Inputs:
+        window_stride [int]:    The number of rows between windows of the scan. Default is 60.
+        n_sample_windows [int]: The number of windows to sample. Default is 1000.
+
+    Outputs:
+        line_order [np.array]: The column indices of data, most discriminating first.
+
+    Optional Outputs:
+        None
+
+    Example:
+        line_order = discriminating_line_order(eve_lines.values, cme_event[eve_lines.columns].values)
+    """
+    data = np.asarray(data, dtype=np.float64)
+    if data.ndim == 1:
+        data = data.reshape(-1, 1)
+    window_rows = np.shape(template)[0]
+    window_starts = sliding_window_starts(data.shape[0], window_rows, window_stride)
+    if len(window_starts) == 0:
+        return np.arange(data.shape[1])
+    sample_stride = int(np.ceil(len(window_starts) / float(n_sample_windows)))
+    _, correlation_coefficients = sliding_window_correlation(data, template, window_stride=window_stride * sample_stride)
+    mean_correlation_coefficients = np.where(np.isnan(correlation_coefficients), -1.0,
+                                             correlation_coefficients).mean(axis=0)
+    return np.argsort(mean_correlation_coefficients, kind='stable')
+
+
+def early_abandon_correlation(data, template, correlation_threshold, line_order=None, window_stride=60,
+                              window_starts=None, block_windows=4096):
+    """Compute Pearson correlation coefficients line by line, abandoning windows that can no longer reach a threshold.
+
+    Lines are scored in line_order. After each line, a window's total can grow by at most 1 per line still to be
+    scored, so once its partial total plus the number of remaining lines falls below correlation_threshold, it is
+    abandoned and its remaining lines are never computed. A NaN coefficient also abandons the window, since its total
+    would be NaN. The window statistics are the running sums of template_bank_correlation, so windows that are scored
+    in full get the same coefficients as sliding_window_correlation.
+
+    Inputs:
+        data [np.array]:              A 2-D array (rows x lines) of the light curves to scan, e.g., eve_lines.values.
+        template [np.array]:          A 2-D array (template rows x lines) of the CME signature, with its columns in
+                                      the same order as data.
+        correlation_threshold [float]: The minimum total coefficient (summed over all lines) of a window to score it
+                                       completely.
+
+    Optional Inputs:
+        line_order [np.array]:    The column indices in the order they are scored, e.g., from
+                                  discriminating_line_order(). Default is None, meaning column order.
+        window_stride [int]:      The number of rows to advance the window between scores. Default is 60.
+        window_starts [np.array]: Set to score only these window start rows, which must be increasing and spaced by
+                                  window_stride. Default is None, meaning every window from row 0.
+        block_windows [int]:      The number of windows to score at a time. Default is 4096.
+
+    Outputs:
+        window_starts [np.array]:            The first row index of each scored window.
+        correlation_coefficients [np.array]: A 2-D array (windows x lines) of Pearson correlation coefficients. NaN for
+                                             the lines of abandoned windows that were not scored.
+        lines_evaluated [np.array]:          The number of lines scored for each window.
+
+    Optional Outputs:
+        None
+
+    Example:
+        window_starts, correlation_coefficients, lines_evaluated = early_abandon_correlation(
+            eve_lines.values, cme_event[eve_lines.columns].values, 4.2, line_order=line_order)
+        print(lines_evaluated.mean())
+    """
+    data = np.asarray(data, dtype=np.float64)
+    template = np.array(template, dtype=np.float64, order='C')  # See template_bank_correlation
+    if data.ndim == 1:
+        data = data.reshape(-1, 1)
+    if template.ndim == 1:
+        template = template.reshape(-1, 1)
+    if data.shape[1] != template.shape[1]:
+        raise ValueError('data has {0} lines but template has {1}.'.format(data.shape[1], template.shape[1]))
+
+    window_rows, n_lines = template.shape
+    if line_order is None:
+        line_order = np.arange(n_lines)
+    if window_starts is None:
+        window_starts = sliding_window_starts(data.shape[0], window_rows, window_stride)
+    window_starts = np.asarray(window_starts, dtype=int)
+    correlation_coefficients = np.full((len(window_starts), n_lines), np.nan)
+    lines_evaluated = np.zeros(len(window_starts), dtype=int)
+
+    template_std = np.nanstd(template, axis=0)
+    centered_template = template - np.nanmean(template, axis=0)
+
+    for block_start in range(0, len(window_starts), block_windows):
+        block_window_starts = window_starts[block_start:block_start + block_windows]
+        first_row = block_window_starts[0]
+        last_row = block_window_starts[-1] + window_rows
+        block = np.array(data[first_row:last_row], order='C')  # See template_bank_correlation
+
+        # Window statistics from running sums, exactly as in template_bank_correlation
+        finite = np.isfinite(block)
+        block_center = np.where(finite, block, 0.0).sum(axis=0) / np.maximum(finite.sum(axis=0), 1)
+        x = np.where(finite, block - block_center, 0.0)
+        zero_row = np.zeros((1, n_lines))
+        sum_x = np.concatenate((zero_row, np.cumsum(x, axis=0)))
+        sum_x2 = np.concatenate((zero_row, np.cumsum(x * x, axis=0)))
+        nan_count = np.concatenate((zero_row, np.cumsum(~finite, axis=0)))
+
+        local_starts = block_window_starts - first_row
+        local_ends = local_starts + window_rows
+        window_std = _window_std(block, sum_x, sum_x2, local_starts, window_rows)
+        window_has_nan = (nan_count[local_ends] - nan_count[local_starts]) > 0
+
+        windows = sliding_window_view(x, window_rows, axis=0)[::window_stride]  # windows x lines x window_rows
+        active = np.arange(len(block_window_starts))
+        partial_total = np.zeros(len(block_window_starts))
+        for k, line in enumerate(line_order):
+            numerator = np.dot(windows[active, line, :], centered_template[:, line])
+            with np.errstate(divide='ignore', invalid='ignore'):
+                line_coefficients = numerator / (window_rows * window_std[active, line] * template_std[line])
+            line_coefficients[window_has_nan[active, line]] = np.nan
+            correlation_coefficients[block_start + active, line] = line_coefficients
+            lines_evaluated[block_start + active] += 1
+
+            # The most the total can still reach is the partial total plus 1 for every line not yet scored
+            partial_total[active] += line_coefficients
+            reachable = partial_total[active] + (n_lines - k - 1) >= correlation_threshold  # False for NaN too
+            active = active[reachable]
+            if len(active) == 0:
+                break
+
+    return window_starts, correlation_coefficients, lines_evaluated
+
+
+def _window_std(block, sum_x, sum_x2, window_starts, window_rows):
+    # The standard deviation of each window (windows x lines) from the running sums of the centered block, NaN for
+    # constant windows. For those, E[x^2] - mean^2 is only rounding error, whose square root would make the coefficient
+    # +-inf or noise instead of the NaN that np.std gives. A window is constant if no row differs from the one before.
+    window_ends = window_starts + window_rows
+    window_mean = (sum_x[window_ends] - sum_x[window_starts]) / window_rows
+    mean_square = (sum_x2[window_ends] - sum_x2[window_starts]) / window_rows
+    window_variance = mean_square - window_mean ** 2
+    changes = np.concatenate((np.zeros((2, block.shape[1])), np.cumsum(block[1:] != block[:-1], axis=0)))
+    constant = changes[window_ends] == changes[window_starts + 1]
+    constant |= window_variance <= np.finfo(np.float64).eps * np.maximum(mean_square, np.finfo(np.float64).tiny)
+    return np.where(constant, np.nan, np.sqrt(np.clip(window_variance, 0.0, None)))
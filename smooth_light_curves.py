@@ -0,0 +1,140 @@
+# Standard modules
+import os
+import numpy as np
+import pandas as pd
+import matplotlib.pyplot as plt
+import progressbar
+
+# Custom modules
+from automatic_fit_light_curve import automatic_fit_light_curves
+from jpm_logger import JpmLogger
+
+__author__ = 'Tyler J Albee & Shawn A Polson'
+__contact__ = 'tyal7988@colorado.edu'
+
+
+def smooth_light_curves(eve_lines, block_rows=720, overlap_rows=120, uncertainty_percent=0.002545,
+                        gamma_search='grid', smoothed_eve_data_path=None, verbose=False, logger=None):
+    """Fit every emission line over a whole data set once, in overlapping blocks whose edges are blended together.
+
+    Scanning windows overlap almost entirely, so fitting each window separately refits the same data many times. This
+    fits each line once per block instead. Each block is converted to percent of its first finite irradiance (the
+    units automatic_fit_light_curve is tuned for), fitted, and converted back to absolute irradiance. Where two blocks
+    overlap, their fits are blended with weights that ramp linearly across the overlap so the stitched curve has no
+    steps at block edges.
+
+    Inputs:
+        eve_lines [pd DataFrame]: EVE extracted emission lines with a DatetimeIndex and one column per line.
+
+    Optional Inputs:
+        block_rows [int]:               The number of rows fitted at a time. Default is 720 (12 hours of 1-minute data).
+        overlap_rows [int]:             The number of rows shared by consecutive blocks. Must be less than block_rows.
+                                        Default is 120.
+        uncertainty_percent [float]:    The irradiance uncertainty passed to the fits, in percent. Default is 0.002545.
+        gamma_search [str]:             The gamma_search of automatic_fit_light_curve. With 'halving', each block of a
+                                        line is warm started from the best gamma of the line's previous block.
+                                        Default is 'grid'.
+        smoothed_eve_data_path [str]:   Set to a csv path to reuse the smoothed data saved there by a previous call, or
+                                        to save it there if it does not exist yet. Default is None.
+        verbose [bool]:                 Set to log the processing messages to disk and console. Default is False.
+        logger [JpmLogger]:             A configured logger from jpm_logger.py. If set to None, will generate a
+                                        new one. Default is None.
+
+    Outputs:
+        eve_lines_smoothed [pd DataFrame]: The same shape and index as eve_lines, holding the fitted irradiance. Rows
+                                           where no block produced an acceptable fit are NaN.
+
+    Optional Outputs:
+        None
+
+    Example:
+        eve_lines_smoothed = smooth_light_curves(eve_lines, smoothed_eve_data_path='eve_selected_lines_smoothed.csv')
+    """
+
+    # Prepare the logger for verbose
+    if verbose:
+        if not logger:
+            logger = JpmLogger(filename='smooth_light_curves_log', path='./')
+        logger.info("Smoothing {0} rows of {1} lines.".format(len(eve_lines), len(eve_lines.columns)))
+
+    if smoothed_eve_data_path and os.path.exists(smoothed_eve_data_path):
+        eve_lines_smoothed = pd.read_csv(smoothed_eve_data_path, index_col=0)
+        eve_lines_smoothed.index = pd.to_datetime(eve_lines_smoothed.index)
+        if eve_lines_smoothed.index.equals(eve_lines.index) and eve_lines_smoothed.columns.equals(eve_lines.columns):
+            if verbose:
+                logger.info('Loaded previously smoothed data from {0}.'.format(smoothed_eve_data_path))
+            return eve_lines_smoothed
+        if verbose:
+            logger.warning('Smoothed data in {0} does not match the input rows; smoothing again.'.format(
+                smoothed_eve_data_path))
+
+    if overlap_rows >= block_rows:
+        raise ValueError('overlap_rows ({0}) must be less than block_rows ({1}).'.format(overlap_rows, block_rows))
+
+    n_rows = len(eve_lines)
+    block_step = block_rows - overlap_rows
+    block_starts = np.arange(0, max(n_rows - overlap_rows, 1), block_step)
+
+    # Blending weights of one block: ramp up over the leading overlap and down over the trailing one
+    ramp = (np.arange(overlap_rows) + 1.0) / (overlap_rows + 1.0)
+
+    weighted_fit_sum = np.zeros((n_rows, len(eve_lines.columns)))
+    weight_sum = np.zeros((n_rows, len(eve_lines.columns)))
+    line_gamma_priors = {}
+
+    # Start a progress bar
+    widgets = [progressbar.Percentage(), progressbar.Bar(), progressbar.Timer(), ' ', progressbar.AdaptiveETA()]
+    progress_bar_smoothing = progressbar.ProgressBar(widgets=[progressbar.FormatLabel('Light curve smoothing: ')] + widgets,
+                                                     max_value=len(block_starts)).start()
+
+    for k, block_start in enumerate(block_starts):
+        block = eve_lines.iloc[block_start:block_start + block_rows]
+        block_weights = np.ones(len(block))
+        if block_start > 0:
+            block_weights[:overlap_rows] = ramp[:len(block)]
+        if block_start + block_rows < n_rows:
+            block_weights[-overlap_rows:] = np.minimum(block_weights[-overlap_rows:], ramp[::-1])
+
+        # Fit in percent of each line's first finite irradiance in the block, then convert back to absolute units
+        fitted_columns = block.columns[block.notnull().any()]
+        reference_irradiance = block[fitted_columns].bfill().iloc[0]
+        block_percentages = (block[fitted_columns] - reference_irradiance) / reference_irradiance * 100.0
+
+        plt.close('all')
+        block_fit_percentages, best_fit_gammas, best_fit_scores = automatic_fit_light_curves(
+            block_percentages, uncertainty=uncertainty_percent, gamma_search=gamma_search,
+            gamma_priors=line_gamma_priors if gamma_search == 'halving' else None, verbose=verbose, logger=logger)
+
+        for column in fitted_columns:
+            if block_fit_percentages[column].isnull().all():
+                if verbose:
+                    logger.info('Block {0} {1} fit rejected with score {2:.2f}.'.format(k, column,
+                                                                                      best_fit_scores[column]))
+                continue
+            line_gamma_priors[column] = best_fit_gammas[column]
+
+            j = eve_lines.columns.get_loc(column)
+            fitted_irradiance = (block_fit_percentages[column].values / 100.0 * reference_irradiance[column] +
+                                 reference_irradiance[column])
+            fitted_rows = np.isfinite(fitted_irradiance)
+            block_rows_slice = slice(block_start, block_start + len(block))
+            weighted_fit_sum[block_rows_slice, j] += np.where(fitted_rows, fitted_irradiance * block_weights, 0.0)
+            weight_sum[block_rows_slice, j] += np.where(fitted_rows, block_weights, 0.0)
+
+        progress_bar_smoothing.update(k)
+
+    progress_bar_smoothing.finish()
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        smoothed = np.where(weight_sum > 0, weighted_fit_sum / weight_sum, np.nan)
+    eve_lines_smoothed = pd.DataFrame(smoothed, index=eve_lines.index, columns=eve_lines.columns)
+
+    if verbose:
+        logger.info('Smoothed {0} blocks of {1} rows.'.format(len(block_starts), block_rows))
+
+    if smoothed_eve_data_path:
+        eve_lines_smoothed.to_csv(smoothed_eve_data_path)
+        if verbose:
+            logger.info('Smoothed data saved to {0}.'.format(smoothed_eve_data_path))
+
+    return eve_lines_smoothed